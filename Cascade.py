@@ -0,0 +1,649 @@
+import json
+import math
+import numpy as np
+from collections import Counter
+
+import Utils
+
+# The cascade works on numpy arrays: queries are built and scores decoded with numpy, the model is only called through
+# run_model, so the onnxruntime backend (DimABSAOnnx.OnnxDimABSA) decodes without torch.
+
+# Query heads used when decoding. They are built from the english prompts the checkpoints are decoded with,
+# the sentence tokens (segment 1) are appended after them.
+forward_opinion_head = '[CLS] What opinion given the aspect'
+backward_aspect_head = '[CLS] What aspect does the opinion'
+category_head = '[CLS] What category given the aspect'
+valence_head = '[CLS] What valence given the aspect'
+arousal_head = '[CLS] What arousal given the aspect'
+pair_joint = 'and the opinion'
+
+# length of the forward aspect / backward opinion query templates in front of the sentence
+sentence_offset = 5
+
+# steps with (start_scores, end_scores) outputs
+SPAN_STEPS = ('A', 'O', 'AO', 'OA')
+
+
+def words_to_ids(tokenize, words):
+    return tokenize.convert_tokens_to_ids(
+        [w.lower() if w not in ['[CLS]', '[SEP]'] else w for w in words.split(' ')])
+
+
+def query_head_ids(tokenize):
+    """Token ids of all query pieces, looked up once per run instead of once per query."""
+    return {
+        'AO': words_to_ids(tokenize, forward_opinion_head),
+        'OA': words_to_ids(tokenize, backward_aspect_head),
+        'C': words_to_ids(tokenize, category_head),
+        'Valence': words_to_ids(tokenize, valence_head),
+        'Arousal': words_to_ids(tokenize, arousal_head),
+        'joint': tokenize.convert_tokens_to_ids([w.lower() for w in pair_joint.split(' ')]),
+        'describe': tokenize.convert_tokens_to_ids('describe'),
+        '?': tokenize.convert_tokens_to_ids('?'),
+        '[SEP]': tokenize.convert_tokens_to_ids('[SEP]'),
+    }
+
+
+def run_model(model, query, query_mask, query_seg, step, gpu):
+    """
+    model(query, mask, seg, step) on numpy queries, the scores come back as numpy arrays:
+    (start_scores, end_scores) for span steps, scores for C / Valence / Arousal.
+    A numpy_io model (the onnx backend) takes the arrays as they are, DimABSA gets tensors (on the GPU with gpu).
+    """
+    if getattr(model, 'numpy_io', False):
+        return model(query, query_mask, query_seg, step)
+
+    import torch
+
+    inputs = [torch.from_numpy(array) for array in (query, query_mask, query_seg)]
+    if gpu:
+        inputs = [tensor.cuda() for tensor in inputs]
+    scores = model(*inputs, step)
+    if step in SPAN_STEPS:
+        return scores[0].float().cpu().numpy(), scores[1].float().cpu().numpy()
+    return scores.float().cpu().numpy()
+
+
+def make_query(head, context_tokens):
+    """[head ids] + sentence tokens → (query, mask, seg) arrays of batch size 1."""
+    query = np.concatenate([np.asarray(head, dtype=np.int64), context_tokens])[np.newaxis]
+    query_mask = np.ones(query.shape, dtype=np.float32)
+    query_seg = np.array([[0] * len(head) + [1] * len(context_tokens)], dtype=np.int64)
+    return query, query_mask, query_seg
+
+
+def softmax_max(scores):
+    """(max probability, argmax) of the softmax over the last axis."""
+    exp = np.exp(scores - scores.max(axis=-1, keepdims=True))
+    probs = exp / exp.sum(axis=-1, keepdims=True)
+    return probs.max(axis=-1), probs.argmax(axis=-1)
+
+
+def span_prediction(start_scores, end_scores, valid_positions, max_len):
+    """Argmax start / end tags on the valid positions and pair them with Utils.filter_unpaired."""
+    start_prob, start_ind = softmax_max(start_scores[0])
+    end_prob, end_ind = softmax_max(end_scores[0])
+
+    start_prob, start_ind = start_prob.tolist(), start_ind.tolist()
+    end_prob, end_ind = end_prob.tolist(), end_ind.tolist()
+    valid_positions = valid_positions.tolist()
+
+    start_prob_temp = []
+    end_prob_temp = []
+    start_index_temp = []
+    end_index_temp = []
+    for k in range(len(start_ind)):
+        if valid_positions[k]:
+            if start_ind[k] == 1:
+                start_index_temp.append(k)
+                start_prob_temp.append(start_prob[k])
+            if end_ind[k] == 1:
+                end_index_temp.append(k)
+                end_prob_temp.append(end_prob[k])
+
+    return Utils.filter_unpaired(start_prob_temp, end_prob_temp, start_index_temp, end_index_temp, max_len)
+
+
+def context_tokens_of(batch_dict):
+    """Sentence tokens (segment 1 of the forward aspect query) shared by every follow-up query."""
+    return batch_dict['forward_asp_query'][0][batch_dict['forward_asp_answer_start'][0] > -1]
+
+
+def forward_pairs(model, batch_dict, context_tokens, head_ids, gpu, max_len, stats=None):
+    """A → AO pass. Returns [(asp_start, asp_end, opi_start, opi_end), prob] in decoding order."""
+    f_asp_start_scores, f_asp_end_scores = run_model(model, batch_dict['forward_asp_query'],
+                                                     batch_dict['forward_asp_query_mask'],
+                                                     batch_dict['forward_asp_query_seg'], 'A', gpu)
+    f_asp_start_index, f_asp_end_index, f_asp_prob = span_prediction(
+        f_asp_start_scores, f_asp_end_scores, batch_dict['forward_asp_answer_start'][0] != -1, max_len)
+    count_encoder_calls(stats, 1 + len(f_asp_start_index))
+
+    context_list = context_tokens.tolist()
+    pairs = []
+    for start_index in range(len(f_asp_start_index)):
+        asp_ind = (f_asp_start_index[start_index] - sentence_offset, f_asp_end_index[start_index] - sentence_offset)
+        head = head_ids['AO'] + context_list[asp_ind[0]:asp_ind[1] + 1] + [head_ids['?'], head_ids['[SEP]']]
+        f_opi_length = len(head)
+        opinion_query, opinion_query_mask, opinion_query_seg = make_query(head, context_tokens)
+
+        f_opi_start_scores, f_opi_end_scores = run_model(model, opinion_query, opinion_query_mask, opinion_query_seg,
+                                                         'AO', gpu)
+        f_opi_start_index, f_opi_end_index, f_opi_prob = span_prediction(
+            f_opi_start_scores, f_opi_end_scores, opinion_query_seg[0] == 1, max_len)
+
+        for idx in range(len(f_opi_start_index)):
+            opi_ind = (f_opi_start_index[idx] - f_opi_length, f_opi_end_index[idx] - f_opi_length)
+            pairs.append((asp_ind + opi_ind, math.sqrt(f_asp_prob[start_index] * f_opi_prob[idx])))
+    return pairs
+
+
+def backward_pairs(model, batch_dict, context_tokens, head_ids, gpu, max_len, stats=None):
+    """O → OA pass. Returns [(asp_start, asp_end, opi_start, opi_end), prob] in decoding order."""
+    b_opi_start_scores, b_opi_end_scores = run_model(model, batch_dict['backward_opi_query'],
+                                                     batch_dict['backward_opi_query_mask'],
+                                                     batch_dict['backward_opi_query_seg'], 'O', gpu)
+    b_opi_start_index, b_opi_end_index, b_opi_prob = span_prediction(
+        b_opi_start_scores, b_opi_end_scores, batch_dict['backward_opi_answer_start'][0] != -1, max_len)
+    count_encoder_calls(stats, 1 + len(b_opi_start_index))
+
+    context_list = context_tokens.tolist()
+    pairs = []
+    for start_index in range(len(b_opi_start_index)):
+        opi_ind = (b_opi_start_index[start_index] - sentence_offset, b_opi_end_index[start_index] - sentence_offset)
+        head = head_ids['OA'] + context_list[opi_ind[0]:opi_ind[1] + 1] + \
+            [head_ids['describe'], head_ids['?'], head_ids['[SEP]']]
+        b_asp_length = len(head)
+        aspect_query, aspect_query_mask, aspect_query_seg = make_query(head, context_tokens)
+
+        b_asp_start_scores, b_asp_end_scores = run_model(model, aspect_query, aspect_query_mask, aspect_query_seg,
+                                                         'OA', gpu)
+        b_asp_start_index, b_asp_end_index, b_asp_prob = span_prediction(
+            b_asp_start_scores, b_asp_end_scores, aspect_query_seg[0] == 1, max_len)
+
+        for idx in range(len(b_asp_start_index)):
+            asp_ind = (b_asp_start_index[idx] - b_asp_length, b_asp_end_index[idx] - b_asp_length)
+            pairs.append((asp_ind + opi_ind, math.sqrt(b_asp_prob[idx] * b_opi_prob[start_index])))
+    return pairs
+
+
+def new_decode_stats():
+    return {'sentences': 0, 'encoder_calls': 0, 'backward_skipped': 0, 'encoder_calls_saved': 0}
+
+
+def count_encoder_calls(stats, calls):
+    if stats is not None:
+        stats['encoder_calls'] += calls
+
+
+def candidate_pairs(model, batch_dict, head_ids, gpu, max_len, fast_threshold=None, stats=None):
+    """
+    Run both directions of the cascade for one sentence (batch size 1).
+    With fast_threshold set ("fast" decoding policy) the backward O → OA pass is skipped when the forward pass
+    found at least one pair and every forward pair has prob >= fast_threshold, backward is then None.
+    """
+    context_tokens = context_tokens_of(batch_dict)
+    forward = forward_pairs(model, batch_dict, context_tokens, head_ids, gpu, max_len, stats)
+    if stats is not None:
+        stats['sentences'] += 1
+
+    if fast_threshold is not None and forward and all(prob >= fast_threshold for _, prob in forward):
+        if stats is not None:
+            # the skipped pass would have cost one O query plus (at least) one OA query per predicted opinion,
+            # pairs it would have added would also have cost their C / Valence / Arousal queries
+            stats['backward_skipped'] += 1
+            stats['encoder_calls_saved'] += 1 + len(set(ind[2:] for ind, _ in forward))
+        return context_tokens, forward, None
+
+    backward = backward_pairs(model, batch_dict, context_tokens, head_ids, gpu, max_len, stats)
+    return context_tokens, forward, backward
+
+
+def log_decode_stats(stats, logger):
+    full_calls = stats['encoder_calls'] + stats['encoder_calls_saved']
+    logger.info('decoding: sentences: {}\tbackward passes skipped: {}\tencoder calls: {}\t'
+                'backward calls saved (lower bound): {} ({:.1f}%)'.format(
+                    stats['sentences'], stats['backward_skipped'], stats['encoder_calls'],
+                    stats['encoder_calls_saved'], 100. * stats['encoder_calls_saved'] / full_calls if full_calls else 0.))
+
+
+def pair_tokens(context_list, ind):
+    return context_list[ind[0]:ind[1] + 1], context_list[ind[2]:ind[3] + 1]
+
+
+def unique_pairs(context_list, pairs):
+    """Drop repeated index tuples (first one wins), returns [(ind, (asp_tokens, opi_tokens), prob)]."""
+    seen = set()
+    result = []
+    for ind, prob in pairs:
+        ind = tuple(ind)
+        if ind not in seen:
+            seen.add(ind)
+            asp, opi = pair_tokens(context_list, ind)
+            result.append((ind, (tuple(asp), tuple(opi)), prob))
+    return result
+
+
+def merge_pairs(context_list, forward, backward, beta):
+    """
+    Keep forward pairs confirmed by the backward pass (same aspect / opinion tokens) or with prob >= beta,
+    then backward-only pairs with prob >= beta. Pairs are grouped by aspect tokens.
+    backward=None (skipped by the fast policy) keeps every forward pair, they all passed fast_threshold.
+    Returns final_asp_list, final_opi_list, final_asp_ind_list, final_opi_ind_list.
+    """
+    if backward is None:
+        backward = forward
+
+    forward_pairs_unique = unique_pairs(context_list, forward)
+    backward_pairs_unique = unique_pairs(context_list, backward)
+    forward_keys = set(key for _, key, _ in forward_pairs_unique)
+    backward_keys = set(key for _, key, _ in backward_pairs_unique)
+
+    final_asp_list = []
+    final_opi_list = []
+    final_asp_ind_list = []
+    final_opi_ind_list = []
+    asp_position = {}  # aspect tokens → index in the final lists
+    opi_seen = []  # per aspect, opinion tokens already kept
+
+    def keep(ind, key):
+        asp, opi = key
+        if asp not in asp_position:
+            asp_position[asp] = len(final_asp_list)
+            final_asp_list.append(list(asp))
+            final_opi_list.append([list(opi)])
+            final_asp_ind_list.append(list(ind[:2]))
+            final_opi_ind_list.append([list(ind[2:])])
+            opi_seen.append({opi})
+        else:
+            asp_index = asp_position[asp]
+            if opi not in opi_seen[asp_index]:
+                opi_seen[asp_index].add(opi)
+                final_opi_list[asp_index].append(list(opi))
+                final_opi_ind_list[asp_index].append(list(ind[2:]))
+
+    for ind, key, prob in forward_pairs_unique:
+        if key in backward_keys or prob >= beta:
+            keep(ind, key)
+
+    for ind, key, prob in backward_pairs_unique:
+        if key not in forward_keys and prob >= beta:
+            keep(ind, key)
+
+    return final_asp_list, final_opi_list, final_asp_ind_list, final_opi_ind_list
+
+
+def predict_attributes(model, head_ids, asp, opi, context_tokens, gpu, steps, stats=None):
+    """
+    Run the pair level heads ('C', 'Valence', 'Arousal') for one aspect / opinion token pair.
+    Returns (category id or None, valence or None, arousal or None).
+    """
+    results = {}
+    count_encoder_calls(stats, len(steps))
+    for step in steps:
+        head = head_ids[step] + asp + head_ids['joint'] + opi + [head_ids['?'], head_ids['[SEP]']]
+        query, query_mask, query_seg = make_query(head, context_tokens)
+        scores = run_model(model, query, query_mask, query_seg, step, gpu)
+        if step == 'C':
+            results[step] = int(np.argmax(scores[0]))
+        else:
+            results[step] = scores.item()
+    return results.get('C'), results.get('Valence'), results.get('Arousal')
+
+
+def sentence_predictions(merged, attributes, with_va):
+    """
+    Turn the merged pairs into the prediction lists used for scoring / output.
+    attributes(asp_tokens, opi_tokens) → (category, valence, arousal).
+    """
+    final_asp_list, final_opi_list, final_asp_ind_list, final_opi_ind_list = merged
+    predictions = {
+        'triplet': [],
+        'aspect': [],
+        'opinion': [],
+        'aspect_opinion': [],
+        'aspect_category': [],
+    }
+    # lists keep the output order, sets answer the "already predicted" checks
+    seen = {name: set() for name in predictions}
+
+    def add(name, item):
+        key = tuple(item)
+        if key not in seen[name]:
+            seen[name].add(key)
+            predictions[name].append(item)
+
+    for idx in range(len(final_asp_list)):
+        for idy in range(len(final_opi_list[idx])):
+            category_predicted, valence, arousal = attributes(final_asp_list[idx], final_opi_list[idx][idy])
+
+            asp_f = [final_asp_ind_list[idx][0], final_asp_ind_list[idx][1]]
+            opi_f = [final_opi_ind_list[idx][idy][0], final_opi_ind_list[idx][idy][1]]
+
+            add('opinion', opi_f)
+            add('aspect', asp_f)
+            add('aspect_opinion', asp_f + opi_f)
+            add('aspect_category', asp_f + [category_predicted])
+
+            triplet_predict = asp_f + opi_f + [category_predicted]
+            if with_va:
+                triplet_predict += [str(round(valence, 2)), str(round(arousal, 2))]
+            add('triplet', triplet_predict)
+    return predictions
+
+
+def decode_span(tokenize, word_list_ids, start, end, language, line=None, offsets=None):
+    """
+    Text of the sentence tokens start..end. With the review and the character offsets of its tokens the span is cut
+    out of the review as written, otherwise the token ids are decoded (zho / jpn spans are written without spaces).
+    """
+    # 位置 0 是 "null", 沒有 offset
+    if offsets is not None and 1 <= start <= end:
+        return line[offsets[start - 1][0]:offsets[end - 1][1]]
+    text = tokenize.decode(word_list_ids[start:end + 1])
+    if language in ['zho', 'jpn']:
+        text = text.replace(" ", "")
+    return text
+
+
+def prediction_records(data_id, word_list_ids, triplets, tokenize, language, task, ids_to_categories, line=None,
+                       offsets=None):
+    """Predicted index triplets of one sentence → the Task 2 'Triplet' and Task 3 'Quadruplet' output records."""
+    dump_data_triple = {
+        "ID": data_id,
+        "Triplet": [],
+    }
+    dump_data_quadra = {
+        "ID": data_id,
+        "Quadruplet": [],
+    }
+    for triplet in triplets:
+        meta_triplet = {}
+        meta_triplet["Aspect"] = decode_span(tokenize, word_list_ids, triplet[0], triplet[1], language, line, offsets)
+        meta_triplet["Opinion"] = decode_span(tokenize, word_list_ids, triplet[2], triplet[3], language, line, offsets)
+        meta_triplet["VA"] = triplet[5] + "#" + triplet[6]
+
+        dump_data_triple['Triplet'].append(meta_triplet)
+
+        if task == 3:
+            meta_quadra = {}
+            meta_quadra["Aspect"] = meta_triplet["Aspect"]
+            meta_quadra["Opinion"] = meta_triplet["Opinion"]
+            meta_quadra["VA"] = meta_triplet["VA"]
+            meta_quadra["Category"] = ids_to_categories[triplet[4]]
+            dump_data_quadra['Quadruplet'].append(meta_quadra)
+    return dump_data_triple, dump_data_quadra
+
+
+# ---------------- batched cascade (many sentences per encoder call) ----------------
+
+
+def run_queries(model, step, queries, gpu, batch_size):
+    """
+    Run one head over many queries of different lengths, batch_size queries per encoder call.
+    Queries are sorted by length and padded (mask 0) inside a batch.
+    queries: [(query_ids, seg_ids)], returns one output per query, cut back to batch size 1 and its own length:
+    (start_scores, end_scores) for span steps, scores for C / Valence / Arousal.
+    """
+    outputs = [None] * len(queries)
+    order = sorted(range(len(queries)), key=lambda idx: len(queries[idx][0]))
+    for begin in range(0, len(order), batch_size):
+        chunk = order[begin:begin + batch_size]
+        width = max(len(queries[idx][0]) for idx in chunk)
+        query = np.zeros((len(chunk), width), dtype=np.int64)
+        query_mask = np.zeros((len(chunk), width), dtype=np.float32)
+        query_seg = np.zeros((len(chunk), width), dtype=np.int64)
+        for row, idx in enumerate(chunk):
+            query_ids, seg_ids = queries[idx]
+            query[row, :len(query_ids)] = query_ids
+            query_mask[row, :len(query_ids)] = 1
+            query_seg[row, :len(query_ids)] = seg_ids
+
+        scores = run_model(model, query, query_mask, query_seg, step, gpu)
+        for row, idx in enumerate(chunk):
+            length = len(queries[idx][0])
+            if step in SPAN_STEPS:
+                outputs[idx] = (scores[0][row:row + 1, :length], scores[1][row:row + 1, :length])
+            else:
+                outputs[idx] = scores[row:row + 1]
+    return outputs
+
+
+def batched_direction_pairs(model, sentences, indices, contexts, head_ids, gpu, max_len, batch_size, backward):
+    """
+    forward_pairs / backward_pairs for the sentences[i], i in indices, with every step batched across sentences.
+    Returns {i: [(asp_start, asp_end, opi_start, opi_end), prob]}.
+    """
+    prefix, first_step, second_step = ('backward_opi', 'O', 'OA') if backward else ('forward_asp', 'A', 'AO')
+    first_outputs = run_queries(
+        model, first_step,
+        [(np.asarray(sentences[i][prefix + '_query']).tolist(), np.asarray(sentences[i][prefix + '_query_seg']).tolist())
+         for i in indices],
+        gpu, batch_size)
+
+    second_queries = []
+    second_meta = []
+    for i, (start_scores, end_scores) in zip(indices, first_outputs):
+        start_index, end_index, first_prob = span_prediction(
+            start_scores, end_scores, np.asarray(sentences[i][prefix + '_answer_start']) != -1, max_len)
+        for k in range(len(start_index)):
+            first_ind = (start_index[k] - sentence_offset, end_index[k] - sentence_offset)
+            span = contexts[i][first_ind[0]:first_ind[1] + 1]
+            if backward:
+                head = head_ids['OA'] + span + [head_ids['describe'], head_ids['?'], head_ids['[SEP]']]
+            else:
+                head = head_ids['AO'] + span + [head_ids['?'], head_ids['[SEP]']]
+            second_queries.append((head + contexts[i], [0] * len(head) + [1] * len(contexts[i])))
+            second_meta.append((i, first_ind, first_prob[k], len(head)))
+
+    pairs = {i: [] for i in indices}
+    second_outputs = run_queries(model, second_step, second_queries, gpu, batch_size)
+    for (i, first_ind, first_prob, head_length), (start_scores, end_scores) in zip(second_meta, second_outputs):
+        valid_positions = np.array([0] * head_length + [1] * len(contexts[i])) == 1
+        start_index, end_index, second_prob = span_prediction(start_scores, end_scores, valid_positions, max_len)
+        for idx in range(len(start_index)):
+            second_ind = (start_index[idx] - head_length, end_index[idx] - head_length)
+            if backward:
+                pairs[i].append((second_ind + first_ind, math.sqrt(second_prob[idx] * first_prob)))
+            else:
+                pairs[i].append((first_ind + second_ind, math.sqrt(first_prob * second_prob[idx])))
+    return pairs
+
+
+def batched_candidate_pairs(model, sentences, head_ids, gpu, max_len, batch_size, fast_threshold=None):
+    """
+    candidate_pairs for a list of sentences (InferenceReviewDataset items), returns (contexts, forward, backward)
+    lists; backward[i] is None when the fast policy skipped it.
+    """
+    contexts = []
+    for sentence in sentences:
+        answer_start = np.asarray(sentence['forward_asp_answer_start'])
+        contexts.append(np.asarray(sentence['forward_asp_query'])[answer_start > -1].tolist())
+
+    indices = list(range(len(sentences)))
+    forward = batched_direction_pairs(model, sentences, indices, contexts, head_ids, gpu, max_len, batch_size, False)
+    if fast_threshold is not None:
+        indices = [i for i in indices
+                   if not (forward[i] and all(prob >= fast_threshold for _, prob in forward[i]))]
+    backward = batched_direction_pairs(model, sentences, indices, contexts, head_ids, gpu, max_len, batch_size, True)
+    return contexts, [forward[i] for i in range(len(sentences))], [backward.get(i) for i in range(len(sentences))]
+
+
+def batched_attributes(model, head_ids, pairs, gpu, steps, batch_size):
+    """predict_attributes for many (asp_tokens, opi_tokens, context_tokens) at once, returns [(category, v, a)]."""
+    results = {}
+    for step in steps:
+        queries = []
+        for asp, opi, context in pairs:
+            head = head_ids[step] + list(asp) + head_ids['joint'] + list(opi) + [head_ids['?'], head_ids['[SEP]']]
+            queries.append((head + list(context), [0] * len(head) + [1] * len(context)))
+        outputs = run_queries(model, step, queries, gpu, batch_size)
+        if step == 'C':
+            results[step] = [int(np.argmax(scores[0])) for scores in outputs]
+        else:
+            results[step] = [scores.item() for scores in outputs]
+    return [(results['C'][k] if 'C' in results else None,
+             results['Valence'][k] if 'Valence' in results else None,
+             results['Arousal'][k] if 'Arousal' in results else None) for k in range(len(pairs))]
+
+
+def batched_predictions(model, sentences, head_ids, gpu, max_len, beta, steps, batch_size, fast_threshold=None):
+    """Full cascade for a list of sentences, returns the sentence_predictions(with_va=True) dict of each."""
+    contexts, forward, backward = batched_candidate_pairs(
+        model, sentences, head_ids, gpu, max_len, batch_size, fast_threshold)
+    merged_list = [merge_pairs(contexts[i], forward[i], backward[i], beta) for i in range(len(sentences))]
+
+    # every (aspect, opinion) pair of every sentence goes through the C / V / A heads together
+    pair_keys = []
+    for i, merged in enumerate(merged_list):
+        final_asp_list, final_opi_list = merged[0], merged[1]
+        for idx in range(len(final_asp_list)):
+            for opi in final_opi_list[idx]:
+                pair_keys.append((i, tuple(final_asp_list[idx]), tuple(opi)))
+    pair_keys = list(dict.fromkeys(pair_keys))
+    values = batched_attributes(model, head_ids, [(asp, opi, contexts[i]) for i, asp, opi in pair_keys],
+                                gpu, steps, batch_size)
+    attributes = dict(zip(pair_keys, values))
+
+    return [sentence_predictions(merged, lambda asp, opi, i=i: attributes[(i, tuple(asp), tuple(opi))], with_va=True)
+            for i, merged in enumerate(merged_list)]
+
+
+def new_match_counts():
+    return {name: {'target': 0, 'predict': 0, 'match': 0}
+            for name in ['triplet', 'aspect', 'opinion', 'aspect_opinion', 'aspect_category']}
+
+
+def update_match_counts(counts, predictions, test_example):
+    targets = {
+        'triplet': test_example.triplet_list,
+        'aspect': test_example.aspect_list,
+        'opinion': test_example.opinion_list,
+        'aspect_opinion': test_example.asp_opi_list,
+        'aspect_category': test_example.asp_cate_list,
+    }
+    for name, target in targets.items():
+        counts[name]['target'] += len(target)
+        counts[name]['predict'] += len(predictions[name])
+        # every prediction matches each equal gold entry (gold lists may repeat a tuple)
+        target_count = Counter(tuple(trip_) for trip_ in target)
+        for trip in predictions[name]:
+            counts[name]['match'] += target_count[tuple(trip)]
+
+
+def precision_recall_f1(count):
+    precision = float(count['match']) / float(count['predict'] + 1e-6)
+    recall = float(count['match']) / float(count['target'] + 1e-6)
+    f1 = 2 * precision * recall / (precision + recall + 1e-6)
+    return precision, recall, f1
+
+
+def new_va_errors():
+    return {'valence': 0., 'arousal': 0., 'num': 0}
+
+
+def update_va_errors(va_errors, predictions, test_example, context_list, attributes):
+    """Squared VA error of the predicted triplets that match a gold triplet (first gold occurrence)."""
+    gold_va = {}
+    for triplet, va in zip(test_example.triplet_list, test_example.VA_list):
+        gold_va.setdefault(tuple(triplet), va)
+    for triplet in predictions['triplet']:
+        key = tuple(triplet[:5])
+        if key not in gold_va:
+            continue
+        gold_valence, gold_arousal = gold_va[key]
+        _, valence, arousal = attributes(*pair_tokens(context_list, triplet[:4]))
+        va_errors['valence'] += (valence - float(gold_valence)) ** 2
+        va_errors['arousal'] += (arousal - float(gold_arousal)) ** 2
+        va_errors['num'] += 1
+
+
+def va_rmse(va_errors):
+    """(valence RMSE, arousal RMSE), None when no triplet matched."""
+    if va_errors['num'] == 0:
+        return None, None
+    return math.sqrt(va_errors['valence'] / va_errors['num']), math.sqrt(va_errors['arousal'] / va_errors['num'])
+
+
+def log_match_counts(counts, logger):
+    """Log P/R/F1 of every sub-task and return the triplet F1."""
+    names = [('triplet', 'Triplet'), ('aspect', 'Aspect'), ('opinion', 'Opinion'),
+             ('aspect_category', 'Aspect-Category'), ('aspect_opinion', 'Aspect-Opinion')]
+    triplet_f1 = 0.
+    for name, title in names:
+        precision, recall, f1 = precision_recall_f1(counts[name])
+        logger.info('{} - Precision: {}\tRecall: {}\tF1: {}'.format(title, precision, recall, f1))
+        if name == 'triplet':
+            triplet_f1 = f1
+    return triplet_f1
+
+
+def save_candidates(file_name, sentences, meta):
+    """
+    Store per-sentence candidate pairs as flat numpy arrays (np.savez_compressed).
+    sentences: [{'context': [ids], 'forward': [(ind, prob)], 'backward': [(ind, prob)],
+                 'attributes': {(asp_tokens, opi_tokens): (category, valence, arousal)}}]
+    """
+    context_offsets = [0]
+    context_tokens = []
+    pair_offsets = [0]
+    pair_index = []
+    pair_prob = []
+    pair_backward = []
+    pair_category = []
+    pair_valence = []
+    pair_arousal = []
+    for sentence in sentences:
+        context_tokens.extend(sentence['context'])
+        context_offsets.append(len(context_tokens))
+        for backward, pairs in ((False, sentence['forward']), (True, sentence['backward'])):
+            for ind, prob in pairs:
+                asp, opi = pair_tokens(sentence['context'], ind)
+                category, valence, arousal = sentence['attributes'][(tuple(asp), tuple(opi))]
+                pair_index.append(ind)
+                pair_prob.append(prob)
+                pair_backward.append(backward)
+                pair_category.append(-1 if category is None else category)
+                pair_valence.append(float('nan') if valence is None else valence)
+                pair_arousal.append(float('nan') if arousal is None else arousal)
+        pair_offsets.append(len(pair_index))
+
+    np.savez_compressed(file_name,
+                        meta=np.array(json.dumps(meta)),
+                        context_offsets=np.array(context_offsets, dtype=np.int64),
+                        context_tokens=np.array(context_tokens, dtype=np.int32),
+                        pair_offsets=np.array(pair_offsets, dtype=np.int64),
+                        pair_index=np.array(pair_index, dtype=np.int32).reshape(-1, 4),
+                        pair_prob=np.array(pair_prob, dtype=np.float64),
+                        pair_backward=np.array(pair_backward, dtype=bool),
+                        pair_category=np.array(pair_category, dtype=np.int32),
+                        pair_valence=np.array(pair_valence, dtype=np.float64),
+                        pair_arousal=np.array(pair_arousal, dtype=np.float64))
+
+
+def load_candidates(file_name):
+    """Inverse of save_candidates, returns (sentences, meta)."""
+    data = np.load(file_name, allow_pickle=False)
+    meta = json.loads(str(data['meta']))
+    context_offsets = data['context_offsets'].tolist()
+    context_tokens = data['context_tokens'].tolist()
+    pair_offsets = data['pair_offsets'].tolist()
+    pair_index = [tuple(ind) for ind in data['pair_index'].tolist()]
+    pair_prob = data['pair_prob'].tolist()
+    pair_backward = data['pair_backward'].tolist()
+    pair_category = data['pair_category'].tolist()
+    pair_valence = data['pair_valence'].tolist()
+    pair_arousal = data['pair_arousal'].tolist()
+
+    sentences = []
+    for i in range(len(context_offsets) - 1):
+        context = context_tokens[context_offsets[i]:context_offsets[i + 1]]
+        sentence = {'context': context, 'forward': [], 'backward': [], 'attributes': {}}
+        for j in range(pair_offsets[i], pair_offsets[i + 1]):
+            sentence['backward' if pair_backward[j] else 'forward'].append((pair_index[j], pair_prob[j]))
+            asp, opi = pair_tokens(context, pair_index[j])
+            sentence['attributes'][(tuple(asp), tuple(opi))] = (
+                None if pair_category[j] == -1 else pair_category[j],
+                None if math.isnan(pair_valence[j]) else pair_valence[j],
+                None if math.isnan(pair_arousal[j]) else pair_arousal[j])
+        sentences.append(sentence)
+    return sentences, meta
@@ -0,0 +1,33 @@
+from Utils import combine_lists
+
+# entity#attribute category labels of every domain, category_map[domain] → (category → id dict, category list)
+
+restaurant_entity_labels = ['RESTAURANT', 'FOOD', 'DRINKS', 'AMBIENCE', 'SERVICE', 'LOCATION']
+restaurant_attribute_labels= ['GENERAL', 'PRICES', 'QUALITY', 'STYLE_OPTIONS', 'MISCELLANEOUS']
+restaurant_category_dict, restaurant_category_list = combine_lists(restaurant_entity_labels, restaurant_attribute_labels)
+
+laptop_entity_labels = ['LAPTOP', 'DISPLAY', 'KEYBOARD', 'MOUSE', 'MOTHERBOARD', 'CPU', 'FANS_COOLING', 'PORTS', 'MEMORY', 'POWER_SUPPLY', 'OPTICAL_DRIVES', 'BATTERY', 'GRAPHICS', 'HARD_DISK', 'MULTIMEDIA_DEVICES', 'HARDWARE', 'SOFTWARE', 'OS', 'WARRANTY', 'SHIPPING', 'SUPPORT', 'COMPANY']+ ['OUT_OF_SCOPE']
+laptop_attribute_labels = ['GENERAL', 'PRICE', 'QUALITY', 'DESIGN_FEATURES', 'OPERATION_PERFORMANCE', 'USABILITY', 'PORTABILITY', 'CONNECTIVITY', 'MISCELLANEOUS']
+laptop_category_dict, laptop_category_list = combine_lists(laptop_entity_labels, laptop_attribute_labels)
+
+
+hotel_entity_labels = ['HOTEL', 'ROOMS', 'FACILITIES', 'ROOM_AMENITIES', 'SERVICE', 'LOCATION', 'FOOD_DRINKS']
+hotel_attribute_labels = ['GENERAL', 'PRICE', 'COMFORT', 'CLEANLINESS', 'QUALITY', 'DESIGN_FEATURES', 'STYLE_OPTIONS', 'MISCELLANEOUS']
+hotel_category_dict, hotel_category_list = combine_lists(hotel_entity_labels, hotel_attribute_labels)
+
+finance_entity_labels = ['MARKET', 'COMPANY', 'BUSINESS', 'PRODUCT']
+finance_attribute_labels = ['GENERAL', 'SALES', 'PROFIT', 'AMOUNT', 'PRICE', 'COST']
+finance_category_dict, finance_category_list = combine_lists(finance_entity_labels, finance_attribute_labels)
+
+
+# laptop category spellings of the datasets → the labels above
+lap_filter_from_category = ["HARD_DISC", "PRICES","OPERATION&PERFORMANCE","FANS&COOLING", "FANS & COOLING", "FANS_&_COOLING", "HARD DISK", "MULTIMEDIA DEVICES", "POWER SUPPLY", "DESIGN & FEATURES"]
+lap_filter_to_category = ["HARD_DISK", "PRICE", "OPERATION_PERFORMANCE", "FANS_COOLING", "FANS_COOLING", "FANS_COOLING", "HARD_DISK", "MULTIMEDIA_DEVICES", "POWER_SUPPLY", "DESIGN_FEATURES"]
+
+
+category_map = {
+    'res': (restaurant_category_dict, restaurant_category_list),
+    'lap': (laptop_category_dict, laptop_category_list),
+    'hot': (hotel_category_dict, hotel_category_list),
+    'fin': (finance_category_dict, finance_category_list),
+}
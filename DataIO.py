@@ -0,0 +1,292 @@
+import argparse
+import gzip
+import hashlib
+import io
+import itertools
+import json
+import os
+
+import Utils
+
+# Review files are JSONL (one {"ID", "Text", "Quadruplet" / "Triplet"} object per line) or Parquet written by
+# `python DataIO.py --input x.jsonl --output x.parquet`: one row per review, the tuples flattened into list columns
+# (Aspect / Opinion / Category / VA + Valence / Arousal as floats) and optionally the token ids / character offsets of
+# the lower-cased Text. Every reader goes through iter_reviews / shard_ranges and takes both formats.
+# pyarrow is imported only when a Parquet file is read or written (pip install pyarrow).
+# JSONL files (reviews and predictions) can also be .jsonl.gz / .jsonl.zst: open_text (de)compresses them as a stream,
+# zstandard is imported only for .zst files (pip install zstandard).
+
+# bumped whenever the Parquet columns change
+PARQUET_FORMAT = 1
+# key of the JSON metadata in the Parquet schema
+METADATA_KEY = b'dimabsa'
+TUPLE_FIELDS = ['Aspect', 'Opinion', 'Category', 'VA']
+
+
+def is_parquet(file_name):
+    return file_name.endswith('.parquet')
+
+
+def compression(file_name):
+    """'gz' / 'zst' for a compressed file name, else None."""
+    for suffix in ('gz', 'zst'):
+        if file_name.endswith('.' + suffix):
+            return suffix
+    return None
+
+
+def compressed_name(file_name, suffix):
+    """x.jsonl → x.jsonl.gz / x.jsonl.zst, suffix None keeps the name."""
+    return file_name + '.' + suffix if suffix else file_name
+
+
+def open_text(file_name, mode='r'):
+    """
+    open(file_name, mode, encoding='utf-8') that (de)compresses .gz / .zst files as a stream, mode: 'r', 'w' or 'a'.
+    Concatenated gzip members / zstd frames are read back as one file.
+    """
+    suffix = compression(file_name)
+    if suffix is None:
+        return open(file_name, mode, encoding='utf-8')
+    if suffix == 'gz':
+        return gzip.open(file_name, mode + 't', encoding='utf-8')
+
+    import zstandard
+
+    if mode == 'r':
+        stream = zstandard.ZstdDecompressor().stream_reader(open(file_name, 'rb'), read_across_frames=True)
+    else:
+        # 'a' adds another frame after the existing ones
+        stream = zstandard.ZstdCompressor().stream_writer(open(file_name, mode + 'b'))
+    return io.TextIOWrapper(stream, encoding='utf-8')
+
+
+def count_lines(file_name):
+    with open_text(file_name) as f:
+        return sum(1 for _ in f)
+
+
+def tokenizer_fingerprint(bert_model_type):
+    """The token columns are only used with the tokenizer (files) they were written with."""
+    from PredictionCache import fingerprint
+
+    files = [os.path.join(bert_model_type, name) for name in ['tokenizer.json', 'vocab.txt', 'tokenizer_config.json']]
+    return fingerprint(files, {'bert_model_type': os.path.basename(os.path.normpath(bert_model_type))})
+
+
+def review_projection(data):
+    """
+    The fields of a review the training features are built from: ID, Text and the tuples with the TUPLE_FIELDS keys
+    only (a missing Category is None). Extra fields are not kept by the Parquet conversion and are left out here too.
+    """
+    review = {'ID': data.get('ID'), 'Text': data.get('Text')}
+    for tuple_key in ('Quadruplet', 'Triplet'):
+        if tuple_key in data:
+            review[tuple_key] = [{name: item.get(name) for name in TUPLE_FIELDS} for item in data[tuple_key]]
+    return review
+
+
+def content_hash(data):
+    """Hash of review_projection(data), so it is the same for a review's JSONL line and its Parquet row."""
+    projection = review_projection(data)
+    return hashlib.sha256(json.dumps(projection, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+
+def parquet_metadata(file_name):
+    import pyarrow.parquet as pq
+
+    metadata = pq.read_schema(file_name).metadata or {}
+    return json.loads(metadata[METADATA_KEY]) if METADATA_KEY in metadata else {}
+
+
+def shard_ranges(file_name, num_shards):
+    """
+    At most num_shards contiguous ranges of the file, read back in order by iter_reviews(file_name, shard_range):
+    byte ranges of a JSONL file (Utils.shard_byte_ranges), row group ranges of a Parquet file, line ranges of a
+    compressed JSONL file (it cannot be seeked, so the lines are counted once and every shard skips to its start).
+    """
+    if compression(file_name) is not None:
+        num_lines = count_lines(file_name)
+        num_shards = max(1, min(num_shards, num_lines))
+        boundaries = [num_lines * shard // num_shards for shard in range(num_shards + 1)]
+        return [(start, end) for start, end in zip(boundaries[:-1], boundaries[1:]) if end > start]
+    if not is_parquet(file_name):
+        return Utils.shard_byte_ranges(file_name, num_shards)
+    import pyarrow.parquet as pq
+
+    num_row_groups = pq.ParquetFile(file_name).num_row_groups
+    num_shards = max(1, min(num_shards, num_row_groups))
+    boundaries = [num_row_groups * shard // num_shards for shard in range(num_shards + 1)]
+    return [(start, end) for start, end in zip(boundaries[:-1], boundaries[1:]) if end > start]
+
+
+def iter_parquet_rows(file_name, columns=None, shard_range=None, batch_size=1024):
+    """Rows of a Parquet file as dicts, batch_size rows are decoded at a time."""
+    import pyarrow.parquet as pq
+
+    parquet_file = pq.ParquetFile(file_name)
+    row_groups = list(range(*shard_range)) if shard_range is not None else None
+    for batch in parquet_file.iter_batches(batch_size=batch_size, row_groups=row_groups, columns=columns):
+        for row in batch.to_pylist():
+            yield row
+
+
+def row_to_review(row, tuple_key):
+    """Parquet row → the review dict of its JSONL line (Category is left out of tuples that have none)."""
+    review = {'ID': row['ID'], 'Text': row['Text']}
+    if tuple_key is not None:
+        tuples = []
+        for aspect, opinion, category, va in zip(row['Aspect'], row['Opinion'], row['Category'], row['VA']):
+            if category is None:
+                tuples.append({'Aspect': aspect, 'Opinion': opinion, 'VA': va})
+            else:
+                tuples.append({'Aspect': aspect, 'Category': category, 'Opinion': opinion, 'VA': va})
+        review[tuple_key] = tuples
+    return review
+
+
+def iter_reviews(file_name, shard_range=None, on_error=None):
+    """
+    Review dicts of a JSONL (.jsonl / .jsonl.gz / .jsonl.zst) or Parquet file, shard_range: one range of shard_ranges.
+    on_error(line) is called for JSONL lines that are not valid JSON, they raise when it is None.
+    """
+    if is_parquet(file_name):
+        tuple_key = parquet_metadata(file_name).get('tuples')
+        columns = ['ID', 'Text'] + (TUPLE_FIELDS if tuple_key is not None else [])
+        for row in iter_parquet_rows(file_name, columns, shard_range):
+            yield row_to_review(row, tuple_key)
+        return
+
+    if shard_range is None:
+        source = lines = open_text(file_name)
+    elif compression(file_name) is not None:
+        # the lines before the range are only decompressed, not parsed
+        source = open_text(file_name)
+        lines = itertools.islice(source, *shard_range)
+    else:
+        source = lines = Utils.read_lines_in_range(file_name, *shard_range)
+    try:
+        for line in lines:
+            if not line.strip():
+                continue
+            try:
+                data = json.loads(line)
+            except json.JSONDecodeError:
+                if on_error is None:
+                    raise
+                on_error(line)
+                continue
+            yield data
+    finally:
+        source.close()
+
+
+def has_tokens(file_name, bert_model_type):
+    """True for a Parquet file whose token columns were written with the tokenizer of bert_model_type."""
+    if not is_parquet(file_name):
+        return False
+    tokenizer = parquet_metadata(file_name).get('tokenizer')
+    return tokenizer is not None and tokenizer == tokenizer_fingerprint(bert_model_type)
+
+
+def iter_tokens(file_name, shard_range=None):
+    """(token ids, [(start, end), ...] offsets) of the lower-cased Text per row, see has_tokens."""
+    for row in iter_parquet_rows(file_name, ['token_ids', 'offsets'], shard_range):
+        offsets = row['offsets']
+        yield row['token_ids'], list(zip(offsets[0::2], offsets[1::2]))
+
+
+def read_va_columns(file_name):
+    """Valence and arousal of every tuple with both values of a Parquet file, read from the float columns only."""
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+
+    table = pq.read_table(file_name, columns=['Valence', 'Arousal'])
+    valence = pc.list_flatten(table['Valence'])
+    arousal = pc.list_flatten(table['Arousal'])
+    keep = pc.and_(pc.is_valid(valence), pc.is_valid(arousal))
+    return pc.filter(valence, keep).to_pylist(), pc.filter(arousal, keep).to_pylist()
+
+
+def parse_va(va):
+    """VA string "7.80#5.00" → (7.8, 5.0), a missing part is None."""
+    parts = va.split('#') if va else []
+    try:
+        valence = float(parts[0]) if len(parts) > 0 else None
+        arousal = float(parts[1]) if len(parts) > 1 else None
+    except ValueError:
+        return None, None
+    return valence, arousal
+
+
+def convert(input_file, output_file, bert_model_type=None, row_group_size=10000):
+    """JSONL (or .jsonl.gz / .jsonl.zst) → Parquet, row_group_size reviews are kept in memory at a time. Returns the number of reviews."""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    reviews = iter_reviews(input_file)
+    first = next(reviews, None)
+    tuple_key = None
+    if first is not None:
+        tuple_key = 'Quadruplet' if 'Quadruplet' in first else 'Triplet' if 'Triplet' in first else None
+
+    tokenizer = Utils.load_tokenizer(bert_model_type) if bert_model_type else None
+    fields = [('ID', pa.string()), ('Text', pa.string())]
+    if tuple_key is not None:
+        fields += [(name, pa.list_(pa.string())) for name in TUPLE_FIELDS]
+        fields += [('Valence', pa.list_(pa.float64())), ('Arousal', pa.list_(pa.float64()))]
+    if tokenizer is not None:
+        fields += [('token_ids', pa.list_(pa.int32())), ('offsets', pa.list_(pa.int32()))]
+    metadata = {'format': PARQUET_FORMAT, 'tuples': tuple_key,
+                'tokenizer': tokenizer_fingerprint(bert_model_type) if tokenizer is not None else None}
+    schema = pa.schema(fields, metadata={METADATA_KEY: json.dumps(metadata)})
+
+    def new_columns():
+        return {name: [] for name, _ in fields}
+
+    count = 0
+    columns = new_columns()
+    with pq.ParquetWriter(output_file, schema) as writer:
+        for data in itertools.chain([first] if first is not None else [], reviews):
+            columns['ID'].append(data['ID'])
+            columns['Text'].append(data['Text'])
+            if tuple_key is not None:
+                tuples = data.get(tuple_key, [])
+                for name in TUPLE_FIELDS:
+                    columns[name].append([item.get(name) for item in tuples])
+                values = [parse_va(item.get('VA')) for item in tuples]
+                columns['Valence'].append([valence for valence, _ in values])
+                columns['Arousal'].append([arousal for _, arousal in values])
+            if tokenizer is not None:
+                # 和 load_inference_data 一樣: 小寫後 tokenize, offsets 攤平成 [start0, end0, start1, end1, ...]
+                token_ids, offsets = tokenizer.encode(data['Text'].lower())
+                columns['token_ids'].append(token_ids)
+                columns['offsets'].append([offset for span in offsets for offset in span])
+            count += 1
+            if count % row_group_size == 0:
+                writer.write_table(pa.table(columns, schema=schema))
+                columns = new_columns()
+        if columns['ID']:
+            writer.write_table(pa.table(columns, schema=schema))
+    return count
+
+
+def parser_getting():
+    parser = argparse.ArgumentParser(description='Convert a JSONL review file to Parquet')
+    parser.add_argument('--input', type=str, required=True, help="JSONL file (.jsonl / .jsonl.gz / .jsonl.zst)")
+    parser.add_argument('--output', type=str, default=None, help="Parquet file, default the input with .parquet")
+    parser.add_argument('--bert_model_type', type=str, default=None,
+                        help="also store the token ids / offsets of this tokenizer (used by --mode inference)")
+    parser.add_argument('--row_group_size', type=int, default=10000,
+                        help="reviews per row group, also the unit of the --num_workers shards")
+
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == '__main__':
+    args = parser_getting()
+    input_name = args.input[:-len(compression(args.input)) - 1] if compression(args.input) else args.input
+    output = args.output or os.path.splitext(input_name)[0] + '.parquet'
+    count = convert(args.input, output, args.bert_model_type, args.row_group_size)
+    print('{} reviews written to {}'.format(count, output))
@@ -1,11 +1,22 @@
+import hashlib
+import multiprocessing
 import random
 import re
+from array import array
 import Utils as Data
-from transformers import AutoTokenizer
+from Categories import category_map, lap_filter_from_category, lap_filter_to_category
 
 
 dataset_type_list = ["train", "dev"]
 
+# --streaming: tokenized aspect / opinion phrases kept per process, the table is cleared when it grows beyond this
+phrase_cache_size = 100000
+
+# Query fields kept as array('i') by compact_query
+query_int_fields = ['forward_asp_query', 'forward_asp_query_mask', 'forward_asp_query_seg', 'forward_asp_answer_start',
+                    'forward_asp_answer_end', 'backward_opi_query', 'backward_opi_query_mask', 'backward_opi_query_seg',
+                    'backward_opi_answer_start', 'backward_opi_answer_end']
+
 triplet_pattern = re.compile(r'[(](.*?)[)]', re.S)  # 匹配圆括号 () 中的内容
 aspect_and_opinion_pattern = re.compile(r'[\[](.*?)[]]', re.S)  # 匹配方括号 [] 中的内容
 category_pattern = re.compile(r"['](.*?)[']", re.S)
@@ -225,7 +236,14 @@ def ids_to_tokens(input_ids_list, tokenizer):
 # tokens to ids
 def tokens_to_ids(QA_list, tokenizer):
     max_len = 0
+    template_ids = {}
     for QA in QA_list:
+        if isinstance(QA, Data.CompactQueryAndAnswer):
+            compact_tokens_to_ids(QA, tokenizer, template_ids)
+            if compact_query_len(QA) > max_len:
+                max_len = compact_query_len(QA)
+            continue
+
         QA.forward_asp_query = tokenizer.convert_tokens_to_ids(QA.forward_asp_query)
         if len(QA.forward_asp_query) > max_len:
             max_len = len(QA.forward_asp_query)
@@ -262,6 +280,35 @@ def tokens_to_ids(QA_list, tokenizer):
     return QA_list, max_len
 
 
+def compact_tokens_to_ids(QA, tokenizer, template_ids):
+    # 同一種語言的模板只轉一次, 所有 review 共用同一份 id
+    key = tuple(tuple(template) for template in QA.templates)
+    if key not in template_ids:
+        template_ids[key] = tuple(tokenizer.convert_tokens_to_ids(template) for template in QA.templates)
+    QA.templates = template_ids[key]
+    QA.word_list = array('i', tokenizer.convert_tokens_to_ids(QA.word_list))
+    QA.sep = tokenizer.convert_tokens_to_ids(QA.sep)
+    QA.pad = tokenizer.convert_tokens_to_ids(QA.pad)
+    return QA
+
+
+def compact_query_len(QA):
+    """Length of the longest query build_QA makes for a CompactQueryAndAnswer, without building it."""
+    (forward_aspect_query_template, forward_opinion_query_template, backward_opinion_query_template,
+     backward_aspect_query_template, category_query_template, valence_query_template,
+     arousal_query_template) = QA.templates
+    lengths = [len(forward_aspect_query_template), len(backward_opinion_query_template)]
+    for asp, opi in zip(QA.aspect_list, QA.opinion_list):
+        asp_len = asp[1] - asp[0] + 1
+        opi_len = opi[1] - opi[0] + 1
+        lengths += [len(forward_opinion_query_template) + asp_len, len(backward_aspect_query_template) + opi_len,
+                    len(valence_query_template) + asp_len + opi_len, len(arousal_query_template) + asp_len + opi_len]
+        if QA.task == 3 and QA.category_list[0] is not None:
+            lengths.append(len(category_query_template) + asp_len + opi_len)
+    # + sentence + [SEP]
+    return max(lengths) + len(QA.word_list) + 1
+
+
 def list_to_object(dataset_object):
     line = []
     forward_asp_query = []
@@ -381,123 +428,164 @@ def dataset_align(dataset_object, max_tokens_len, max_aspect_num, tokenizer):
     for dataset_type in dataset_type_list:
         tokenized_QA_list = dataset_object[dataset_type]
         for tokenized_QA in tokenized_QA_list:
-
-            tokenized_QA.forward_asp_query.extend([0] * (max_tokens_len - len(tokenized_QA.forward_asp_query)))
-            tokenized_QA.forward_asp_query_mask.extend(
-                [0] * (max_tokens_len - len(tokenized_QA.forward_asp_query_mask)))
-            tokenized_QA.forward_asp_query_seg.extend(
-                [1] * (max_tokens_len - len(tokenized_QA.forward_asp_query_seg)))
-
-            tokenized_QA.forward_asp_answer_start.extend(
-                [-1] * (max_tokens_len - len(tokenized_QA.forward_asp_answer_start)))
-            tokenized_QA.forward_asp_answer_end.extend(
-                [-1] * (max_tokens_len - len(tokenized_QA.forward_asp_answer_end)))
-
-            for i in range(len(tokenized_QA.forward_opi_query)):
-                tokenized_QA.forward_opi_query[i].extend(
-                    [0] * (max_tokens_len - len(tokenized_QA.forward_opi_query[i])))
-                tokenized_QA.forward_opi_answer_start[i].extend(
-                    [-1] * (max_tokens_len - len(tokenized_QA.forward_opi_answer_start[i])))
-                tokenized_QA.forward_opi_answer_end[i].extend(
-                    [-1] * (max_tokens_len - len(tokenized_QA.forward_opi_answer_end[i])))
-
-                tokenized_QA.forward_opi_query_mask[i].extend(
-                    [0] * (max_tokens_len - len(tokenized_QA.forward_opi_query_mask[i])))
-                tokenized_QA.forward_opi_query_seg[i].extend(
-                    [1] * (max_tokens_len - len(tokenized_QA.forward_opi_query_seg[i])))
-
-            tokenized_QA.backward_opi_query.extend([0] * (max_tokens_len - len(tokenized_QA.backward_opi_query)))
-
-            tokenized_QA.backward_opi_query_mask.extend(
-                [0] * (max_tokens_len - len(tokenized_QA.backward_opi_query_mask)))
-            tokenized_QA.backward_opi_query_seg.extend(
-                [1] * (max_tokens_len - len(tokenized_QA.backward_opi_query_seg)))
-
-            tokenized_QA.backward_opi_answer_start.extend(
-                [-1] * (max_tokens_len - len(tokenized_QA.backward_opi_answer_start)))
-            tokenized_QA.backward_opi_answer_end.extend(
-                [-1] * (max_tokens_len - len(tokenized_QA.backward_opi_answer_end)))
-
-            for i in range(len(tokenized_QA.backward_asp_query)):
-                tokenized_QA.backward_asp_query[i].extend(
-                    [0] * (max_tokens_len - len(tokenized_QA.backward_asp_query[i])))
-                tokenized_QA.backward_asp_answer_start[i].extend(
-                    [-1] * (max_tokens_len - len(tokenized_QA.backward_asp_answer_start[i])))
-                tokenized_QA.backward_asp_answer_end[i].extend(
-                    [-1] * (max_tokens_len - len(tokenized_QA.backward_asp_answer_end[i])))
-
-                tokenized_QA.backward_asp_query_mask[i].extend(
-                    [0] * (max_tokens_len - len(tokenized_QA.backward_asp_query_mask[i])))
-                tokenized_QA.backward_asp_query_seg[i].extend(
-                    [1] * (max_tokens_len - len(tokenized_QA.backward_asp_query_seg[i])))
-
-            for i in range(len(tokenized_QA.category_query)):
-                if tokenized_QA.category_query[i] is not None:
-                    tokenized_QA.category_query[i].extend([0] * (max_tokens_len - len(tokenized_QA.category_query[i])))
-
-                    tokenized_QA.category_query_mask[i].extend(
-                        [0] * (max_tokens_len - len(tokenized_QA.category_query_mask[i])))
-                    tokenized_QA.category_query_seg[i].extend(
-                        [1] * (max_tokens_len - len(tokenized_QA.category_query_seg[i])))
-
-            for i in range(len(tokenized_QA.valence_query)):
-                tokenized_QA.valence_query[i].extend([0] * (max_tokens_len - len(tokenized_QA.valence_query[i])))
-                tokenized_QA.valence_query_mask[i].extend(
-                    [0] * (max_tokens_len - len(tokenized_QA.valence_query_mask[i])))
-                tokenized_QA.valence_query_seg[i].extend(
-                    [1] * (max_tokens_len - len(tokenized_QA.valence_query_seg[i])))
-
-            for i in range(len(tokenized_QA.arousal_query)):
-                tokenized_QA.arousal_query[i].extend([0] * (max_tokens_len - len(tokenized_QA.arousal_query[i])))
-                tokenized_QA.arousal_query_mask[i].extend(
-                    [0] * (max_tokens_len - len(tokenized_QA.arousal_query_mask[i])))
-                tokenized_QA.arousal_query_seg[i].extend(
-                    [1] * (max_tokens_len - len(tokenized_QA.arousal_query_seg[i])))
-
-            for i in range(max_aspect_num - len(tokenized_QA.forward_opi_query)):
-                tokenized_QA.forward_opi_query.insert(-1, tokenized_QA.forward_opi_query[0])
-                tokenized_QA.forward_opi_query_mask.insert(-1, tokenized_QA.forward_opi_query_mask[0])
-                tokenized_QA.forward_opi_query_seg.insert(-1, tokenized_QA.forward_opi_query_seg[0])
-
-                tokenized_QA.forward_opi_answer_start.insert(-1, tokenized_QA.forward_opi_answer_start[0])
-                tokenized_QA.forward_opi_answer_end.insert(-1, tokenized_QA.forward_opi_answer_end[0])
-
-                tokenized_QA.backward_asp_query.insert(-1, tokenized_QA.backward_asp_query[0])
-                tokenized_QA.backward_asp_query_mask.insert(-1, tokenized_QA.backward_asp_query_mask[0])
-                tokenized_QA.backward_asp_query_seg.insert(-1, tokenized_QA.backward_asp_query_seg[0])
-
-                tokenized_QA.backward_asp_answer_start.insert(-1, tokenized_QA.backward_asp_answer_start[0])
-                tokenized_QA.backward_asp_answer_end.insert(-1, tokenized_QA.backward_asp_answer_end[0])
-
-                tokenized_QA.category_query.insert(-1, tokenized_QA.category_query[0])
-                tokenized_QA.category_query_mask.insert(-1, tokenized_QA.category_query_mask[0])
-                tokenized_QA.category_query_seg.insert(-1, tokenized_QA.category_query_seg[0])
-                tokenized_QA.category_answer.insert(-1, tokenized_QA.category_answer[0])
-
-                tokenized_QA.valence_query.insert(-1, tokenized_QA.valence_query[0])
-                tokenized_QA.valence_query_mask.insert(-1, tokenized_QA.valence_query_mask[0])
-                tokenized_QA.valence_query_seg.insert(-1, tokenized_QA.valence_query_seg[0])
-                tokenized_QA.valence_answer.insert(-1, tokenized_QA.valence_answer[0])
-
-                tokenized_QA.arousal_query.insert(-1, tokenized_QA.arousal_query[0])
-                tokenized_QA.arousal_query_mask.insert(-1, tokenized_QA.arousal_query_mask[0])
-                tokenized_QA.arousal_query_seg.insert(-1, tokenized_QA.arousal_query_seg[0])
-                tokenized_QA.arousal_answer.insert(-1, tokenized_QA.arousal_answer[0])
-
-            valid(tokenized_QA)
+            if isinstance(tokenized_QA, Data.CompactQueryAndAnswer):
+                # padded when the queries are built (expand_QA)
+                tokenized_QA.max_tokens_len = max_tokens_len
+                tokenized_QA.max_aspect_num = max_aspect_num
+                continue
+            align_QA(tokenized_QA, max_tokens_len, max_aspect_num)
             if random.random() == 0.999:
                 print_QA(tokenized_QA, tokenizer)
     return dataset_object
 
 
+def align_QA(tokenized_QA, max_tokens_len, max_aspect_num):
+    """Pads every query to max_tokens_len and the pair queries to max_aspect_num pairs."""
+    tokenized_QA.forward_asp_query.extend([0] * (max_tokens_len - len(tokenized_QA.forward_asp_query)))
+    tokenized_QA.forward_asp_query_mask.extend(
+        [0] * (max_tokens_len - len(tokenized_QA.forward_asp_query_mask)))
+    tokenized_QA.forward_asp_query_seg.extend(
+        [1] * (max_tokens_len - len(tokenized_QA.forward_asp_query_seg)))
+
+    tokenized_QA.forward_asp_answer_start.extend(
+        [-1] * (max_tokens_len - len(tokenized_QA.forward_asp_answer_start)))
+    tokenized_QA.forward_asp_answer_end.extend(
+        [-1] * (max_tokens_len - len(tokenized_QA.forward_asp_answer_end)))
+
+    for i in range(len(tokenized_QA.forward_opi_query)):
+        tokenized_QA.forward_opi_query[i].extend(
+            [0] * (max_tokens_len - len(tokenized_QA.forward_opi_query[i])))
+        tokenized_QA.forward_opi_answer_start[i].extend(
+            [-1] * (max_tokens_len - len(tokenized_QA.forward_opi_answer_start[i])))
+        tokenized_QA.forward_opi_answer_end[i].extend(
+            [-1] * (max_tokens_len - len(tokenized_QA.forward_opi_answer_end[i])))
+
+        tokenized_QA.forward_opi_query_mask[i].extend(
+            [0] * (max_tokens_len - len(tokenized_QA.forward_opi_query_mask[i])))
+        tokenized_QA.forward_opi_query_seg[i].extend(
+            [1] * (max_tokens_len - len(tokenized_QA.forward_opi_query_seg[i])))
+
+    tokenized_QA.backward_opi_query.extend([0] * (max_tokens_len - len(tokenized_QA.backward_opi_query)))
+
+    tokenized_QA.backward_opi_query_mask.extend(
+        [0] * (max_tokens_len - len(tokenized_QA.backward_opi_query_mask)))
+    tokenized_QA.backward_opi_query_seg.extend(
+        [1] * (max_tokens_len - len(tokenized_QA.backward_opi_query_seg)))
+
+    tokenized_QA.backward_opi_answer_start.extend(
+        [-1] * (max_tokens_len - len(tokenized_QA.backward_opi_answer_start)))
+    tokenized_QA.backward_opi_answer_end.extend(
+        [-1] * (max_tokens_len - len(tokenized_QA.backward_opi_answer_end)))
+
+    for i in range(len(tokenized_QA.backward_asp_query)):
+        tokenized_QA.backward_asp_query[i].extend(
+            [0] * (max_tokens_len - len(tokenized_QA.backward_asp_query[i])))
+        tokenized_QA.backward_asp_answer_start[i].extend(
+            [-1] * (max_tokens_len - len(tokenized_QA.backward_asp_answer_start[i])))
+        tokenized_QA.backward_asp_answer_end[i].extend(
+            [-1] * (max_tokens_len - len(tokenized_QA.backward_asp_answer_end[i])))
+
+        tokenized_QA.backward_asp_query_mask[i].extend(
+            [0] * (max_tokens_len - len(tokenized_QA.backward_asp_query_mask[i])))
+        tokenized_QA.backward_asp_query_seg[i].extend(
+            [1] * (max_tokens_len - len(tokenized_QA.backward_asp_query_seg[i])))
+
+    for i in range(len(tokenized_QA.category_query)):
+        if tokenized_QA.category_query[i] is not None:
+            tokenized_QA.category_query[i].extend([0] * (max_tokens_len - len(tokenized_QA.category_query[i])))
+
+            tokenized_QA.category_query_mask[i].extend(
+                [0] * (max_tokens_len - len(tokenized_QA.category_query_mask[i])))
+            tokenized_QA.category_query_seg[i].extend(
+                [1] * (max_tokens_len - len(tokenized_QA.category_query_seg[i])))
+
+    for i in range(len(tokenized_QA.valence_query)):
+        tokenized_QA.valence_query[i].extend([0] * (max_tokens_len - len(tokenized_QA.valence_query[i])))
+        tokenized_QA.valence_query_mask[i].extend(
+            [0] * (max_tokens_len - len(tokenized_QA.valence_query_mask[i])))
+        tokenized_QA.valence_query_seg[i].extend(
+            [1] * (max_tokens_len - len(tokenized_QA.valence_query_seg[i])))
+
+    for i in range(len(tokenized_QA.arousal_query)):
+        tokenized_QA.arousal_query[i].extend([0] * (max_tokens_len - len(tokenized_QA.arousal_query[i])))
+        tokenized_QA.arousal_query_mask[i].extend(
+            [0] * (max_tokens_len - len(tokenized_QA.arousal_query_mask[i])))
+        tokenized_QA.arousal_query_seg[i].extend(
+            [1] * (max_tokens_len - len(tokenized_QA.arousal_query_seg[i])))
+
+    for i in range(max_aspect_num - len(tokenized_QA.forward_opi_query)):
+        tokenized_QA.forward_opi_query.insert(-1, tokenized_QA.forward_opi_query[0])
+        tokenized_QA.forward_opi_query_mask.insert(-1, tokenized_QA.forward_opi_query_mask[0])
+        tokenized_QA.forward_opi_query_seg.insert(-1, tokenized_QA.forward_opi_query_seg[0])
+
+        tokenized_QA.forward_opi_answer_start.insert(-1, tokenized_QA.forward_opi_answer_start[0])
+        tokenized_QA.forward_opi_answer_end.insert(-1, tokenized_QA.forward_opi_answer_end[0])
+
+        tokenized_QA.backward_asp_query.insert(-1, tokenized_QA.backward_asp_query[0])
+        tokenized_QA.backward_asp_query_mask.insert(-1, tokenized_QA.backward_asp_query_mask[0])
+        tokenized_QA.backward_asp_query_seg.insert(-1, tokenized_QA.backward_asp_query_seg[0])
+
+        tokenized_QA.backward_asp_answer_start.insert(-1, tokenized_QA.backward_asp_answer_start[0])
+        tokenized_QA.backward_asp_answer_end.insert(-1, tokenized_QA.backward_asp_answer_end[0])
+
+        tokenized_QA.category_query.insert(-1, tokenized_QA.category_query[0])
+        tokenized_QA.category_query_mask.insert(-1, tokenized_QA.category_query_mask[0])
+        tokenized_QA.category_query_seg.insert(-1, tokenized_QA.category_query_seg[0])
+        tokenized_QA.category_answer.insert(-1, tokenized_QA.category_answer[0])
+
+        tokenized_QA.valence_query.insert(-1, tokenized_QA.valence_query[0])
+        tokenized_QA.valence_query_mask.insert(-1, tokenized_QA.valence_query_mask[0])
+        tokenized_QA.valence_query_seg.insert(-1, tokenized_QA.valence_query_seg[0])
+        tokenized_QA.valence_answer.insert(-1, tokenized_QA.valence_answer[0])
+
+        tokenized_QA.arousal_query.insert(-1, tokenized_QA.arousal_query[0])
+        tokenized_QA.arousal_query_mask.insert(-1, tokenized_QA.arousal_query_mask[0])
+        tokenized_QA.arousal_query_seg.insert(-1, tokenized_QA.arousal_query_seg[0])
+        tokenized_QA.arousal_answer.insert(-1, tokenized_QA.arousal_answer[0])
+
+    valid(tokenized_QA)
+    return tokenized_QA
+
+
 def get_start_end(str_list):
     index_list = [int(s) for s in str_list]
     return [index_list[0] + 1, index_list[-1] + 1]
 
 
 def make_QA(args, line, word_list, aspect_list, opinion_list, category_list, valence_list, arousal_list):
-
     # 🔹 1. 新增這一段：依語言拿對應的 query 模板
+    return build_QA(args.task, get_query_templates(getattr(args, "language", "eng")), line, word_list,
+                    aspect_list, opinion_list, category_list, valence_list, arousal_list)
+
+
+def make_compact_QA(args, line, word_list, aspect_list, opinion_list, category_list, valence_list, arousal_list):
+    return Data.CompactQueryAndAnswer(line=line,
+                                      task=args.task,
+                                      templates=get_query_templates(getattr(args, "language", "eng")),
+                                      word_list=word_list,
+                                      sep="[SEP]",
+                                      pad="[PAD]",
+                                      aspect_list=aspect_list,
+                                      opinion_list=opinion_list,
+                                      category_list=category_list,
+                                      valence_list=valence_list,
+                                      arousal_list=arousal_list)
+
+
+def expand_QA(QA):
+    """CompactQueryAndAnswer → the padded QueryAndAnswer of make_QA + tokens_to_ids + dataset_align."""
+    # build_QA / align_QA 會改動傳進去的 list, 所以都複製一份
+    tokenized_QA = build_QA(QA.task, QA.templates, QA.line, list(QA.word_list), QA.aspect_list, QA.opinion_list,
+                            list(QA.category_list), list(QA.valence_list), list(QA.arousal_list), QA.sep, QA.pad)
+    return align_QA(tokenized_QA, QA.max_tokens_len, QA.max_aspect_num)
+
+
+def build_QA(task, templates, line, word_list, aspect_list, opinion_list, category_list, valence_list, arousal_list,
+             sep="[SEP]", pad="[PAD]"):
+    """
+    All queries of one review. Works on tokens (templates / word_list / sep / pad as strings) as well as on token
+    ids, expand_QA uses the latter to rebuild the queries of a CompactQueryAndAnswer at batch time.
+    """
     (
         forward_aspect_query_template,
         forward_opinion_query_template,
@@ -506,9 +594,9 @@ def make_QA(args, line, word_list, aspect_list, opinion_list, category_list, val
         category_query_template,
         valence_query_template,
         arousal_query_template,
-    ) = get_query_templates(getattr(args, "language", "eng"))
+    ) = templates
 
-    word_list.append("[SEP]")
+    word_list.append(sep)
     forward_asp_query = forward_aspect_query_template + word_list
     forward_asp_query_mask = [1] * len(forward_asp_query)
     forward_asp_query_seg = [0] * len(forward_aspect_query_template) + [1] * len(word_list)
@@ -554,10 +642,10 @@ def make_QA(args, line, word_list, aspect_list, opinion_list, category_list, val
 
     for i in range(len(aspect_list)):
         for aspect_index in range(aspect_list[i][0], aspect_list[i][1] + 1):
-            category_word_list[aspect_index] = "[PAD]"
+            category_word_list[aspect_index] = pad
             category_query_mask_init[aspect_index] = 0
         for opinion_index in range(opinion_list[i][0], opinion_list[i][1] + 1):
-            category_word_list[opinion_index] = "[PAD]"
+            category_word_list[opinion_index] = pad
             category_query_mask_init[opinion_index] = 0
 
     for i in range(len(aspect_list)):
@@ -603,7 +691,7 @@ def make_QA(args, line, word_list, aspect_list, opinion_list, category_list, val
         backward_asp_answer_end.append(asp_answer_end_temp)
 
         # for generating category queries, if task_3 anc category is not None, it is None.
-        if args.task != 3 or category_list[0] is None:
+        if task != 3 or category_list[0] is None:
             category_query.append(None)
             category_query_mask.append(None)
             category_query_mask_init.append(None)
@@ -697,7 +785,13 @@ def make_QA(args, line, word_list, aspect_list, opinion_list, category_list, val
                                )
 
 
-def make_inference_QA(args, text_id, line, word_list):
+def query_template_ids(tokenizer, language):
+    """get_query_templates as token ids, looked up once and shared by every query."""
+    return tuple(tokenizer.convert_tokens_to_ids(template) for template in get_query_templates(language))
+
+
+def make_inference_QA(args, text_id, line, word_list, templates=None, offsets=None):
+    """word_list: tokens, or token ids together with the templates as ids (query_template_ids)."""
     (
         forward_aspect_query_template,
         forward_opinion_query_template,
@@ -706,7 +800,7 @@ def make_inference_QA(args, text_id, line, word_list):
         category_query_template,
         valence_query_template,
         arousal_query_template,
-    ) = get_query_templates(getattr(args, "language", "eng"))
+    ) = templates if templates is not None else get_query_templates(getattr(args, "language", "eng"))
 
 
     # word_list.append("[SEP]")
@@ -735,35 +829,125 @@ def make_inference_QA(args, text_id, line, word_list):
                       backward_opi_query_seg=backward_opi_query_seg,
                       backward_opi_answer_start=backward_opi_answer_start,
                       backward_opi_answer_end=backward_opi_answer_end,
+                      offsets=offsets,
                       )
 
 
-def line_data_process(args, line, category_mapping, isQA=True):
+def token_positions(words):
+    """token → positions in the review, only the positions of a phrase's first token are compared."""
+    positions = {}
+    for i, word in enumerate(words):
+        positions.setdefault(word, []).append(i)
+    return positions
+
+
+def find_word_indices(words, positions, phrase_words):
+    """(start, end) token indices of the first occurrence of phrase_words in words, (-1, -1) when it is missing."""
+    # first occurrence, same result as scanning every start position
+    length = len(phrase_words)
+    for i in positions.get(phrase_words[0], []):
+        if i + length > len(words):
+            break
+        if words[i:i + length] == phrase_words:
+            return i, i + length - 1
+    return -1, -1
+
+
+def review_to_record(args, data, tokenizer, phrase_tokens):
+    """
+    One {"ID", "Text", "Quadruplet"} review of the training JSONL → the record of line_to_record.
+    phrase_tokens: aspect / opinion phrase → tokens, shared between the reviews so every phrase is tokenized once.
+    """
+    category_dict, category_list = category_map[args.domain]
+
+    def span(phrase):
+        if phrase == "NULL" or not phrase:
+            return -1, -1
+        if phrase not in phrase_tokens:
+            phrase_tokens[phrase] = tokenizer.tokenize(phrase)
+        if not phrase_tokens[phrase]:
+            return 0, -1
+        return find_word_indices(words, positions, phrase_tokens[phrase])
+
+    # 每則 review 只 tokenize 一次
+    words = tokenizer.tokenize(data['Text'])[:256]
+    positions = token_positions(words)
+    quintuplets = []
+    for quad in data['Quadruplet']:
+        if 'Category' in quad and args.task == 3:
+            category = quad['Category'].upper()
+            if args.domain in ['lap']:
+                replacement_dict = dict(zip(lap_filter_from_category, lap_filter_to_category))
+                category = Data.replace_using_dict(category, replacement_dict)
+            assert category in category_list, print(f"Wrong category type {category} in dataset, need filter.")
+        else:
+            category = None
+
+        a_start, a_end = span(quad['Aspect'].lower())
+        o_start, o_end = span(quad['Opinion'].lower())
+
+        va_parts = quad['VA'].split('#')
+        valence = float(va_parts[0])
+        arousal = float(va_parts[1]) if len(va_parts) > 1 else 0.0
+
+        quintuplets.append((
+            [a_start, a_end],
+            [o_start, o_end],
+            category_dict[category] if category is not None else None,
+            valence,
+            arousal
+        ))
+    return {'line': " ".join(words), 'words': words, 'quintuplets': quintuplets}
+
+
+def line_to_record(args, line, category_mapping):
+    """
+    "text####[(...)]" line → the structured record load_train_data_multilingual builds directly:
+    {'line': text, 'words': tokens, 'quintuplets': [([a_start, a_end], [o_start, o_end], category_id, valence, arousal)]}
+    """
     # Line sample:
     # judging from previous posts this used to be a good place , but not any longer .####[([10, 10], [13, 15], 'RESTAURANT#GENERAL', '3.62', '5.88')]
     split = line.split("####")
     assert len(split) == 2
 
+    triplet_str_list = re.findall(triplet_pattern, split[1])
+    quintuplets = []
+    for triplet in triplet_str_list:
+        aspect, opinion = re.findall(aspect_and_opinion_pattern, triplet)[:2]
+        category = category_mapping[re.findall(category_pattern, triplet)[0]] if args.task == 3 else None
+        quintuplets.append((
+            [int(index) for index in aspect.split(', ')],
+            [int(index) for index in opinion.split(', ')],
+            category,
+            eval(triplet.split(',')[-2].strip().strip('"').strip("'")),
+            eval(triplet.split(',')[-1].strip().strip('"').strip("'")),
+        ))
+    return {'line': line, 'words': split[0].split(), 'quintuplets': quintuplets}
+
+
+def line_data_process(args, line, category_mapping, isQA=True):
+    """line: a "text####[(...)]" string or a structured record (see line_to_record)."""
+    record = line_to_record(args, line, category_mapping) if isinstance(line, str) else line
+    line = record['line']
+    quintuplets = record['quintuplets']
+
     max_aspect_num = 0
     max_len = 0
-    word_list = split[0].split()
-    word_list.insert(0, "null")
+    word_list = ["null"] + record['words']
 
-    triplet_str_list = re.findall(triplet_pattern, split[1])
-    aspect_list = [re.findall(aspect_and_opinion_pattern, triplet)[0] for triplet in triplet_str_list]
-    aspect_list = [get_start_end(aspect.split(', ')) for aspect in aspect_list]
+    # +1: "null" 佔了第 0 個位置
+    aspect_list = [get_start_end(quintuplet[0]) for quintuplet in quintuplets]
     if len(aspect_list) > max_aspect_num:
         max_aspect_num = len(aspect_list)
-    opinion_list = [re.findall(aspect_and_opinion_pattern, triplet)[1] for triplet in triplet_str_list]
-    opinion_list = [get_start_end(opinion.split(', ')) for opinion in opinion_list]
+    opinion_list = [get_start_end(quintuplet[1]) for quintuplet in quintuplets]
 
     if args.task != 3:
-        category_list = [None for _ in triplet_str_list]
+        category_list = [None for _ in quintuplets]
     else:
-        category_list = [category_mapping[re.findall(category_pattern, triplet)[0]] for triplet in triplet_str_list]
+        category_list = [quintuplet[2] for quintuplet in quintuplets]
 
-    valence_list = [eval(triplet.split(',')[-2].strip().strip('"').strip("'")) for triplet in triplet_str_list]
-    arousal_list = [eval(triplet.split(',')[-1].strip().strip('"').strip("'")) for triplet in triplet_str_list]
+    valence_list = [quintuplet[3] for quintuplet in quintuplets]
+    arousal_list = [quintuplet[4] for quintuplet in quintuplets]
 
     assert len(aspect_list) > 0 and len(opinion_list) > 0 and len(valence_list) > 0 and len(arousal_list) > 0
     assert len(aspect_list) == len(opinion_list) == len(category_list) == len(valence_list) == len(aspect_list)
@@ -774,8 +958,9 @@ def line_data_process(args, line, category_mapping, isQA=True):
         if (opinion_list[i][1] - opinion_list[i][0] + 1) > max_len:
             max_len = opinion_list[i][1] - opinion_list[i][0] + 1
     if isQA:
-        return make_QA(args, line, word_list, aspect_list, opinion_list, category_list, valence_list,
-                       arousal_list), max_aspect_num, max_len
+        # 只存句子和 pair, 每個 pair 的 query 在組 batch 時才由 expand_QA 產生
+        return make_compact_QA(args, line, word_list, aspect_list, opinion_list, category_list, valence_list,
+                               arousal_list), max_aspect_num, max_len
     else:
         return line, aspect_list, opinion_list, category_list, valence_list, arousal_list
 
@@ -809,7 +994,8 @@ def train_data_process(args, text, category_mapping):
     return QA_list, max_aspect_num, max_len
 
 
-def inference_data_process(args, text):
+def inference_data_process(args, text, tokenizer):
+    """text: (ID, review, token ids, character offsets) of load_inference_data."""
     QA_list = []
     TEXT_list = []
     ID_list = []
@@ -817,10 +1003,14 @@ def inference_data_process(args, text):
     # 🔍 DEBUG B-0
     print("[DEBUG B0] inference_data_process: input len(text) =", len(text))
 
+    # 模板只查一次 id, 句子直接用第一次 tokenize 的 id (不再 join → split → 查表)
+    template_ids = query_template_ids(tokenizer, getattr(args, "language", "eng"))
+    null_id = tokenizer.convert_tokens_to_ids("null")
     for idx, line in enumerate(text[:]):
         ID_list.append(line[0])
         TEXT_list.append(line[1])
-        QA = line_inference_data_process(args, line[0], line[1])
+        QA = make_inference_QA(args, line[0], line[1], [null_id] + list(line[2]), templates=template_ids,
+                               offsets=line[3])
         QA_list.append(QA)
 
         if idx < 3:
@@ -878,23 +1068,100 @@ def test_data_process(args, text, category_mapping):
     return test_dataset
 
 
-def dataset_process(args, datatsets, category_mapping, tokenizer):
+def split_chunks(lines, num_chunks):
+    """num_chunks contiguous slices of lines (fewer for short inputs), concatenating them gives lines back."""
+    num_chunks = max(1, min(num_chunks, len(lines)))
+    size, rest = divmod(len(lines), num_chunks)
+    chunks = []
+    start = 0
+    for i in range(num_chunks):
+        end = start + size + (1 if i < rest else 0)
+        chunks.append(lines[start:end])
+        start = end
+    return chunks
+
+
+def parallel_map(function, jobs, workers):
+    """--preprocess_workers: run the jobs on a process pool, in this process when there is one worker / job."""
+    if workers <= 1 or len(jobs) <= 1:
+        return [function(job) for job in jobs]
+    with multiprocessing.get_context('spawn').Pool(processes=min(workers, len(jobs))) as pool:
+        return pool.map(function, jobs)
+
+
+def train_chunk_process(job):
+    """One chunk of train / dev lines: QA + token ids + gold records, with the chunk maxima."""
+    args, lines, category_mapping, tokenizer = job
+    QA_list, max_aspect_num, max_len = train_data_process(args, lines, category_mapping)
+    QA_list, max_tokens_len = tokens_to_ids(QA_list, tokenizer)
+    return QA_list, max_aspect_num, max_len, max_tokens_len, test_data_process(args, lines, category_mapping)
+
+
+def compact_QA_statistics(QA):
+    """(pairs, longest aspect / opinion span, longest query) of a CompactQueryAndAnswer, as dataset_process counts them."""
+    max_len = 0
+    for span in QA.aspect_list + QA.opinion_list:
+        if span[1] - span[0] + 1 > max_len:
+            max_len = span[1] - span[0] + 1
+    return len(QA.aspect_list), max_len, compact_query_len(QA)
+
+
+def dataset_process(args, datatsets, category_mapping, tokenizer, cache=None):
+    """
+    datatsets[type]: records (line_to_record / review_to_record). With a RecordCache they may also be the
+    (QA, TestDataset) pairs it returned, records carrying a 'cache_key' (ID, content hash) are cached once built.
+    """
     train_dataset_object = {}
     test_dataset_object = {}
     max_tokens_len = 0
     max_aspect_num = 0
     max_len = 0
+
+    # lines are split into one contiguous chunk per worker, results are concatenated back in order
+    workers = getattr(args, 'preprocess_workers', 1)
+    jobs = []
+    for dataset_type in dataset_type_list:
+        records = [record for record in datatsets[dataset_type] if not isinstance(record, tuple)]
+        jobs += [(dataset_type, (args, chunk, category_mapping, tokenizer))
+                 for chunk in split_chunks(records, workers)]
+    results = parallel_map(train_chunk_process, [job for _, job in jobs], workers)
+
+    built = {}
     for dataset_type in dataset_type_list:
-        text_lines = datatsets[dataset_type]
-        QA_list, max_aspect_temp, max_len_temp = train_data_process(args, text_lines, category_mapping)
-        train_dataset_object[dataset_type], max_tokens_temp = tokens_to_ids(QA_list, tokenizer)
-        test_dataset_object[dataset_type] = test_data_process(args, text_lines, category_mapping)
+        train_dataset_object[dataset_type] = []
+        test_dataset_object[dataset_type] = []
+        built[dataset_type] = ([], [])
+    for (dataset_type, _), (QA_list, max_aspect_temp, max_len_temp, max_tokens_temp, test_list) in zip(jobs, results):
+        built[dataset_type][0].extend(QA_list)
+        built[dataset_type][1].extend(test_list)
         if max_tokens_temp > max_tokens_len:
             max_tokens_len = max_tokens_temp
         if max_aspect_temp > max_aspect_num:
             max_aspect_num = max_aspect_temp
         if max_len_temp > max_len:
             max_len = max_len_temp
+
+    for dataset_type in dataset_type_list:
+        QA_iter = iter(built[dataset_type][0])
+        test_iter = iter(built[dataset_type][1])
+        for record in datatsets[dataset_type]:
+            if isinstance(record, tuple):
+                # 快取裡的 review: 不用重新 tokenize, 統計值直接由 QA 算出來併進去
+                QA, test = record
+                max_aspect_temp, max_len_temp, max_tokens_temp = compact_QA_statistics(QA)
+                if max_tokens_temp > max_tokens_len:
+                    max_tokens_len = max_tokens_temp
+                if max_aspect_temp > max_aspect_num:
+                    max_aspect_num = max_aspect_temp
+                if max_len_temp > max_len:
+                    max_len = max_len_temp
+            else:
+                QA, test = next(QA_iter), next(test_iter)
+                if cache is not None and 'cache_key' in record:
+                    cache.put(record['cache_key'][0], record['cache_key'][1], QA, test)
+            train_dataset_object[dataset_type].append(QA)
+            test_dataset_object[dataset_type].append(test)
+
     train_dataset_object = dataset_align(train_dataset_object, max_tokens_len, max_aspect_num+1, tokenizer)
     train_dataset_object['max_tokens_len'] = max_tokens_len
     train_dataset_object['max_aspect_num'] = max_aspect_num
@@ -906,22 +1173,85 @@ def dataset_process(args, datatsets, category_mapping, tokenizer):
     return train_dataset_object, test_dataset_object
 
 
-def dataset_inference_process(args, datasets, category_mapping, tokenizer):
+def is_dev_review(review_id, dev_percent):
+    """--streaming train / dev split: a hash of the ID, the same review always lands on the same side."""
+    return int(hashlib.md5(str(review_id).encode('utf-8')).hexdigest(), 16) % 100 < dev_percent
 
 
-    # 🔍 DEBUG B-1
-    print("[DEBUG B1] dataset_inference_process: raw dataset len =", len(datasets))
+def record_to_QA(args, record, tokenizer, template_ids):
+    """review_to_record record → CompactQueryAndAnswer with token ids, its pair count, span length and query length."""
+    QA, max_aspect_num, max_len = line_data_process(args, record, category_map[args.domain][0])
+    compact_tokens_to_ids(QA, tokenizer, template_ids)
+    return QA, max_aspect_num, max_len, compact_query_len(QA)
 
-    ID_list, TEXT_list, QA_list = inference_data_process(args, datasets)
+
+def stream_shard_statistics(job):
+    """
+    --streaming: one pass over a training shard without keeping its reviews, only the dev reviews (at most
+    max_dev_reviews) are returned. Padding needs max_tokens_len / max_aspect_num of the whole corpus up front.
+    """
+    from DataIO import iter_reviews
+
+    args, path, tokenizer = job
+    phrase_tokens = {}
+    template_ids = {}
+    statistics = {'train_count': 0, 'dev_records': [], 'max_tokens_len': 0, 'max_aspect_num': 0, 'max_len': 0}
+    for data in iter_reviews(path):
+        record = review_to_record(args, data, tokenizer, phrase_tokens)
+        _, max_aspect_num, max_len, max_tokens_len = record_to_QA(args, record, tokenizer, template_ids)
+        if is_dev_review(data['ID'], args.dev_percent):
+            if len(statistics['dev_records']) < args.max_dev_reviews:
+                statistics['dev_records'].append(record)
+        else:
+            statistics['train_count'] += 1
+        statistics['max_tokens_len'] = max(statistics['max_tokens_len'], max_tokens_len)
+        statistics['max_aspect_num'] = max(statistics['max_aspect_num'], max_aspect_num)
+        statistics['max_len'] = max(statistics['max_len'], max_len)
+        if len(phrase_tokens) > phrase_cache_size:
+            phrase_tokens.clear()
+    return statistics
+
+
+def inference_chunk_process(job):
+    """One chunk of load_inference_data records → queries (token ids)."""
+    args, datasets, tokenizer = job
+    ID_list, TEXT_list, QA_list = inference_data_process(args, datasets, tokenizer)
 
     max_len = 0
     for QA in QA_list:
-        QA.forward_asp_query = tokenizer.convert_tokens_to_ids(QA.forward_asp_query)
         if len(QA.forward_asp_query) > max_len:
             max_len = len(QA.forward_asp_query)
-        QA.backward_opi_query = tokenizer.convert_tokens_to_ids(QA.backward_opi_query)
         if len(QA.backward_opi_query) > max_len:
             max_len = len(QA.backward_opi_query)
+        compact_query(QA)
+    return ID_list, TEXT_list, QA_list, max_len
+
+
+def compact_query(QA):
+    """Token id / mask / seg / answer lists of a Query as array('i'), 4 bytes per value instead of a Python int."""
+    for name in query_int_fields:
+        setattr(QA, name, array('i', getattr(QA, name)))
+    if QA.offsets is not None:
+        QA.offsets = array('i', [offset for span in QA.offsets for offset in span])
+    return QA
+
+
+def dataset_inference_process(args, datasets, category_mapping, tokenizer):
+
+
+    # 🔍 DEBUG B-1
+    print("[DEBUG B1] dataset_inference_process: raw dataset len =", len(datasets))
+
+    workers = getattr(args, 'preprocess_workers', 1)
+    results = parallel_map(inference_chunk_process,
+                           [(args, chunk, tokenizer) for chunk in split_chunks(datasets, workers)], workers)
+    ID_list, TEXT_list, QA_list = [], [], []
+    max_len = 0
+    for ID_chunk, TEXT_chunk, QA_chunk, max_len_temp in results:
+        ID_list += ID_chunk
+        TEXT_list += TEXT_chunk
+        QA_list += QA_chunk
+        max_len = max(max_len, max_len_temp)
     
     # 🔍 DEBUG B-2
     print("[DEBUG B2] inference_data_process result: len(ID_list) =", len(ID_list),
@@ -1,13 +1,24 @@
-from transformers import BertModel
+import json
+
+from transformers import BertConfig, BertModel
+import torch
 import torch.nn as nn
+from torch.nn import functional as F
+
+# --compile: query lengths are padded up to one of these, so the compiled encoder only sees a few shapes
+SEQ_BUCKETS = [32, 64, 96, 128, 192, 256, 384, 512]
 
 
 class DimABSA(nn.Module):
-    def __init__(self, hidden_size, bert_model_type, num_category):
+    def __init__(self, hidden_size, bert_model_type, num_category, pretrained=True):
 
         super(DimABSA, self).__init__()
 
-        self.bert = BertModel.from_pretrained(bert_model_type)
+        # pretrained=False: only the config is read, for models whose weights come from a checkpoint right after
+        if pretrained:
+            self.bert = BertModel.from_pretrained(bert_model_type)
+        else:
+            self.bert = BertModel(BertConfig.from_pretrained(bert_model_type))
 
         self.classifier_a_start = nn.Linear(hidden_size, 2)
         self.classifier_a_end = nn.Linear(hidden_size, 2)
@@ -23,9 +34,37 @@ class DimABSA(nn.Module):
         # self.classifier_valence = nn.Linear(hidden_size, 9)
         # self.classifier_arousal = nn.Linear(hidden_size, 9)
 
+        # filled by compile_model(), kept in plain containers so state_dict() / named_parameters() do not change
+        self.seq_buckets = None
+        self.compile_mode = None
+        self.encoder_runners = {}
+
+    def encode(self, query_tensor, query_mask, query_seg):
+        if self.seq_buckets is None:
+            return self.bert(query_tensor, attention_mask=query_mask, token_type_ids=query_seg)[0]
+
+        # pad to the bucket (mask 0), the heads only look at the first length positions
+        # fixed dtypes as well, so the compiled / traced encoder sees exactly the warm-up signature
+        query_tensor, query_mask, query_seg = query_tensor.long(), query_mask.float(), query_seg.long()
+        length = query_tensor.size(1)
+        bucket = bucket_length(length, self.seq_buckets)
+        if bucket > length:
+            query_tensor = F.pad(query_tensor, (0, bucket - length))
+            query_mask = F.pad(query_mask, (0, bucket - length))
+            query_seg = F.pad(query_seg, (0, bucket - length))
+
+        # longer than the largest bucket → eager, never compile a new shape
+        if self.compile_mode == 'compile' and length <= self.seq_buckets[-1]:
+            hidden_states = self.encoder_runners['compile'](query_tensor, query_mask, query_seg)
+        elif self.compile_mode == 'script' and not self.training and bucket in self.encoder_runners:
+            hidden_states = self.encoder_runners[bucket](query_tensor, query_mask, query_seg)
+        else:
+            hidden_states = self.bert(query_tensor, attention_mask=query_mask, token_type_ids=query_seg)[0]
+        return hidden_states[:, :length]
+
     def forward(self, query_tensor, query_mask, query_seg, step):
 
-        hidden_states = self.bert(query_tensor, attention_mask=query_mask, token_type_ids=query_seg)[0]
+        hidden_states = self.encode(query_tensor, query_mask, query_seg)
         if step == 'A':
             predict_start = self.classifier_a_start(hidden_states)
             predict_end = self.classifier_a_end(hidden_states)
@@ -58,3 +97,110 @@ class DimABSA(nn.Module):
             return arousal_scores
         else:
             raise KeyError('step error.')
+
+
+def save_weights_file(path, net, meta):
+    """Weights → safetensors file, meta (json serializable) goes into the header."""
+    from safetensors.torch import save_file
+
+    save_file({name: tensor.contiguous() for name, tensor in net.items()}, path,
+              metadata={'meta': json.dumps(meta, ensure_ascii=False)})
+
+
+def load_weights_file(path):
+    """
+    Training checkpoint (.pth) or inference artifact (.safetensors / .pth), returned in the checkpoint layout
+    {'net': state_dict, 'meta': ... or None, 'max_len': ... or None}.
+    Both are memory mapped: tensors are only read from disk when load_state_dict copies them.
+    """
+    if path.endswith('.safetensors'):
+        from safetensors import safe_open
+        from safetensors.torch import load_file
+
+        with safe_open(path, framework='pt') as f:
+            meta = json.loads(f.metadata()['meta'])
+        return {'net': load_file(path), 'meta': meta, 'max_len': meta['max_len']}
+
+    checkpoint = torch.load(path, mmap=True)
+    return {'net': checkpoint['net'], 'meta': checkpoint.get('meta'), 'max_len': checkpoint.get('max_len')}
+
+
+def quantize_dynamic_int8(model):
+    """
+    Dynamic int8 quantization (CPU only): every nn.Linear of the BERT encoder and of the classifier heads
+    gets int8 weights, activations are quantized on the fly. Returns a quantized copy, model is left as is.
+    """
+    return torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+
+
+class BertEncoder(nn.Module):
+    """BERT returning only the last hidden states, the part of DimABSA that gets compiled / traced."""
+
+    def __init__(self, bert):
+        super(BertEncoder, self).__init__()
+        self.bert = bert
+
+    def forward(self, query_tensor, query_mask, query_seg):
+        return self.bert(query_tensor, attention_mask=query_mask, token_type_ids=query_seg)[0]
+
+
+class DimABSAStep(nn.Module):
+    """DimABSA with the step fixed, so that it can be traced / exported (DimABSAOnnx.export_onnx)."""
+
+    def __init__(self, model, step):
+        super(DimABSAStep, self).__init__()
+        self.model = model
+        self.step = step
+
+    def forward(self, query_tensor, query_mask, query_seg):
+        return self.model(query_tensor, query_mask, query_seg, self.step)
+
+
+def bucket_length(length, buckets):
+    for bucket in buckets:
+        if length <= bucket:
+            return bucket
+    return length
+
+
+def compile_model(model, buckets=None, logger=None):
+    """
+    Compile the encoder of model in place with torch.compile and warm it up once on every bucket length.
+    If torch.compile is unavailable or fails, fall back to one TorchScript trace per bucket
+    (traces are eval only, training then runs eager with bucketed lengths). Returns the mode used.
+    """
+    model.seq_buckets = sorted(buckets or SEQ_BUCKETS)
+    encoder = BertEncoder(model.bert)
+    device = next(model.parameters()).device
+    training = model.training
+    model.eval()
+
+    def dummy_query(bucket):
+        query_mask = torch.ones(1, bucket).float().to(device)
+        query_mask[0, -1] = 0  # trace / compile the padded-mask path
+        return torch.ones(1, bucket).long().to(device), query_mask, torch.zeros(1, bucket).long().to(device)
+
+    try:
+        # one graph per bucket and train / eval / grad mode, keep dynamo from giving up on the buckets
+        dynamo_config = torch._dynamo.config
+        limit_name = 'recompile_limit' if hasattr(dynamo_config, 'recompile_limit') else 'cache_size_limit'
+        setattr(dynamo_config, limit_name, max(getattr(dynamo_config, limit_name), 4 * len(model.seq_buckets)))
+
+        model.encoder_runners = {'compile': torch.compile(encoder, dynamic=False)}
+        model.compile_mode = 'compile'
+        with torch.no_grad():
+            for bucket in model.seq_buckets:
+                model.encoder_runners['compile'](*dummy_query(bucket))
+    except Exception as e:
+        if logger is not None:
+            logger.info('torch.compile failed ({}), falling back to TorchScript'.format(repr(e)[:200]))
+        model.encoder_runners = {}
+        model.compile_mode = 'script'
+        with torch.no_grad():
+            for bucket in model.seq_buckets:
+                model.encoder_runners[bucket] = torch.jit.trace(encoder, dummy_query(bucket), check_trace=False)
+
+    model.train(training)
+    if logger is not None:
+        logger.info('encoder compiled with {}, buckets: {}'.format(model.compile_mode, model.seq_buckets))
+    return model.compile_mode
@@ -0,0 +1,97 @@
+import os
+import json
+
+import numpy as np
+
+# torch is only imported by the exporter: OnnxDimABSA (--backend onnx) runs on onnxruntime + numpy alone
+
+# 每個 step 各自 export 成一個 graph，forward 裡的字串 dispatch 就不會進到 graph 裡
+STEPS = ['A', 'O', 'AO', 'OA', 'C', 'Valence', 'Arousal']
+SPAN_STEPS = ['A', 'O', 'AO', 'OA']
+OUTPUT_NAMES = {
+    'A': ['start_scores', 'end_scores'],
+    'O': ['start_scores', 'end_scores'],
+    'AO': ['start_scores', 'end_scores'],
+    'OA': ['start_scores', 'end_scores'],
+    'C': ['category_scores'],
+    'Valence': ['valence_scores'],
+    'Arousal': ['arousal_scores'],
+}
+INPUT_NAMES = ['query', 'query_mask', 'query_seg']
+
+
+def onnx_file_name(onnx_dir, step):
+    return os.path.join(onnx_dir, 'step_' + step + '.onnx')
+
+
+def export_onnx(model, onnx_dir, max_len, opset_version=17):
+    """
+    Write one ONNX graph per head group (step_A.onnx ... step_Arousal.onnx) with dynamic batch / sequence axes,
+    plus onnx_meta.json describing the inputs / outputs.
+    """
+    import torch
+    from DimABSAModel import DimABSAStep
+
+    if not os.path.exists(onnx_dir):
+        os.makedirs(onnx_dir)
+
+    model = model.cpu().eval()
+    # dummy query, the sequence length is dynamic anyway
+    seq_len = min(16, max_len)
+    query = torch.ones(1, seq_len).long()
+    query_mask = torch.ones(1, seq_len).float()
+    query_seg = torch.zeros(1, seq_len).long()
+
+    for step in STEPS:
+        dynamic_axes = {name: {0: 'batch', 1: 'sequence'} for name in INPUT_NAMES}
+        for name in OUTPUT_NAMES[step]:
+            dynamic_axes[name] = {0: 'batch', 1: 'sequence'} if step in SPAN_STEPS else {0: 'batch'}
+        with torch.no_grad():
+            torch.onnx.export(DimABSAStep(model, step), (query, query_mask, query_seg), onnx_file_name(onnx_dir, step),
+                              input_names=INPUT_NAMES, output_names=OUTPUT_NAMES[step],
+                              dynamic_axes=dynamic_axes, opset_version=opset_version, dynamo=False)
+
+    with open(os.path.join(onnx_dir, 'onnx_meta.json'), 'w', encoding='utf-8') as f:
+        json.dump({'steps': STEPS, 'inputs': INPUT_NAMES, 'outputs': OUTPUT_NAMES, 'max_len': max_len,
+                   'opset_version': opset_version}, f, indent=2)
+
+
+class OnnxDimABSA:
+    """
+    onnxruntime backend with the same call signature as DimABSA: model(query, mask, seg, step), but numpy arrays in and
+    out (numpy_io, see Cascade.run_model). Sessions are opened lazily per step.
+    """
+
+    numpy_io = True
+
+    def __init__(self, onnx_dir, num_threads=0):
+        import onnxruntime as ort
+
+        self.onnx_dir = onnx_dir
+        self.options = ort.SessionOptions()
+        self.options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads > 0:
+            self.options.intra_op_num_threads = num_threads
+        self.ort = ort
+        self.sessions = {}
+
+    def session(self, step):
+        if step not in self.sessions:
+            if step not in OUTPUT_NAMES:
+                raise KeyError('step error.')
+            self.sessions[step] = self.ort.InferenceSession(onnx_file_name(self.onnx_dir, step), self.options,
+                                                            providers=['CPUExecutionProvider'])
+        return self.sessions[step]
+
+    def eval(self):
+        return self
+
+    def __call__(self, query_tensor, query_mask, query_seg, step):
+        outputs = self.session(step).run(OUTPUT_NAMES[step], {
+            'query': np.asarray(query_tensor, dtype=np.int64),
+            'query_mask': np.asarray(query_mask, dtype=np.float32),
+            'query_seg': np.asarray(query_seg, dtype=np.int64),
+        })
+        if step in SPAN_STEPS:
+            return outputs[0], outputs[1]
+        return outputs[0]
@@ -0,0 +1,239 @@
+import torch
+from transformers import AutoTokenizer
+
+import Cascade
+from Categories import category_map
+from PredictionCache import PredictionCache, fingerprint, decoding_settings
+from DataProcess import make_inference_QA, query_template_ids
+from DimABSAModel import DimABSA, quantize_dynamic_int8, compile_model, load_weights_file
+
+
+class SentimentTuple:
+    """One predicted (aspect, category, opinion, valence, arousal), spans are sentence token indices."""
+
+    def __init__(self, aspect, opinion, category, valence, arousal, aspect_span, opinion_span):
+        self.aspect = aspect
+        self.opinion = opinion
+        self.category = category
+        self.valence = valence
+        self.arousal = arousal
+        self.aspect_span = aspect_span
+        self.opinion_span = opinion_span
+
+    def to_dict(self):
+        return {'Aspect': self.aspect, 'Opinion': self.opinion, 'Category': self.category,
+                'Valence': self.valence, 'Arousal': self.arousal,
+                'AspectSpan': list(self.aspect_span), 'OpinionSpan': list(self.opinion_span)}
+
+    def __repr__(self):
+        return 'SentimentTuple({!r}, {!r}, {!r}, {}, {})'.format(
+            self.aspect, self.category, self.opinion, self.valence, self.arousal)
+
+
+class Prediction:
+    """All tuples predicted for one review."""
+
+    def __init__(self, id, text, tuples):
+        self.id = id
+        self.text = text
+        self.tuples = tuples
+
+    def triplet_record(self):
+        """Task 2 record, the same schema as the subtask_2 prediction files."""
+        return {'ID': self.id,
+                'Triplet': [{'Aspect': t.aspect, 'Opinion': t.opinion, 'VA': '{}#{}'.format(t.valence, t.arousal)}
+                            for t in self.tuples]}
+
+    def quadruplet_record(self):
+        """Task 3 record, the same schema as the subtask_3 prediction files."""
+        return {'ID': self.id,
+                'Quadruplet': [{'Aspect': t.aspect, 'Opinion': t.opinion,
+                                'VA': '{}#{}'.format(t.valence, t.arousal), 'Category': t.category}
+                               for t in self.tuples]}
+
+    def __repr__(self):
+        return 'Prediction(id={!r}, tuples={!r})'.format(self.id, self.tuples)
+
+
+class DimABSAPredictor:
+    """
+    In-process predictor: checkpoint, tokenizer and query heads are loaded once, reviews are decoded with the
+    batched cascade and returned as Prediction objects, nothing is written to ./tasks/.
+
+        predictor = DimABSAPredictor('./model/task3_res_eng.pth', task=3, domain='res', language='eng')
+        predictor.predict('The pasta was great but the waiter was rude.')
+    """
+
+    def __init__(self, model_path, bert_model_type='bert-base-multilingual-uncased', task=3, domain='res',
+                 language='eng', hidden_size=768, inference_beta=0.90, max_span_len=None, gpu=False,
+                 batch_size=16, query_batch_size=64, decode_policy='full', fast_threshold=0.95,
+                 quantize='none', compile=False, cache_path=None, cache_memory_size=10000,
+                 cache_max_entries=1000000):
+        self.task = task
+        self.language = language
+        self.inference_beta = inference_beta
+        self.gpu = gpu
+        self.batch_size = batch_size
+        self.query_batch_size = query_batch_size
+        if decode_policy == 'fast' and fast_threshold < inference_beta:
+            raise ValueError('fast_threshold ({}) must be >= inference_beta ({})'.format(
+                fast_threshold, inference_beta))
+        self.fast_threshold = fast_threshold if decode_policy == 'fast' else None
+        self.steps = ('C', 'Valence', 'Arousal') if task == 3 else ('Valence', 'Arousal')
+
+        category_dict, _ = category_map[domain]
+        self.ids_to_categories = [key for key, value in sorted(category_dict.items(), key=lambda item: item[1])]
+        self.tokenize = AutoTokenizer.from_pretrained(bert_model_type)
+        self.head_ids = Cascade.query_head_ids(self.tokenize)
+        # make_inference_QA only reads .task / .language
+        self.query_args = _QueryArgs(task, language)
+        self.template_ids = query_template_ids(self.tokenize, language)
+        self.null_id = self.tokenize.convert_tokens_to_ids("null")
+
+        # training checkpoint or the weights-only task*_infer.safetensors artifact (export_inference), memory mapped
+        checkpoint = load_weights_file(model_path)
+        meta = checkpoint.get('meta')
+        if meta is not None and (meta['task'], meta['domain'], meta['language']) != (task, domain, language):
+            raise ValueError('{} was exported for task {} {} {}'.format(
+                model_path, meta['task'], meta['domain'], meta['language']))
+        self.max_len = checkpoint['max_len'] if checkpoint['max_len'] is not None else max_span_len
+        if self.max_len is None:
+            raise KeyError('{} does not store max_len, pass max_span_len'.format(model_path))
+
+        # config only, the pretrained BERT weights would be overwritten by the checkpoint anyway
+        model = DimABSA(hidden_size, bert_model_type, len(category_dict), pretrained=False)
+        model.load_state_dict(checkpoint['net'])
+        if quantize == 'int8':
+            if gpu:
+                raise ValueError('dynamic int8 quantization only runs on CPU')
+            model = quantize_dynamic_int8(model)
+        if gpu:
+            model = model.cuda()
+        model.eval()
+        if compile:
+            compile_model(model)
+        self.model = model
+
+        # cache_path: sqlite PredictionCache shared with --prediction_cache of the CLI (same fingerprint)
+        self.cache = None
+        if cache_path:
+            settings = decoding_settings(task, language, self.max_len, inference_beta, self.fast_threshold, quantize)
+            self.cache = PredictionCache(cache_path, fingerprint([model_path], settings, by_content=False),
+                                         cache_memory_size, cache_max_entries)
+
+    @classmethod
+    def from_args(cls, args):
+        """Build from the argparse namespace of the CLI / InferenceServer."""
+        model_path = getattr(args, 'model_path', None) or \
+            args.save_model_path + 'task' + str(args.task) + '_' + args.domain + '_' + args.language + '.pth'
+        return cls(model_path, bert_model_type=args.bert_model_type, task=args.task, domain=args.domain,
+                   language=args.language, hidden_size=args.hidden_size, inference_beta=args.inference_beta,
+                   max_span_len=getattr(args, 'max_span_len', None), gpu=bool(args.gpu),
+                   query_batch_size=getattr(args, 'query_batch_size', 64),
+                   decode_policy=getattr(args, 'decode_policy', 'full'),
+                   fast_threshold=getattr(args, 'fast_threshold', 0.95),
+                   quantize=getattr(args, 'quantize', 'none'), compile=getattr(args, 'compile', False),
+                   cache_path=getattr(args, 'prediction_cache', None),
+                   cache_memory_size=getattr(args, 'cache_memory_size', 10000),
+                   cache_max_entries=getattr(args, 'cache_max_entries', 1000000))
+
+    def sentence(self, record):
+        """Same preprocessing as load_inference_data / dataset_inference_process, for one record."""
+        text = record['Text']
+        lowered = text.lower()
+        encoding = self.tokenize(lowered, add_special_tokens=False, return_offsets_mapping=True)
+        QA = make_inference_QA(self.query_args, record.get('ID'), text if len(lowered) == len(text) else lowered,
+                               [self.null_id] + encoding['input_ids'], templates=self.template_ids,
+                               offsets=encoding['offset_mapping'])
+        return {
+            'forward_asp_query': QA.forward_asp_query,
+            'forward_asp_query_seg': QA.forward_asp_query_seg,
+            'forward_asp_answer_start': QA.forward_asp_answer_start,
+            'backward_opi_query': QA.backward_opi_query,
+            'backward_opi_query_seg': QA.backward_opi_query_seg,
+            'backward_opi_answer_start': QA.backward_opi_answer_start,
+            'line': QA.line,
+            'offsets': QA.offsets,
+        }
+
+    @torch.no_grad()
+    def predict_batch(self, records):
+        """records: review strings or {'ID', 'Text'} dicts, all decoded in one batched cascade run."""
+        records = [{'ID': None, 'Text': record} if isinstance(record, str) else record for record in records]
+        if not records:
+            return []
+        sentences = [self.sentence(record) for record in records]
+        triplets = self.sentence_triplets(sentences)
+
+        results = []
+        for record, sentence, sentence_triplets in zip(records, sentences, triplets):
+            word_list_ids = sentence['forward_asp_query'][Cascade.sentence_offset:]
+            tuples = []
+            for triplet in sentence_triplets:
+                tuples.append(SentimentTuple(
+                    aspect=Cascade.decode_span(self.tokenize, word_list_ids, triplet[0], triplet[1], self.language,
+                                               sentence['line'], sentence['offsets']),
+                    opinion=Cascade.decode_span(self.tokenize, word_list_ids, triplet[2], triplet[3], self.language,
+                                                sentence['line'], sentence['offsets']),
+                    category=self.ids_to_categories[triplet[4]] if triplet[4] is not None else None,
+                    valence=float(triplet[5]),
+                    arousal=float(triplet[6]),
+                    aspect_span=(triplet[0], triplet[1]),
+                    opinion_span=(triplet[2], triplet[3])))
+            results.append(Prediction(record.get('ID'), record['Text'], tuples))
+        return results
+
+    def sentence_triplets(self, sentences):
+        """
+        Predicted index triplets per sentence. Identical sentences (same token ids) are decoded once,
+        with a cache only the sentences it does not hold yet go through the cascade.
+        """
+        keys = [tuple(sentence['forward_asp_query'][Cascade.sentence_offset:]) for sentence in sentences]
+        known = {}
+        if self.cache is not None:
+            for key in set(keys):
+                value = self.cache.get(self.cache.key(key))
+                if value is not None:
+                    known[key] = value
+
+        # 相同的句子只算一次
+        todo = {}
+        for key, sentence in zip(keys, sentences):
+            if key not in known and key not in todo:
+                todo[key] = sentence
+        if todo:
+            predictions = Cascade.batched_predictions(
+                self.model, list(todo.values()), self.head_ids, self.gpu, self.max_len, self.inference_beta,
+                self.steps, self.query_batch_size, self.fast_threshold)
+            for key, prediction in zip(todo, predictions):
+                known[key] = prediction['triplet']
+                if self.cache is not None:
+                    self.cache.put(self.cache.key(key), prediction['triplet'])
+            if self.cache is not None:
+                self.cache.flush()
+        return [known[key] for key in keys]
+
+    def predict(self, texts):
+        """A single review → Prediction, a list of reviews → list of Prediction (split into batch_size runs)."""
+        if isinstance(texts, (str, dict)):
+            return self.predict_batch([texts])[0]
+        return list(self.predict_stream(texts))
+
+    def predict_stream(self, iterable, batch_size=None):
+        """Generator over any iterable of reviews, batch_size reviews per cascade run, results in input order."""
+        batch_size = batch_size or self.batch_size
+        batch = []
+        for record in iterable:
+            batch.append(record)
+            if len(batch) >= batch_size:
+                for prediction in self.predict_batch(batch):
+                    yield prediction
+                batch = []
+        for prediction in self.predict_batch(batch):
+            yield prediction
+
+
+class _QueryArgs:
+    def __init__(self, task, language):
+        self.task = task
+        self.language = language
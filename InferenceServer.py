@@ -0,0 +1,210 @@
+import argparse
+import asyncio
+import json
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from DimABSAPredictor import DimABSAPredictor
+
+# latencies kept for the percentiles in /stats
+LATENCY_WINDOW = 10000
+
+
+def parser_getting():
+    parser = argparse.ArgumentParser(description='HTTP inference service for DimABSA with dynamic micro-batching')
+    parser.add_argument('--task', type=int, default=3, choices=[2, 3])
+    parser.add_argument('--domain', type=str, default="res", choices=["res", "lap", "hot", "fin"])
+    parser.add_argument('--language', type=str, default="eng")
+    parser.add_argument('--bert_model_type', type=str, default="bert-base-multilingual-uncased")
+    parser.add_argument('--hidden_size', type=int, default=768)
+    parser.add_argument('--save_model_path', type=str, default="./model/")
+    parser.add_argument('--model_path', type=str, default=None,
+                        help="checkpoint, default ./model/task{task}_{domain}_{language}.pth")
+    parser.add_argument('--max_span_len', type=int, default=None,
+                        help="longest aspect / opinion span, read from the checkpoint when it was saved there")
+    parser.add_argument('--inference_beta', type=float, default=0.90)
+    parser.add_argument('--decode_policy', type=str, default="full", choices=["full", "fast"])
+    parser.add_argument('--fast_threshold', type=float, default=0.95)
+    parser.add_argument('--gpu', action='store_true')
+
+    parser.add_argument('--host', type=str, default="127.0.0.1")
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--max_batch_size', type=int, default=16, help="reviews grouped into one cascade run")
+    parser.add_argument('--max_wait_ms', type=float, default=5.,
+                        help="how long the first queued review waits for others before its batch runs")
+    parser.add_argument('--query_batch_size', type=int, default=64, help="queries per encoder call")
+    parser.add_argument('--prediction_cache', type=str, default=None, help="sqlite file of cached predictions")
+    parser.add_argument('--cache_memory_size', type=int, default=10000, help="entries in the in-memory LRU")
+    parser.add_argument('--cache_max_entries', type=int, default=1000000, help="rows kept in the sqlite file")
+
+    args = parser.parse_args()
+    return args
+
+
+class LatencyStats:
+    def __init__(self):
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+        self.queue_waits = deque(maxlen=LATENCY_WINDOW)
+        self.batch_sizes = deque(maxlen=LATENCY_WINDOW)
+        self.requests = 0
+        self.batches = 0
+        self.errors = 0
+
+    def summary(self):
+        def percentiles(values):
+            if not values:
+                return None
+            p50, p90, p95, p99 = np.percentile(np.asarray(values) * 1000., [50, 90, 95, 99])
+            return {'p50_ms': p50, 'p90_ms': p90, 'p95_ms': p95, 'p99_ms': p99,
+                    'max_ms': max(values) * 1000.}
+
+        return {
+            'requests': self.requests,
+            'batches': self.batches,
+            'errors': self.errors,
+            'mean_batch_size': float(np.mean(self.batch_sizes)) if self.batch_sizes else None,
+            'latency': percentiles(self.latencies),
+            'queue_wait': percentiles(self.queue_waits),
+        }
+
+
+class InferenceServer:
+    """
+    Requests are queued, a single batcher task takes the first waiting review, waits up to max_wait_ms for more
+    (at most max_batch_size) and runs them as one batched cascade in a worker thread.
+    """
+
+    def __init__(self, args, predictor):
+        self.args = args
+        self.predictor = predictor
+        self.stats = LatencyStats()
+        self.queue = None
+        # one thread: the model runs one batch at a time, the event loop keeps accepting requests meanwhile
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    async def batcher(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.args.max_wait_ms / 1000.
+            while len(batch) < self.args.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            start_time = time.perf_counter()
+            for _, _, enqueue_time in batch:
+                self.stats.queue_waits.append(start_time - enqueue_time)
+            self.stats.batches += 1
+            self.stats.batch_sizes.append(len(batch))
+            try:
+                results = await loop.run_in_executor(
+                    self.executor, self.predict_records, [record for record, _, _ in batch])
+                for (_, future, _), result in zip(batch, results):
+                    if not future.done():
+                        future.set_result(result)
+            except Exception as e:
+                self.stats.errors += 1
+                for _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+
+    def predict_records(self, records):
+        results = []
+        for prediction in self.predictor.predict_batch(records):
+            result = prediction.triplet_record()
+            if self.args.task == 3:
+                result['Quadruplet'] = prediction.quadruplet_record()['Quadruplet']
+            results.append(result)
+        return results
+
+    async def predict(self, records):
+        loop = asyncio.get_running_loop()
+        enqueue_time = time.perf_counter()
+        futures = []
+        for record in records:
+            future = loop.create_future()
+            await self.queue.put((record, future, enqueue_time))
+            futures.append(future)
+        results = await asyncio.gather(*futures)
+        for _ in records:
+            self.stats.latencies.append(time.perf_counter() - enqueue_time)
+        self.stats.requests += len(records)
+        return results
+
+    async def handle(self, reader, writer):
+        try:
+            request_line = (await reader.readline()).decode('latin-1').strip()
+            if not request_line:
+                return
+            method, path, _ = request_line.split(' ', 2)
+            headers = {}
+            while True:
+                line = (await reader.readline()).decode('latin-1').strip()
+                if not line:
+                    break
+                key, value = line.split(':', 1)
+                headers[key.strip().lower()] = value.strip()
+            body = await reader.readexactly(int(headers.get('content-length', 0)))
+
+            if method == 'GET' and path == '/health':
+                status, payload = 200, {'status': 'ok'}
+            elif method == 'GET' and path == '/stats':
+                status, payload = 200, self.stats.summary()
+                if self.predictor.cache is not None:
+                    payload['cache'] = self.predictor.cache.summary()
+            elif method == 'POST' and path == '/predict':
+                status, payload = await self.predict_payload(body)
+            else:
+                status, payload = 404, {'error': 'unknown endpoint {} {}'.format(method, path)}
+        except (ValueError, KeyError) as e:
+            status, payload = 400, {'error': repr(e)}
+        except Exception as e:
+            status, payload = 500, {'error': repr(e)}
+
+        data = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        writer.write('HTTP/1.1 {} {}\r\nContent-Type: application/json; charset=utf-8\r\nContent-Length: {}\r\n'
+                     'Connection: close\r\n\r\n'.format(status, 'OK' if status == 200 else 'Error', len(data))
+                     .encode('latin-1') + data)
+        await writer.drain()
+        writer.close()
+
+    async def predict_payload(self, body):
+        """
+        {"ID": ..., "Text": ...} → one result, [{"ID": ..., "Text": ...}, ...] → list of results,
+        a bare string is taken as {"ID": null, "Text": ...},
+        results follow the Triplet (and for task 3 Quadruplet) schema of the prediction files.
+        """
+        data = json.loads(body.decode('utf-8'))
+        records = [{'ID': None, 'Text': r} if isinstance(r, str) else r
+                   for r in (data if isinstance(data, list) else [data])]
+        for record in records:
+            if not isinstance(record, dict) or not isinstance(record.get('Text'), str):
+                raise ValueError('every record needs to be a string or an object with a "Text" string')
+        results = await self.predict(records)
+        return 200, results if isinstance(data, list) else results[0]
+
+    async def serve(self):
+        self.queue = asyncio.Queue()
+        batcher = asyncio.create_task(self.batcher())
+        server = await asyncio.start_server(self.handle, self.args.host, self.args.port)
+        print('serving on http://{}:{} (max_batch_size={}, max_wait_ms={})'.format(
+            self.args.host, self.args.port, self.args.max_batch_size, self.args.max_wait_ms))
+        async with server:
+            try:
+                await server.serve_forever()
+            finally:
+                batcher.cancel()
+
+
+if __name__ == '__main__':
+    args = parser_getting()
+    predictor = DimABSAPredictor.from_args(args)
+    asyncio.run(InferenceServer(args, predictor).serve())
@@ -0,0 +1,172 @@
+import hashlib
+import json
+import os
+import sqlite3
+from collections import OrderedDict
+
+
+def file_digest(file_name):
+    digest = hashlib.sha256()
+    with open(file_name, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def file_stat(file_name):
+    """(path, size, mtime) of a file, like preprocess_key: no need to read hundreds of MB of weights."""
+    return os.path.abspath(file_name), os.path.getsize(file_name), os.path.getmtime(file_name)
+
+
+def fingerprint(files, settings, by_content=True):
+    """
+    Fingerprint of everything a sentence prediction depends on besides the sentence itself:
+    the weight files (missing ones are skipped) and the decoding settings / query templates.
+    by_content=True hashes the files (small ones, e.g. the tokenizer), False keys them on file_stat (model weights).
+    """
+    describe = file_digest if by_content else file_stat
+    parts = {'settings': settings, 'files': []}
+    for file_name in files:
+        if os.path.isdir(file_name):
+            parts['files'] += [(name, describe(os.path.join(file_name, name)))
+                               for name in sorted(os.listdir(file_name))]
+        elif os.path.exists(file_name):
+            parts['files'].append((os.path.basename(file_name), describe(file_name)))
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+
+class PredictionCache:
+    """
+    Sentence → predicted index triplets (the Cascade.sentence_predictions 'triplet' list).
+    Keyed by sha256 of the model fingerprint and the sentence token ids (i.e. the lower-cased, tokenized text the
+    model sees). An in-memory LRU of memory_size entries sits in front of a sqlite file, which keeps at most
+    max_entries rows, least recently used rows are evicted.
+    Every put is committed at once and lookups only read, the last_used stamps of disk hits are written in one short
+    transaction by flush() (at the latest after commit_every of them), so no process holds the write lock for long.
+    """
+
+    def __init__(self, path, fingerprint, memory_size=10000, max_entries=1000000, commit_every=1000):
+        self.path = path
+        self.fingerprint = fingerprint
+        self.memory_size = memory_size
+        self.max_entries = max_entries
+        self.commit_every = commit_every
+        self.memory = OrderedDict()
+
+        # several --num_workers processes may share the file: WAL + a generous lock timeout + short write transactions
+        self.db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        # a commit per put: no fsync per commit (a crash loses at most the last cached predictions)
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS predictions '
+                        '(key TEXT PRIMARY KEY, value TEXT NOT NULL, last_used INTEGER NOT NULL)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS predictions_last_used ON predictions (last_used)')
+        self.clock = self.db.execute('SELECT COALESCE(MAX(last_used), 0) FROM predictions').fetchone()[0]
+        self.used = {}
+        self.written = 0
+
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def key(self, token_ids):
+        text = ' '.join(str(int(token_id)) for token_id in token_ids)
+        return hashlib.sha256((self.fingerprint + '|' + text).encode('utf-8')).hexdigest()
+
+    def tick(self):
+        self.clock += 1
+        return self.clock
+
+    def remember(self, key, value):
+        self.memory[key] = value
+        self.memory.move_to_end(key)
+        if len(self.memory) > self.memory_size:
+            self.memory.popitem(last=False)
+
+    def get(self, key):
+        """Cached triplets of key, None on a miss."""
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            self.memory_hits += 1
+            return self.memory[key]
+
+        row = self.db.execute('SELECT value FROM predictions WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.used[key] = self.tick()
+        if len(self.used) >= self.commit_every:
+            self.flush()
+        value = json.loads(row[0])
+        self.remember(key, value)
+        self.disk_hits += 1
+        return value
+
+    def put(self, key, value):
+        self.remember(key, value)
+        self.db.execute('INSERT OR REPLACE INTO predictions (key, value, last_used) VALUES (?, ?, ?)',
+                        (key, json.dumps(value), self.tick()))
+        self.db.commit()
+        self.written += 1
+        if self.written >= self.commit_every:
+            self.flush()
+            self.evict()
+
+    def evict(self):
+        """Drop the least recently used rows beyond max_entries."""
+        count = self.db.execute('SELECT COUNT(*) FROM predictions').fetchone()[0]
+        if count > self.max_entries:
+            self.db.execute('DELETE FROM predictions WHERE key IN '
+                            '(SELECT key FROM predictions ORDER BY last_used ASC LIMIT ?)', (count - self.max_entries,))
+            self.evictions += count - self.max_entries
+        self.db.commit()
+        self.written = 0
+
+    def flush(self):
+        """Write the last_used stamps of the disk hits since the last flush."""
+        if self.used:
+            self.db.executemany('UPDATE predictions SET last_used = ? WHERE key = ?',
+                                [(last_used, key) for key, last_used in self.used.items()])
+            self.db.commit()
+            self.used.clear()
+
+    def close(self):
+        self.flush()
+        self.evict()
+        self.db.close()
+
+    def summary(self):
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        return {
+            'lookups': lookups,
+            'memory_hits': self.memory_hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'hit_rate': (self.memory_hits + self.disk_hits) / lookups if lookups else None,
+            'evictions': self.evictions,
+        }
+
+    def log_summary(self, logger):
+        summary = self.summary()
+        logger.info('prediction cache: lookups: {}\tmemory hits: {}\tdisk hits: {}\tmisses: {}\thit rate: {}\t'
+                    'evictions: {}'.format(summary['lookups'], summary['memory_hits'], summary['disk_hits'],
+                                           summary['misses'], summary['hit_rate'], summary['evictions']))
+
+
+def decoding_settings(task, language, max_len, beta, fast_threshold, quantize='none', backend='torch'):
+    """Settings / query templates that change the predicted triplets of a sentence, for fingerprint()."""
+    import Cascade
+    from DataProcess import get_query_templates
+
+    return {
+        'task': task,
+        'max_len': max_len,
+        'beta': beta,
+        'fast_threshold': fast_threshold,
+        'quantize': quantize,
+        'backend': backend,
+        'heads': [Cascade.forward_opinion_head, Cascade.backward_aspect_head, Cascade.category_head,
+                  Cascade.valence_head, Cascade.arousal_head, Cascade.pair_joint],
+        'templates': get_query_templates(language),
+    }
@@ -0,0 +1,64 @@
+import pickle
+import sqlite3
+
+
+class RecordCache:
+    """
+    Review ID → (DataIO.content_hash, CompactQueryAndAnswer with token ids, TestDataset) of the training reviews in a
+    sqlite file, so a growing corpus only tokenizes / builds the QA features of its new or changed reviews.
+    The features depend on the tokenizer / templates / task as well: rows written with another fingerprint are
+    dropped when the file is opened.
+    """
+
+    def __init__(self, path, fingerprint, commit_every=1000):
+        self.path = path
+        self.fingerprint = fingerprint
+        self.commit_every = commit_every
+        # the shared query templates of the cached reviews, so unpickled reviews do not each keep a copy
+        self.templates = {}
+
+        self.db = sqlite3.connect(path, timeout=60)
+        self.db.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS records '
+                        '(id TEXT PRIMARY KEY, hash TEXT NOT NULL, value BLOB NOT NULL)')
+        row = self.db.execute("SELECT value FROM meta WHERE key = 'fingerprint'").fetchone()
+        if row is None or row[0] != fingerprint:
+            self.db.execute('DELETE FROM records')
+            self.db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('fingerprint', ?)", (fingerprint,))
+            self.db.commit()
+        self.pending = 0
+
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, record_id, record_hash):
+        """(QA, TestDataset) of the review when it was cached with the same content hash, else None."""
+        row = self.db.execute('SELECT hash, value FROM records WHERE id = ?', (str(record_id),)).fetchone()
+        if row is None or row[0] != record_hash:
+            self.misses += 1
+            return None
+        self.hits += 1
+        QA, test = pickle.loads(row[1])
+        key = tuple(tuple(template) for template in QA.templates)
+        QA.templates = self.templates.setdefault(key, QA.templates)
+        return QA, test
+
+    def put(self, record_id, record_hash, QA, test):
+        self.db.execute('INSERT OR REPLACE INTO records (id, hash, value) VALUES (?, ?, ?)',
+                        (str(record_id), record_hash, pickle.dumps((QA, test), protocol=pickle.HIGHEST_PROTOCOL)))
+        self.pending += 1
+        if self.pending >= self.commit_every:
+            self.flush()
+
+    def flush(self):
+        self.db.commit()
+        self.pending = 0
+
+    def close(self):
+        self.flush()
+        self.db.close()
+
+    def summary(self):
+        lookups = self.hits + self.misses
+        return {'lookups': lookups, 'hits': self.hits, 'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else None}
@@ -0,0 +1,106 @@
+import glob
+import random
+
+from torch.utils.data import IterableDataset, get_worker_info
+
+from Utils import example_to_numpy
+from DataIO import iter_reviews, shard_ranges, compression
+from DataProcess import review_to_record, record_to_QA, is_dev_review, phrase_cache_size
+
+# --streaming: the training reviews are never held in memory. The shards are read line by line while training,
+# each review is tokenized and turned into its QA features inside the DataLoader worker that reads it, and a bounded
+# shuffle buffer replaces the full in-memory shuffle. Memory is the buffer + the dev split, not the corpus.
+# With DataLoader workers every worker reads its own byte ranges (Parquet: row groups) of the shards, nothing twice.
+
+
+def train_shard_paths(args):
+    """
+    --train_data as a glob under --data_path (e.g. zho_laptop_train_*.jsonl, JSONL or Parquet shards), sorted so the
+    order is fixed.
+    """
+    paths = sorted(glob.glob(args.data_path + args.train_data))
+    if not paths:
+        raise KeyError('no training shard matches {}'.format(args.data_path + args.train_data))
+    return paths
+
+
+class StreamingReviewDataset(IterableDataset):
+    """
+    Training reviews of the shards (the dev reviews, see DataProcess.is_dev_review, are skipped).
+    With DataLoader workers, each shard is split into one range per worker (DataIO.shard_ranges) and the ranges are
+    dealt out round-robin (starting one worker further for every shard), so a worker only reads its own part of the
+    shards. A compressed shard cannot be seeked and goes to a single worker whole.
+    Every epoch (set_epoch) visits the shards in another order and draws another shuffle.
+    """
+
+    def __init__(self, args, paths, tokenizer, train_count, max_tokens_len, max_aspect_num, seed=42):
+        self.args = args
+        self.paths = paths
+        self.tokenizer = tokenizer
+        self.train_count = train_count
+        self.max_tokens_len = max_tokens_len
+        self.max_aspect_num = max_aspect_num
+        self.seed = seed
+        self.epoch = 0
+
+    def __len__(self):
+        return self.train_count
+
+    def get_batch_num(self, batch_size):
+        if self.train_count % batch_size == 0:
+            return self.train_count / batch_size
+        return int(self.train_count / batch_size) + 1
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def worker_ranges(self, worker_id, num_workers):
+        """(shard path, range or None for the whole shard) read by this worker in this epoch."""
+        paths = list(self.paths)
+        # same shard order in every worker, otherwise the ranges would be dealt out differently
+        random.Random('{}-{}'.format(self.seed, self.epoch)).shuffle(paths)
+        ranges = []
+        for path_index, path in enumerate(paths):
+            if num_workers == 1 or compression(path) is not None:
+                path_ranges = [None]
+            else:
+                path_ranges = shard_ranges(path, num_workers)
+            # the first range of the next shard goes to the next worker, so uneven ranges do not pile up on one worker
+            ranges += [(path, shard_range) for range_index, shard_range in enumerate(path_ranges)
+                       if (path_index + range_index) % num_workers == worker_id]
+        return ranges
+
+    def examples(self, worker_id, num_workers):
+        """The CompactQueryAndAnswer of this worker's training reviews, in file order."""
+        phrase_tokens = {}
+        template_ids = {}
+        for path, shard_range in self.worker_ranges(worker_id, num_workers):
+            for data in iter_reviews(path, shard_range):
+                if is_dev_review(data['ID'], self.args.dev_percent):
+                    continue
+                record = review_to_record(self.args, data, self.tokenizer, phrase_tokens)
+                QA, _, _, _ = record_to_QA(self.args, record, self.tokenizer, template_ids)
+                # 跟 dataset_process 一樣: pair 數 padding 到 max_aspect_num + 1
+                QA.max_tokens_len = self.max_tokens_len
+                QA.max_aspect_num = self.max_aspect_num + 1
+                yield QA
+                if len(phrase_tokens) > phrase_cache_size:
+                    phrase_tokens.clear()
+
+    def __iter__(self):
+        worker_info = get_worker_info()
+        worker_id, num_workers = (0, 1) if worker_info is None else (worker_info.id, worker_info.num_workers)
+        rng = random.Random('{}-{}-{}'.format(self.seed, self.epoch, worker_id))
+
+        # bounded shuffle buffer: once it is full, every new review replaces a random one, which is yielded
+        buffer = []
+        for QA in self.examples(worker_id, num_workers):
+            if len(buffer) < self.args.shuffle_buffer:
+                buffer.append(QA)
+                continue
+            index = rng.randrange(len(buffer))
+            yield example_to_numpy(self.args, buffer[index])
+            buffer[index] = QA
+        rng.shuffle(buffer)
+        for QA in buffer:
+            yield example_to_numpy(self.args, QA)
@@ -1,14 +1,17 @@
 import os
+import sys
+import json
 import math
-import torch
 import logging
+import functools
 import numpy as np
 
-from torch.nn import functional as F
-from torch.utils.data import Dataset, DataLoader
+# torch is imported inside the functions that need it, so that data preprocessing (--mode preprocess) runs without it.
+# The datasets are plain map-style datasets (__len__ / __getitem__), DataLoader takes them as they are
+# (--streaming uses the iterable StreamingData.StreamingReviewDataset instead).
 
 
-class ReviewDataset(Dataset):
+class ReviewDataset:
     def __init__(self, args, dataset):
         self.args = args
         self.dataset = dataset
@@ -17,52 +20,7 @@ class ReviewDataset(Dataset):
         return len(self.dataset)
 
     def __getitem__(self, item):
-        example = self.dataset[item]
-
-        dataset_to_numpy_array = {
-            'line': example.line,
-
-            'forward_asp_query': np.array(example.forward_asp_query),
-            'forward_opi_query': np.array(example.forward_opi_query),
-            'forward_asp_query_mask': np.array(example.forward_asp_query_mask),
-            'forward_opi_query_mask': np.array(example.forward_opi_query_mask),
-            'forward_asp_query_seg': np.array(example.forward_asp_query_seg),
-            'forward_opi_query_seg': np.array(example.forward_opi_query_seg),
-            'forward_asp_answer_start': np.array(example.forward_asp_answer_start),
-            'forward_asp_answer_end': np.array(example.forward_asp_answer_end),
-            'forward_opi_answer_start': np.array(example.forward_opi_answer_start),
-            'forward_opi_answer_end': np.array(example.forward_opi_answer_end),
-
-            'backward_asp_query': np.array(example.backward_asp_query),
-            'backward_opi_query': np.array(example.backward_opi_query),
-            'backward_asp_query_mask': np.array(example.backward_asp_query_mask),
-            'backward_opi_query_mask': np.array(example.backward_opi_query_mask),
-            'backward_asp_query_seg': np.array(example.backward_asp_query_seg),
-            'backward_opi_query_seg': np.array(example.backward_opi_query_seg),
-            'backward_asp_answer_start': np.array(example.backward_asp_answer_start),
-            'backward_asp_answer_end': np.array(example.backward_asp_answer_end),
-            'backward_opi_answer_start': np.array(example.backward_opi_answer_start),
-            'backward_opi_answer_end': np.array(example.backward_opi_answer_end),
-
-            'valence_query': np.array(example.valence_query),
-            'valence_answer': np.array(example.valence_answer),
-            'valence_query_mask': np.array(example.valence_query_mask),
-            'valence_query_seg': np.array(example.valence_query_seg),
-
-            'arousal_query': np.array(example.arousal_query),
-            'arousal_answer': np.array(example.arousal_answer),
-            'arousal_query_mask': np.array(example.arousal_query_mask),
-            'arousal_query_seg': np.array(example.arousal_query_seg),
-        }
-
-        # task 3 才有 category，而且要確定不是全 None
-        if self.args.task == 3 and example.category_query is not None and None not in example.category_query:
-            dataset_to_numpy_array['category_query'] = np.array(example.category_query)
-            dataset_to_numpy_array['category_answer'] = np.array(example.category_answer)
-            dataset_to_numpy_array['category_query_mask'] = np.array(example.category_query_mask)
-            dataset_to_numpy_array['category_query_seg'] = np.array(example.category_query_seg)
-
-        return dataset_to_numpy_array
+        return example_to_numpy(self.args, self.dataset[item])
 
     def get_batch_num(self, batch_size):
         if len(self.dataset) % batch_size == 0:
@@ -70,7 +28,59 @@ class ReviewDataset(Dataset):
         return int(len(self.dataset) / batch_size) + 1
 
 
-class InferenceReviewDataset(Dataset):
+def example_to_numpy(args, example):
+    """QueryAndAnswer / CompactQueryAndAnswer → the numpy arrays of one training batch row."""
+    if isinstance(example, CompactQueryAndAnswer):
+        from DataProcess import expand_QA
+        example = expand_QA(example)
+
+    dataset_to_numpy_array = {
+        'line': example.line,
+
+        'forward_asp_query': np.array(example.forward_asp_query),
+        'forward_opi_query': np.array(example.forward_opi_query),
+        'forward_asp_query_mask': np.array(example.forward_asp_query_mask),
+        'forward_opi_query_mask': np.array(example.forward_opi_query_mask),
+        'forward_asp_query_seg': np.array(example.forward_asp_query_seg),
+        'forward_opi_query_seg': np.array(example.forward_opi_query_seg),
+        'forward_asp_answer_start': np.array(example.forward_asp_answer_start),
+        'forward_asp_answer_end': np.array(example.forward_asp_answer_end),
+        'forward_opi_answer_start': np.array(example.forward_opi_answer_start),
+        'forward_opi_answer_end': np.array(example.forward_opi_answer_end),
+
+        'backward_asp_query': np.array(example.backward_asp_query),
+        'backward_opi_query': np.array(example.backward_opi_query),
+        'backward_asp_query_mask': np.array(example.backward_asp_query_mask),
+        'backward_opi_query_mask': np.array(example.backward_opi_query_mask),
+        'backward_asp_query_seg': np.array(example.backward_asp_query_seg),
+        'backward_opi_query_seg': np.array(example.backward_opi_query_seg),
+        'backward_asp_answer_start': np.array(example.backward_asp_answer_start),
+        'backward_asp_answer_end': np.array(example.backward_asp_answer_end),
+        'backward_opi_answer_start': np.array(example.backward_opi_answer_start),
+        'backward_opi_answer_end': np.array(example.backward_opi_answer_end),
+
+        'valence_query': np.array(example.valence_query),
+        'valence_answer': np.array(example.valence_answer),
+        'valence_query_mask': np.array(example.valence_query_mask),
+        'valence_query_seg': np.array(example.valence_query_seg),
+
+        'arousal_query': np.array(example.arousal_query),
+        'arousal_answer': np.array(example.arousal_answer),
+        'arousal_query_mask': np.array(example.arousal_query_mask),
+        'arousal_query_seg': np.array(example.arousal_query_seg),
+    }
+
+    # task 3 才有 category，而且要確定不是全 None
+    if args.task == 3 and example.category_query is not None and None not in example.category_query:
+        dataset_to_numpy_array['category_query'] = np.array(example.category_query)
+        dataset_to_numpy_array['category_answer'] = np.array(example.category_answer)
+        dataset_to_numpy_array['category_query_mask'] = np.array(example.category_query_mask)
+        dataset_to_numpy_array['category_query_seg'] = np.array(example.category_query_seg)
+
+    return dataset_to_numpy_array
+
+
+class InferenceReviewDataset:
     def __init__(self, args, dataset):
         self.args = args
         self.dataset = dataset
@@ -83,22 +93,25 @@ class InferenceReviewDataset(Dataset):
     def __getitem__(self, idx):
         example = self.dataset[idx]
 
+        # the fields are array('i') (DataProcess.inference_chunk_process), batches stay int64
         dataset_to_numpy_array = {
             'id': example.id,   # string or whatever
             'line': example.line,
 
-            'forward_asp_query': np.array(example.forward_asp_query),
-            'forward_asp_query_mask': np.array(example.forward_asp_query_mask),
-            'forward_asp_query_seg': np.array(example.forward_asp_query_seg),
-            'forward_asp_answer_start': np.array(example.forward_asp_answer_start),
-            'forward_asp_answer_end': np.array(example.forward_asp_answer_end),
-
-            'backward_opi_query': np.array(example.backward_opi_query),
-            'backward_opi_query_mask': np.array(example.backward_opi_query_mask),
-            'backward_opi_query_seg': np.array(example.backward_opi_query_seg),
-            'backward_opi_answer_start': np.array(example.backward_opi_answer_start),
-            'backward_opi_answer_end': np.array(example.backward_opi_answer_end),
+            'forward_asp_query': np.array(example.forward_asp_query, dtype=np.int64),
+            'forward_asp_query_mask': np.array(example.forward_asp_query_mask, dtype=np.int64),
+            'forward_asp_query_seg': np.array(example.forward_asp_query_seg, dtype=np.int64),
+            'forward_asp_answer_start': np.array(example.forward_asp_answer_start, dtype=np.int64),
+            'forward_asp_answer_end': np.array(example.forward_asp_answer_end, dtype=np.int64),
+
+            'backward_opi_query': np.array(example.backward_opi_query, dtype=np.int64),
+            'backward_opi_query_mask': np.array(example.backward_opi_query_mask, dtype=np.int64),
+            'backward_opi_query_seg': np.array(example.backward_opi_query_seg, dtype=np.int64),
+            'backward_opi_answer_start': np.array(example.backward_opi_answer_start, dtype=np.int64),
+            'backward_opi_answer_end': np.array(example.backward_opi_answer_end, dtype=np.int64),
         }
+        if example.offsets is not None:
+            dataset_to_numpy_array['offsets'] = np.array(example.offsets, dtype=np.int64).reshape(-1, 2)
 
         # 想看的話可以打開這行：看前幾筆 id
         if idx < 3:
@@ -113,6 +126,16 @@ class InferenceReviewDataset(Dataset):
 
 
 class QueryAndAnswer:
+    __slots__ = ('line', 'forward_asp_query', 'forward_opi_query', 'forward_asp_query_mask', 'forward_asp_query_seg',
+                 'forward_opi_query_mask', 'forward_opi_query_seg', 'forward_asp_answer_start',
+                 'forward_asp_answer_end', 'forward_opi_answer_start', 'forward_opi_answer_end',
+                 'backward_asp_query', 'backward_opi_query', 'backward_asp_query_mask', 'backward_asp_query_seg',
+                 'backward_opi_query_mask', 'backward_opi_query_seg', 'backward_asp_answer_start',
+                 'backward_asp_answer_end', 'backward_opi_answer_start', 'backward_opi_answer_end',
+                 'category_query', 'category_answer', 'category_query_mask', 'category_query_seg', 'valence_query',
+                 'valence_answer', 'valence_query_mask', 'valence_query_seg', 'arousal_query', 'arousal_answer',
+                 'arousal_query_mask', 'arousal_query_seg')
+
     def __init__(self, line, forward_asp_query, forward_opi_query,
                  forward_asp_query_mask, forward_asp_query_seg,
                  forward_opi_query_mask, forward_opi_query_seg,
@@ -174,15 +197,52 @@ class QueryAndAnswer:
         self.arousal_query_seg = arousal_query_seg
 
 
+class CompactQueryAndAnswer:
+    """
+    A training review as its sentence (once) and its (aspect, opinion) pairs. QueryAndAnswer copies the sentence into
+    every query of every pair, here the queries are only built, and padded, by DataProcess.expand_QA when the review
+    is put into a batch.
+    """
+
+    __slots__ = ('line', 'task', 'templates', 'word_list', 'sep', 'pad', 'aspect_list', 'opinion_list',
+                 'category_list', 'valence_list', 'arousal_list', 'max_tokens_len', 'max_aspect_num')
+
+    def __init__(self, line, task, templates, word_list, sep, pad,
+                 aspect_list, opinion_list, category_list, valence_list, arousal_list):
+        self.line = line
+        self.task = task
+        self.templates = templates
+        self.word_list = word_list
+        self.sep = sep
+        self.pad = pad
+
+        self.aspect_list = aspect_list
+        self.opinion_list = opinion_list
+        self.category_list = category_list
+        self.valence_list = valence_list
+        self.arousal_list = arousal_list
+
+        # set by DataProcess.dataset_align
+        self.max_tokens_len = None
+        self.max_aspect_num = None
+
+
 class Query:
+    __slots__ = ('id', 'line', 'forward_asp_query', 'forward_asp_query_mask', 'forward_asp_query_seg',
+                 'forward_asp_answer_start', 'forward_asp_answer_end', 'backward_opi_query',
+                 'backward_opi_query_mask', 'backward_opi_query_seg', 'backward_opi_answer_start',
+                 'backward_opi_answer_end', 'offsets')
+
     def __init__(self, text_id, line, forward_asp_query,
                  forward_asp_query_mask, forward_asp_query_seg,
                  forward_asp_answer_start, forward_asp_answer_end,
                  backward_opi_query, backward_opi_query_mask, backward_opi_query_seg,
-                 backward_opi_answer_start, backward_opi_answer_end
+                 backward_opi_answer_start, backward_opi_answer_end, offsets=None
                  ):
         self.id = text_id
         self.line = line
+        # (start, end) character offsets of the sentence tokens in line, the predicted spans are cut out of line
+        self.offsets = offsets
 
         self.forward_asp_query = forward_asp_query
         self.forward_asp_query_mask = forward_asp_query_mask
@@ -198,6 +258,9 @@ class Query:
 
 
 class TestDataset:
+    __slots__ = ('line', 'aspect_list', 'opinion_list', 'asp_opi_list', 'asp_cate_list', 'triplet_list',
+                 'valence_list', 'arousal_list', 'VA_list')
+
     def __init__(self, line, aspect_list, opinion_list, asp_opi_list, asp_cate_list,
                  triplet_list, valence_list, arousal_list, VA_list):
         self.line = line
@@ -226,6 +289,9 @@ def replace_using_dict(text, replacement_dict):
 
 
 def calculate_entity_loss(pred_start, pred_end, gold_start, gold_end, gpu):
+    import torch
+    from torch.nn import functional as F
+
     pred_start = normalize_size(pred_start)
     pred_end = normalize_size(pred_end)
     gold_start = normalize_size(gold_start)
@@ -242,15 +308,18 @@ def calculate_entity_loss(pred_start, pred_end, gold_start, gold_end, gpu):
 
 
 def calculate_category_loss(pred_category, gold_category):
+    from torch.nn import functional as F
     return F.cross_entropy(pred_category, gold_category.long(),
                            reduction='sum', ignore_index=-1)
 
 
 def calculate_valence_loss(pred_valence, gold_valence):
+    from torch.nn import functional as F
     return F.mse_loss(pred_valence, gold_valence.float(), reduction='sum')
 
 
 def calculate_arousal_loss(pred_arousal, gold_arousal):
+    from torch.nn import functional as F
     return F.mse_loss(pred_arousal, gold_arousal.float(), reduction='sum')
 
 
@@ -321,18 +390,26 @@ def filter_unpaired(start_prob, end_prob, start, end, max_len):
     return filtered_start, filtered_end, filtered_prob
 
 
-def generate_batches(dataset, batch_size, shuffle=True, drop_last=False, gpu=True):
+def generate_batches(dataset, batch_size, shuffle=True, drop_last=False, gpu=True, num_workers=0):
     """
     統一使用 DataLoader，會把 numpy 轉成 torch.Tensor。
     回傳的 batch_dict 裡：
       - tensor 欄位 (非 line / id) 會搬到 GPU（如果 gpu=True）
       - 'line' 和 'id' 保留為原本型態方便做 debug / 輸出
+    num_workers: DataLoader worker processes (--streaming builds the features in them)
     """
+    from torch.utils.data import DataLoader, IterableDataset
+
+    if isinstance(dataset, IterableDataset):
+        # iterable datasets shuffle themselves (shuffle buffer), DataLoader refuses shuffle=True for them
+        shuffle = False
+
     dataloader = DataLoader(
         dataset=dataset,
         batch_size=batch_size,
         shuffle=shuffle,
-        drop_last=drop_last
+        drop_last=drop_last,
+        num_workers=num_workers
     )
 
     dataset_len = len(dataset)
@@ -356,6 +433,97 @@ def generate_batches(dataset, batch_size, shuffle=True, drop_last=False, gpu=Tru
         yield _dict
 
 
+def numpy_batches(dataset):
+    """
+    The batches of size 1 of generate_batches(dataset, 1, shuffle=False) as numpy arrays, without torch / DataLoader:
+    for the decoding loops (Cascade), which move the queries to the model themselves.
+    """
+    for idx in range(len(dataset)):
+        yield {name: [value] if name in ['line', 'id'] else value[np.newaxis]
+               for name, value in dataset[idx].items()}
+
+
+def no_grad(function):
+    """
+    torch.no_grad() as a decorator, torch is only imported when the function is called.
+    If nothing imported torch yet there is no torch model to track (--backend onnx), torch is then not imported at all.
+    """
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        torch = sys.modules.get('torch')
+        if torch is None:
+            return function(*args, **kwargs)
+        with torch.no_grad():
+            return function(*args, **kwargs)
+    return wrapper
+
+
+class TextTokenizer:
+    """
+    The tokenize / convert_tokens_to_ids / convert_ids_to_tokens part of the BERT tokenizer on top of the
+    `tokenizers` library only. Same tokens and ids as AutoTokenizer (which imports torch through transformers).
+    """
+
+    def __init__(self, tokenizer):
+        self.tokenizer = tokenizer
+        self.tokenizer.no_truncation()
+        self.tokenizer.no_padding()
+        self.unk_token_id = tokenizer.token_to_id('[UNK]')
+        # token → id table, built on first use
+        self.vocab = None
+
+    def __getstate__(self):
+        # the table is not pickled, --preprocess_workers processes rebuild it
+        state = dict(self.__dict__)
+        state['vocab'] = None
+        return state
+
+    def tokenize(self, text):
+        return self.tokenizer.encode(text, add_special_tokens=False).tokens
+
+    def encode(self, text):
+        """Token ids and (start, end) character offsets into text, from one tokenization."""
+        encoding = self.tokenizer.encode(text, add_special_tokens=False)
+        return encoding.ids, encoding.offsets
+
+    def convert_tokens_to_ids(self, tokens):
+        if self.vocab is None:
+            self.vocab = self.tokenizer.get_vocab()
+        if isinstance(tokens, str):
+            return self.vocab.get(tokens, self.unk_token_id)
+        vocab = self.vocab
+        unk_token_id = self.unk_token_id
+        return [vocab.get(token, unk_token_id) for token in tokens]
+
+    def convert_ids_to_tokens(self, ids):
+        if isinstance(ids, int):
+            return self.tokenizer.id_to_token(ids)
+        return [self.tokenizer.id_to_token(int(token_id)) for token_id in ids]
+
+    def decode(self, ids):
+        """Text of token ids like AutoTokenizer.decode: special tokens kept, ## pieces joined by the decoder."""
+        return self.tokenizer.decode([int(token_id) for token_id in ids], skip_special_tokens=False)
+
+
+def load_tokenizer(bert_model_type):
+    """TextTokenizer of a local model folder (tokenizer.json or vocab.txt) or a hub model name."""
+    from tokenizers import Tokenizer
+    from tokenizers.implementations import BertWordPieceTokenizer
+
+    if os.path.isdir(bert_model_type):
+        tokenizer_file = os.path.join(bert_model_type, 'tokenizer.json')
+        if os.path.exists(tokenizer_file):
+            return TextTokenizer(Tokenizer.from_file(tokenizer_file))
+        do_lower_case = True
+        config_file = os.path.join(bert_model_type, 'tokenizer_config.json')
+        if os.path.exists(config_file):
+            with open(config_file, 'r', encoding='utf-8') as f:
+                do_lower_case = json.load(f).get('do_lower_case', True)
+        return TextTokenizer(BertWordPieceTokenizer(os.path.join(bert_model_type, 'vocab.txt'),
+                                                    lowercase=do_lower_case)._tokenizer)
+    return TextTokenizer(Tokenizer.from_pretrained(bert_model_type))
+
+
 def create_directory(arguments):
     if not os.path.exists(arguments.log_path):
         os.makedirs(arguments.log_path)
@@ -383,3 +551,48 @@ def combine_lists(list1, list2):
     for index, combo in enumerate(combinations):
         result_dict[combo] = index
     return result_dict, combinations
+
+
+def shard_byte_ranges(file_name, num_shards):
+    """
+    Split a JSONL file into at most num_shards contiguous [start, end) byte ranges, each starting at a line start.
+    Concatenating the shards in order gives back the original line order.
+    """
+    size = os.path.getsize(file_name)
+    boundaries = [0]
+    with open(file_name, 'rb') as f:
+        for shard in range(1, num_shards):
+            f.seek(max(size * shard // num_shards, boundaries[-1]))
+            if f.tell() > 0:
+                f.readline()  # move to the start of the next line
+            boundaries.append(min(f.tell(), size))
+    boundaries.append(size)
+    return [(start, end) for start, end in zip(boundaries[:-1], boundaries[1:]) if end > start]
+
+
+def read_lines_in_range(file_name, start, end):
+    """Yield the decoded lines of file_name that start inside the byte range [start, end)."""
+    with open(file_name, 'rb') as f:
+        f.seek(start)
+        while f.tell() < end:
+            line = f.readline()
+            if not line:
+                break
+            yield line.decode('utf-8')
+
+
+def memory_usage_mb():
+    """
+    (RSS, PSS) of the current process in MB, PSS splits shared pages between the processes mapping them,
+    so the PSS sum over workers is the real memory cost. Linux only, (None, None) elsewhere.
+    """
+    usage = {}
+    try:
+        with open('/proc/self/smaps_rollup', 'r') as f:
+            for line in f:
+                fields = line.split()
+                if fields[0] in ('Rss:', 'Pss:'):
+                    usage[fields[0][:-1]] = int(fields[1]) / 1024.
+    except (OSError, IndexError, ValueError):
+        pass
+    return usage.get('Rss'), usage.get('Pss')
@@ -0,0 +1,278 @@
+import argparse
+import json
+import math
+import os
+from collections import Counter
+from multiprocessing import Pool
+
+import numpy as np
+
+from DataIO import iter_reviews, open_text
+
+# VA scores live in [1, 9], so the largest possible distance between two (V, A) points is sqrt(8^2 + 8^2)
+VA_MIN = 1.0
+VA_MAX = 9.0
+MAX_VA_DISTANCE = math.sqrt(2 * (VA_MAX - VA_MIN) ** 2)
+
+# matched VA pairs are buffered in python lists and folded into the running sums with numpy in chunks
+VA_CHUNK_SIZE = 65536
+
+
+def parser_getting():
+    parser = argparse.ArgumentParser(description='Score subtask_2 / subtask_3 prediction files against gold JSONL')
+    parser.add_argument('--gold', type=str, required=True,
+                        help="Gold JSONL (or Parquet, see DataIO.py) with 'Quadruplet' (or 'Triplet') labels, e.g. ./dataset/zho_laptop_train_alltasks.jsonl")
+    parser.add_argument('--pred', type=str, nargs='+', required=True,
+                        help="One or more prediction JSONL (.jsonl / .jsonl.gz / .jsonl.zst) files, e.g. ./tasks/subtask_3/*.jsonl")
+    parser.add_argument('--task', type=int, default=3, choices=[2, 3],
+                        help="2 → score (Aspect, Opinion) triplets, 3 → score (Aspect, Category, Opinion) quadruplets")
+    parser.add_argument('--workers', type=int, default=1, help="Number of prediction files scored in parallel")
+    parser.add_argument('--only_common_ids', action='store_true',
+                        help="Ignore gold records whose ID never appears in the prediction file (e.g. --limit runs)")
+    parser.add_argument('--output', type=str, default=None, help="Optional JSON file to write all metrics to")
+
+    args = parser.parse_args()
+    return args
+
+
+def normalize_phrase(phrase):
+    # predictions are produced by an uncased tokenizer and have their spaces removed for zho/jpn
+    return "".join(str(phrase).lower().split())
+
+
+def parse_va(va_str):
+    try:
+        valence, arousal = str(va_str).split('#')
+        return float(valence), float(arousal)
+    except (ValueError, TypeError):
+        return None
+
+
+def extract_tuples(record, task):
+    """Return the list of ((aspect, [category,] opinion), va) tuples of one JSONL record."""
+    if 'Quadruplet' in record:
+        items = record['Quadruplet']
+    elif 'Triplet' in record and task == 3:
+        raise ValueError("Record {} only has 'Triplet' labels, it can only be scored with --task 2".format(
+            record.get('ID')))
+    else:
+        # unlabeled records (e.g. *_dev_task3.jsonl) have neither field
+        items = record.get('Triplet', [])
+
+    tuples = []
+    for item in items or []:
+        aspect = normalize_phrase(item.get('Aspect', ''))
+        opinion = normalize_phrase(item.get('Opinion', ''))
+        if task == 3:
+            key = (aspect, str(item.get('Category', '')).upper(), opinion)
+        else:
+            key = (aspect, opinion)
+        tuples.append((key, parse_va(item.get('VA'))))
+    return tuples
+
+
+class ScoreAccumulator:
+    """One-pass accumulator for tuple P/R/F1, continuous F1 and VA error statistics."""
+
+    def __init__(self):
+        self.predict_num = 0
+        self.target_num = 0
+        self.match_num = 0
+        self.continuous_match = 0.
+
+        self.records = 0
+        self.va_pairs = 0
+        # per dimension: mean(p), mean(g), sum((p - mean p)^2), sum((g - mean g)^2), sum((p - mean p)(g - mean g)),
+        # sum((p - g)^2). Centred moments, so Pearson r stays exact over millions of pairs (raw sums cancel out)
+        self.va_stats = np.zeros(6, dtype=np.float64)
+        self.arousal_stats = np.zeros(6, dtype=np.float64)
+
+        self._pred_buffer = []
+        self._gold_buffer = []
+
+    def add_record(self, predict_tuples, target_tuples):
+        self.records += 1
+        self.predict_num += len(predict_tuples)
+        self.target_num += len(target_tuples)
+
+        # multiset matching on the tuple key, gold VA values are consumed in file order
+        gold_va = {}
+        for key, va in target_tuples:
+            gold_va.setdefault(key, []).append(va)
+        remaining = Counter(key for key, _ in target_tuples)
+
+        for key, va in predict_tuples:
+            if remaining[key] <= 0:
+                continue
+            gold = gold_va[key][len(gold_va[key]) - remaining[key]]
+            remaining[key] -= 1
+            self.match_num += 1
+            if va is None or gold is None:
+                continue
+            self._pred_buffer.append(va)
+            self._gold_buffer.append(gold)
+            if len(self._pred_buffer) >= VA_CHUNK_SIZE:
+                self._flush()
+
+    def _flush(self):
+        if not self._pred_buffer:
+            return
+        pred = np.asarray(self._pred_buffer, dtype=np.float64)
+        gold = np.asarray(self._gold_buffer, dtype=np.float64)
+        self._pred_buffer = []
+        self._gold_buffer = []
+
+        distance = np.sqrt(np.sum((np.clip(pred, VA_MIN, VA_MAX) - gold) ** 2, axis=1))
+        self.continuous_match += float(np.sum(1. - distance / MAX_VA_DISTANCE))
+        for column, stats in ((0, self.va_stats), (1, self.arousal_stats)):
+            merge_moments(stats, self.va_pairs, pred[:, column], gold[:, column])
+        self.va_pairs += pred.shape[0]
+
+    def result(self):
+        self._flush()
+        precision = self.match_num / (self.predict_num + 1e-6)
+        recall = self.match_num / (self.target_num + 1e-6)
+        f1 = 2 * precision * recall / (precision + recall + 1e-6)
+        c_precision = self.continuous_match / (self.predict_num + 1e-6)
+        c_recall = self.continuous_match / (self.target_num + 1e-6)
+        c_f1 = 2 * c_precision * c_recall / (c_precision + c_recall + 1e-6)
+        return {
+            'records': self.records,
+            'predict_num': self.predict_num,
+            'target_num': self.target_num,
+            'match_num': self.match_num,
+            'precision': precision,
+            'recall': recall,
+            'f1': f1,
+            'c_precision': c_precision,
+            'c_recall': c_recall,
+            'c_f1': c_f1,
+            'va_pairs': self.va_pairs,
+            'valence_rmse': rmse(self.va_stats, self.va_pairs),
+            'arousal_rmse': rmse(self.arousal_stats, self.va_pairs),
+            'valence_pearson': pearson(self.va_stats, self.va_pairs),
+            'arousal_pearson': pearson(self.arousal_stats, self.va_pairs),
+        }
+
+
+def merge_moments(stats, n, p, g):
+    """
+    Fold one chunk of (p, g) values into the centred statistics of the n pairs seen so far (stats is updated in place).
+    The chunk is centred on its own means and merged with the parallel variance / covariance formula.
+    """
+    m = p.shape[0]
+    if m == 0:
+        return
+    mean_p, mean_g = p.mean(), g.mean()
+    dp, dg = p - mean_p, g - mean_g
+    delta_p, delta_g = mean_p - stats[0], mean_g - stats[1]
+    weight = n * m / (n + m)
+    stats[0] += delta_p * m / (n + m)
+    stats[1] += delta_g * m / (n + m)
+    stats[2] += (dp * dp).sum() + delta_p * delta_p * weight
+    stats[3] += (dg * dg).sum() + delta_g * delta_g * weight
+    stats[4] += (dp * dg).sum() + delta_p * delta_g * weight
+    stats[5] += ((p - g) ** 2).sum()
+
+
+def rmse(stats, n):
+    if n == 0:
+        return None
+    return math.sqrt(stats[5] / n)
+
+
+def pearson(stats, n):
+    if n < 2:
+        return None
+    var_p, var_g, cov = stats[2], stats[3], stats[4]
+    if var_p <= 0 or var_g <= 0:
+        return None
+    return cov / math.sqrt(var_p * var_g)
+
+
+def score_file(gold_file, pred_file, task=3, only_common_ids=False):
+    """
+    Stream a prediction file and a gold file side by side and join them by ID.
+    Files written in the same order are scored with O(1) memory, out-of-order records wait in a
+    pending table until their partner shows up, so memory is bounded by how far the two files drift apart.
+    """
+    accumulator = ScoreAccumulator()
+    pending_pred = {}
+    pending_gold = {}
+
+    gold_iter = iter_reviews(gold_file)
+    pred_iter = iter_reviews(pred_file)
+    gold_done = pred_done = False
+    while not (gold_done and pred_done):
+        if not pred_done:
+            pred = next(pred_iter, None)
+            if pred is None:
+                pred_done = True
+            else:
+                pred_tuples = extract_tuples(pred, task)
+                if pred['ID'] in pending_gold:
+                    accumulator.add_record(pred_tuples, pending_gold.pop(pred['ID']))
+                else:
+                    pending_pred[pred['ID']] = pred_tuples
+        if not gold_done:
+            gold = next(gold_iter, None)
+            if gold is None:
+                gold_done = True
+            else:
+                gold_tuples = extract_tuples(gold, task)
+                if gold['ID'] in pending_pred:
+                    accumulator.add_record(pending_pred.pop(gold['ID']), gold_tuples)
+                else:
+                    pending_gold[gold['ID']] = gold_tuples
+
+    # predictions without gold count as false positives, gold without predictions as misses
+    for pred_tuples in pending_pred.values():
+        accumulator.add_record(pred_tuples, [])
+    if not only_common_ids:
+        for gold_tuples in pending_gold.values():
+            accumulator.add_record([], gold_tuples)
+
+    metrics = accumulator.result()
+    metrics['pred_file'] = pred_file
+    metrics['unmatched_pred_ids'] = len(pending_pred)
+    metrics['unmatched_gold_ids'] = len(pending_gold)
+    return metrics
+
+
+def _score_file_job(job):
+    return score_file(*job)
+
+
+def score_files(gold_file, pred_files, task=3, workers=1, only_common_ids=False):
+    jobs = [(gold_file, pred_file, task, only_common_ids) for pred_file in pred_files]
+    if workers <= 1 or len(jobs) == 1:
+        return [_score_file_job(job) for job in jobs]
+    with Pool(processes=min(workers, len(jobs))) as pool:
+        return pool.map(_score_file_job, jobs)
+
+
+def format_metrics(metrics):
+    def fmt(value):
+        return 'n/a' if value is None else '{:.4f}'.format(value)
+
+    return ('{}\n  P: {}\tR: {}\tF1: {}\tcF1: {}\n  Valence RMSE: {}\tPearson: {}\n'
+            '  Arousal RMSE: {}\tPearson: {}\n  records: {}\tpred/gold/match: {}/{}/{}\tunmatched pred/gold IDs: {}/{}'
+            ).format(metrics['pred_file'], fmt(metrics['precision']), fmt(metrics['recall']), fmt(metrics['f1']),
+                     fmt(metrics['c_f1']), fmt(metrics['valence_rmse']), fmt(metrics['valence_pearson']),
+                     fmt(metrics['arousal_rmse']), fmt(metrics['arousal_pearson']), metrics['records'],
+                     metrics['predict_num'], metrics['target_num'], metrics['match_num'],
+                     metrics['unmatched_pred_ids'], metrics['unmatched_gold_ids'])
+
+
+if __name__ == '__main__':
+    args = parser_getting()
+    all_metrics = score_files(args.gold, args.pred, args.task, args.workers, args.only_common_ids)
+    for metrics in all_metrics:
+        print(format_metrics(metrics))
+
+    if args.output:
+        output_dir = os.path.dirname(args.output)
+        if output_dir and not os.path.exists(output_dir):
+            os.makedirs(output_dir)
+        with open_text(args.output, 'w') as f:
+            json.dump(all_metrics, f, ensure_ascii=False, indent=2)
@@ -2,6 +2,7 @@ import pandas as pd
 import json
 import numpy as np
 import os
+from DataIO import iter_reviews, open_text
 from typing import Dict, Any, Tuple, List, Set
 
 # --- 設定 ---
@@ -13,7 +14,7 @@ PERCENTILES = [0, 25, 50, 75, 100] # Min, Q1, Median, Q3, Max
 # --- 1. 數據提取與緩存函數 ---
 def extract_all_data(file_name: str) -> Tuple[pd.DataFrame, Dict[str, Dict[str, Any]]]:
     """
-    讀取 JSONL 檔案，返回扁平化數據和原始完整記錄的緩存。
+    讀取 JSONL / Parquet 檔案，返回扁平化數據和原始完整記錄的緩存。
     
     返回: (DataFrame of flattened quadruplets, Dict mapping ID to full original record)
     """
@@ -24,33 +25,24 @@ def extract_all_data(file_name: str) -> Tuple[pd.DataFrame, Dict[str, Dict[str,
     records_list = []
     record_cache = {} # 用於儲存完整的原始記錄 (ID, Text, Quadruplet list)
     
-    with open(file_name, 'r', encoding='utf-8') as f:
-        for line in f:
-            line = line.strip()
-            if not line:
-                continue
-            
-            try:
-                data = json.loads(line)
-                record_id = data.get('ID')
-                
-                # 儲存完整的原始記錄到緩存中
-                record_cache[record_id] = data
+    # JSONL (.jsonl / .jsonl.gz / .jsonl.zst) 或 Parquet (DataIO.py) 都可以, 壞掉的 JSON 行直接跳過
+    for data in iter_reviews(file_name, on_error=lambda line: None):
+        record_id = data.get('ID')
+        
+        # 儲存完整的原始記錄到緩存中
+        record_cache[record_id] = data
+        
+        # 扁平化處理每個四元組，用於後續的分數排序和查找
+        for quad in data.get('Quadruplet', []):
+            va_str = quad.get('VA')
+            if va_str and '#' in va_str:
+                valence, arousal = map(float, va_str.split('#'))
                 
-                # 扁平化處理每個四元組，用於後續的分數排序和查找
-                for quad in data.get('Quadruplet', []):
-                    va_str = quad.get('VA')
-                    if va_str and '#' in va_str:
-                        valence, arousal = map(float, va_str.split('#'))
-                        
-                        records_list.append({
-                            'ID': record_id,
-                            'Valence': valence,
-                            'Arousal': arousal
-                        })
-            
-            except json.JSONDecodeError:
-                continue
+                records_list.append({
+                    'ID': record_id,
+                    'Valence': valence,
+                    'Arousal': arousal
+                })
             
     print(f"成功提取 {len(records_list)} 筆四元組，並緩存 {len(record_cache)} 筆原始記錄。")
     return pd.DataFrame(records_list), record_cache
@@ -112,7 +104,7 @@ def get_percentile_examples_and_output(df: pd.DataFrame, record_cache: Dict[str,
     # 5. 寫入 JSONL 檔案 (保持原始格式)
     print(f"\n開始寫入 {score_type} 統計範例 (共 {len(final_records)} 筆，已去重) 至 {output_file}...")
     try:
-        with open(output_file, 'w', encoding='utf-8') as outfile:
+        with open_text(output_file, 'w') as outfile:
             for record in final_records:
                 # 嚴格保持原始資料型式：{"ID": "...", "Text": "...", "Quadruplet": [...]}
                 json_line = json.dumps(record, ensure_ascii=False)
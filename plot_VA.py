@@ -3,6 +3,7 @@ import json
 import matplotlib.pyplot as plt
 import numpy as np
 import os
+from DataIO import is_parquet, read_va_columns, open_text
 
 # --- Configuration ---
 INPUT_FILE = './dataset/zho_restaurant_train_alltasks.jsonl'
@@ -13,16 +14,23 @@ MIN_VAL = 1.0
 MAX_VAL = 9.0
 
 def extract_va_scores(file_name: str) -> pd.DataFrame:
-    """Reads the JSONL file and extracts Valence and Arousal scores from all Quadruplets."""
+    """Reads the JSONL (.jsonl / .jsonl.gz / .jsonl.zst) or Parquet file and extracts Valence and Arousal scores from all Quadruplets."""
     
     if not os.path.exists(file_name):
         print(f"Error: Input file '{file_name}' not found. Please check the file path.")
         return pd.DataFrame()
 
+    if is_parquet(file_name):
+        # Parquet (DataIO.py): only the Valence / Arousal float columns are read
+        print(f"Starting to read file: {file_name}")
+        valence, arousal = read_va_columns(file_name)
+        print(f"Successfully extracted {len(valence)} VA scores.")
+        return pd.DataFrame({'Valence': valence, 'Arousal': arousal})
+
     va_scores = []
     
     print(f"Starting to read file: {file_name}")
-    with open(file_name, 'r', encoding='utf-8') as f:
+    with open_text(file_name) as f:
         for line in f:
             line = line.strip()
             if not line:
@@ -1,39 +1,26 @@
 import argparse
+import io
+import shutil
 import math
 import os
 import json
+import pickle
+import time
 import Utils
-import torch
 import random
-from DimABSAModel import DimABSA
-from torch.nn import functional as F
-from transformers import BertTokenizer, AutoTokenizer
-from transformers.optimization import get_linear_schedule_with_warmup
-from torch.optim import AdamW
 
 from Utils import create_directory, ReviewDataset, generate_batches, InferenceReviewDataset, combine_lists, replace_using_dict
-from DataProcess import dataset_process, dataset_inference_process
-from torch.cuda.amp import autocast, GradScaler
-
-os.environ["HF_ENDPOINT"] = "https://hf-mirror.com"
-
-restaurant_entity_labels = ['RESTAURANT', 'FOOD', 'DRINKS', 'AMBIENCE', 'SERVICE', 'LOCATION']
-restaurant_attribute_labels= ['GENERAL', 'PRICES', 'QUALITY', 'STYLE_OPTIONS', 'MISCELLANEOUS']
-restaurant_category_dict, restaurant_category_list = combine_lists(restaurant_entity_labels, restaurant_attribute_labels)
-
-laptop_entity_labels = ['LAPTOP', 'DISPLAY', 'KEYBOARD', 'MOUSE', 'MOTHERBOARD', 'CPU', 'FANS_COOLING', 'PORTS', 'MEMORY', 'POWER_SUPPLY', 'OPTICAL_DRIVES', 'BATTERY', 'GRAPHICS', 'HARD_DISK', 'MULTIMEDIA_DEVICES', 'HARDWARE', 'SOFTWARE', 'OS', 'WARRANTY', 'SHIPPING', 'SUPPORT', 'COMPANY']+ ['OUT_OF_SCOPE']
-laptop_attribute_labels = ['GENERAL', 'PRICE', 'QUALITY', 'DESIGN_FEATURES', 'OPERATION_PERFORMANCE', 'USABILITY', 'PORTABILITY', 'CONNECTIVITY', 'MISCELLANEOUS']
-laptop_category_dict, laptop_category_list = combine_lists(laptop_entity_labels, laptop_attribute_labels)
+from DataProcess import dataset_process, dataset_inference_process, get_query_templates, review_to_record
+from Categories import category_map
+from PredictionCache import PredictionCache, fingerprint, decoding_settings
+from RecordCache import RecordCache
+import DataIO
 
+# torch / transformers / the model modules take seconds to import: they are imported inside the functions that
+# use them, so --help and --mode preprocess (which never imports torch) start fast. evaluate / inference with
+# --backend onnx never import them either (onnxruntime + the `tokenizers` library only).
 
-hotel_entity_labels = ['HOTEL', 'ROOMS', 'FACILITIES', 'ROOM_AMENITIES', 'SERVICE', 'LOCATION', 'FOOD_DRINKS']
-hotel_attribute_labels = ['GENERAL', 'PRICE', 'COMFORT', 'CLEANLINESS', 'QUALITY', 'DESIGN_FEATURES', 'STYLE_OPTIONS', 'MISCELLANEOUS']
-hotel_category_dict, hotel_category_list = combine_lists(hotel_entity_labels, hotel_attribute_labels)
-
-finance_entity_labels = ['MARKET', 'COMPANY', 'BUSINESS', 'PRODUCT']
-finance_attribute_labels = ['GENERAL', 'SALES', 'PROFIT', 'AMOUNT', 'PRICE', 'COST']
-finance_category_dict, finance_category_list = combine_lists(finance_entity_labels, finance_attribute_labels)
-
+os.environ["HF_ENDPOINT"] = "https://hf-mirror.com"
 
 # # restaurant datasets in english
 # res_en_train_data_path = f"./data/eng_restaurant_train_alltasks.jsonl"
@@ -53,13 +40,6 @@ finance_category_dict, finance_category_list = combine_lists(finance_entity_labe
 #     'lap_zho': (lap_zho_train_data_path, None, lap_zho_test_data_path),
 # }
 
-category_map = {
-    'res': (restaurant_category_dict, restaurant_category_list),
-    'lap': (laptop_category_dict, laptop_category_list),
-    'hot': (hotel_category_dict, hotel_category_list),
-    'fin': (finance_category_dict, finance_category_list),
-}
-
 out_put_file_name_map = {
     'res_eng': "pred_eng_restaurant.jsonl",
     'res_zho': "pred_zho_restaurant.jsonl",
@@ -68,9 +48,6 @@ out_put_file_name_map = {
     'hot_jpn': "pred_jpn_hotel.jsonl",
 }
 
-lap_filter_from_category = ["HARD_DISC", "PRICES","OPERATION&PERFORMANCE","FANS&COOLING", "FANS & COOLING", "FANS_&_COOLING", "HARD DISK", "MULTIMEDIA DEVICES", "POWER SUPPLY", "DESIGN & FEATURES"]
-lap_filter_to_category = ["HARD_DISK", "PRICE", "OPERATION_PERFORMANCE", "FANS_COOLING", "FANS_COOLING", "FANS_COOLING", "HARD_DISK", "MULTIMEDIA_DEVICES", "POWER_SUPPLY", "DESIGN_FEATURES"]
-
 
 def parser_getting():
     parser = argparse.ArgumentParser(description='Bidirectional MRC-based sentiment triplet extraction')
@@ -82,12 +59,16 @@ def parser_getting():
     parser.add_argument('--log_path', type=str, default="./log/")
     parser.add_argument('--save_model_path', type=str, default="./model/")
     parser.add_argument('--output_path', type=str, default="./tasks/")
+    parser.add_argument('--compress_output', type=str, default=None, choices=['gz', 'zst'],
+                        help="write the subtask_2 / subtask_3 predictions as pred_*.jsonl.gz / .jsonl.zst")
     parser.add_argument('--model_name', type=str, default="AOC")
 
     parser.add_argument('--train_data', type=str, default="eng_restaurant_train_alltasks.jsonl")
     parser.add_argument('--infer_data', type=str, default="eng_restaurant_dev_task2.jsonl")
 
-    parser.add_argument('--mode', type=str, default="train", choices=["train", "evaluate", "inference"])
+    parser.add_argument('--mode', type=str, default="train", choices=["train", "evaluate", "inference", "sweep_beta",
+                                                                         "quantize_report", "export_onnx",
+                                                                         "export_inference", "preprocess"])
     parser.add_argument('--max_len', type=str, default="max_len", choices=["max_len"])
     parser.add_argument('--max_aspect_num', type=str, default="max_aspect_num", choices=["max_aspect_num"])
 
@@ -98,6 +79,52 @@ def parser_getting():
     parser.add_argument('--bert_model_type', type=str, default="/home/zhangyou/myhuggingface/bert/bert-base-multilingual-uncased")
     parser.add_argument('--hidden_size', type=int, default=768)
     parser.add_argument('--inference_beta', type=float, default=0.90)
+    # int8 → dynamic int8 quantization of all Linear layers at load time (CPU only)
+    parser.add_argument('--quantize', type=str, default="none", choices=["none", "int8"])
+    parser.add_argument('--save_quantized', action='store_true', help="save the int8 model next to the checkpoint")
+    # export_inference: weights only + metadata, cast to --export_dtype
+    parser.add_argument('--export_dtype', type=str, default="fp16", choices=["fp32", "fp16", "bf16"])
+    # restore from this export_inference artifact instead of the training checkpoint (fp16 / bf16 artifacts are lossy)
+    parser.add_argument('--inference_artifact', type=str, default=None,
+                        help="e.g. ./model/task3_res_eng_infer.safetensors, default: the training checkpoint")
+
+    # preprocess: tokenized QA features of --train_data / --infer_data → pickle, other modes reuse it
+    parser.add_argument('--preprocessed_data', type=str, default=None,
+                        help="pickle written by --mode preprocess (default ./model/preprocessed_task{task}_{domain}_{language}.pkl)")
+
+    # sqlite file of the tokenized training reviews by ID + content hash, only new / changed reviews are processed
+    parser.add_argument('--record_cache', type=str, default=None, help="sqlite file of preprocessed training reviews")
+
+    # inference: sentence-level prediction cache (sqlite file + in-memory LRU), off by default
+    parser.add_argument('--prediction_cache', type=str, default=None, help="sqlite file of cached predictions")
+    parser.add_argument('--cache_memory_size', type=int, default=10000, help="entries in the in-memory LRU")
+    parser.add_argument('--cache_max_entries', type=int, default=1000000, help="rows kept in the sqlite file")
+
+    # onnx → run the graphs written by --mode export_onnx on onnxruntime (CPU) in evaluate / inference
+    parser.add_argument('--backend', type=str, default="torch", choices=["torch", "onnx"])
+    parser.add_argument('--onnx_dir', type=str, default=None)
+    parser.add_argument('--ort_threads', type=int, default=0, help="onnxruntime intra-op threads, 0 = default")
+    # inference mode: split --infer_data into N byte-range shards, one process each
+    parser.add_argument('--num_workers', type=int, default=1)
+    parser.add_argument('--preprocess_workers', type=int, default=1,
+                        help="processes building the QA features of the train / dev / inference lines")
+    # train: read the --train_data shards (a glob) lazily instead of loading the whole corpus, dev split by ID hash
+    parser.add_argument('--streaming', action='store_true')
+    parser.add_argument('--shuffle_buffer', type=int, default=10000, help="--streaming: reviews in the shuffle buffer")
+    parser.add_argument('--dev_percent', type=int, default=20, help="--streaming: percent of the IDs in the dev split")
+    parser.add_argument('--max_dev_reviews', type=int, default=5000, help="--streaming: dev reviews kept in memory")
+    # load the checkpoint once and share the parameter tensors read-only between the --num_workers processes
+    parser.add_argument('--share_weights', action='store_true')
+    # torch.compile the encoder (TorchScript fallback), query lengths padded to --compile_buckets
+    parser.add_argument('--compile', action='store_true')
+    parser.add_argument('--compile_buckets', type=str, default=None,
+                        help="comma separated sequence buckets, default 32,64,96,128,192,256,384,512")
+    # full → always run both A→AO and O→OA, fast → skip O→OA when every forward pair prob >= fast_threshold
+    parser.add_argument('--decode_policy', type=str, default="full", choices=["full", "fast"])
+    parser.add_argument('--fast_threshold', type=float, default=0.95)
+    # sweep_beta mode: beta values to try and where the cached candidate pairs are stored
+    parser.add_argument('--beta_grid', type=str, default="0.5,0.6,0.7,0.8,0.85,0.9,0.95,0.99")
+    parser.add_argument('--candidate_cache', type=str, default=None)
 
     # training hyper-parameter
     parser.add_argument('--gpu', type=bool, default=True)
@@ -109,391 +136,43 @@ def parser_getting():
     parser.add_argument('--beta', type=float, default=1)
 
     args = parser.parse_args()
+    # pairs under inference_beta are dropped by the merge anyway, a lower threshold would skip O→OA on their account
+    if args.decode_policy == 'fast' and args.fast_threshold < args.inference_beta:
+        parser.error('--fast_threshold ({}) must be >= --inference_beta ({})'.format(args.fast_threshold,
+                                                                                    args.inference_beta))
     return args
 
 
+@Utils.no_grad
 def evaluate(args, model, tokenize, batch_generator, test_data, beta, logger, gpu, max_len):
-    model.eval()
-
-    triplet_target_num = 0
-    asp_target_num = 0
-    opi_target_num = 0
-    asp_opi_target_num = 0
-    asp_cate_target_num = 0
-
-    triplet_predict_num = 0
-    asp_predict_num = 0
-    opi_predict_num = 0
-    asp_opi_predict_num = 0
-    asp_cate_predict_num = 0
-
-    triplet_match_num = 0
-    asp_match_num = 0
-    opi_match_num = 0
-    asp_opi_match_num = 0
-    asp_cate_match_num = 0
-
-    with torch.no_grad():
-        for batch_index, batch_dict in enumerate(batch_generator):
-
-            triplets_target = test_data[batch_index].triplet_list
-            asp_target = test_data[batch_index].aspect_list
-            opi_target = test_data[batch_index].opinion_list
-            asp_opi_target = test_data[batch_index].asp_opi_list
-            asp_cate_target = test_data[batch_index].asp_cate_list
-
-            triplets_predict = []
-            asp_predict = []
-            opi_predict = []
-            asp_opi_predict = []
-            asp_cate_predict = []
-
-            forward_pair_list = []
-            backward_pair_list = []
-
-            forward_pair_prob = []
-            backward_pair_prob = []
-
-            forward_pair_ind_list = []
-            backward_pair_ind_list = []
-
-            final_asp_list = []
-            final_opi_list = []
-
-            final_asp_ind_list = []
-            final_opi_ind_list = []
-
-            ok_start_index = batch_dict['forward_asp_answer_start'][0].gt(-1).float().nonzero()
-
-            ok_start_tokens = batch_dict['forward_asp_query'][0][ok_start_index].squeeze(1)
-
-            f_asp_start_scores, f_asp_end_scores = model(batch_dict['forward_asp_query'],
-                                                        batch_dict['forward_asp_query_mask'],
-                                                        batch_dict['forward_asp_query_seg'], 'A')
-
-            f_asp_start_scores = F.softmax(f_asp_start_scores[0], dim=1)
-            f_asp_end_scores = F.softmax(f_asp_end_scores[0], dim=1)
-
-            f_asp_start_prob, f_asp_start_ind = torch.max(f_asp_start_scores, dim=1)
-            f_asp_end_prob, f_asp_end_ind = torch.max(f_asp_end_scores, dim=1)
+    import Cascade
 
-            f_asp_start_prob_temp = []
-            f_asp_end_prob_temp = []
-            f_asp_start_index_temp = []
-            f_asp_end_index_temp = []
-
-            for start_index in range(f_asp_start_ind.size(0)):
-                if batch_dict['forward_asp_answer_start'][0, start_index] != -1:
-                    if f_asp_start_ind[start_index].item() == 1:
-                        f_asp_start_index_temp.append(start_index)
-                        f_asp_start_prob_temp.append(f_asp_start_prob[start_index].item())
-                    if f_asp_end_ind[start_index].item() == 1:
-                        f_asp_end_index_temp.append(start_index)
-                        f_asp_end_prob_temp.append(f_asp_end_prob[start_index].item())
-            f_asp_start_index, f_asp_end_index, f_asp_prob = Utils.filter_unpaired(
-                f_asp_start_prob_temp, f_asp_end_prob_temp, f_asp_start_index_temp, f_asp_end_index_temp, max_len)
-
-            for start_index in range(len(f_asp_start_index)):
-                opinion_query = tokenize.convert_tokens_to_ids(
-                    [word.lower() if word not in ['[CLS]', '[SEP]'] else word for word in
-                    '[CLS] What opinion given the aspect'.split(' ')])
-                for j in range(f_asp_start_index[start_index], f_asp_end_index[start_index] + 1):
-                    opinion_query.append(batch_dict['forward_asp_query'][0][j].item())
-                opinion_query.append(tokenize.convert_tokens_to_ids('?'))
-                opinion_query.append(tokenize.convert_tokens_to_ids('[SEP]'))
-                opinion_query_seg = [0] * len(opinion_query)
-                f_opi_length = len(opinion_query)
-
-                opinion_query = torch.tensor(opinion_query).long()
-                if gpu:
-                    opinion_query = opinion_query.cuda()
-                opinion_query = torch.cat([opinion_query, ok_start_tokens], -1).unsqueeze(0)
-                opinion_query_seg += [1] * ok_start_tokens.size(0)
-                opinion_query_mask = torch.ones(opinion_query.size(1)).float().unsqueeze(0)
-                if gpu:
-                    opinion_query_mask = opinion_query_mask.cuda()
-                opinion_query_seg = torch.tensor(opinion_query_seg).long().unsqueeze(0)
-                if gpu:
-                    opinion_query_seg = opinion_query_seg.cuda()
-
-                f_opi_start_scores, f_opi_end_scores = model(opinion_query, opinion_query_mask, opinion_query_seg, 'AO')
-
-                f_opi_start_scores = F.softmax(f_opi_start_scores[0], dim=1)
-                f_opi_end_scores = F.softmax(f_opi_end_scores[0], dim=1)
-                f_opi_start_prob, f_opi_start_ind = torch.max(f_opi_start_scores, dim=1)
-                f_opi_end_prob, f_opi_end_ind = torch.max(f_opi_end_scores, dim=1)
-
-                f_opi_start_prob_temp = []
-                f_opi_end_prob_temp = []
-                f_opi_start_index_temp = []
-                f_opi_end_index_temp = []
-                for k in range(f_opi_start_ind.size(0)):
-                    if opinion_query_seg[0, k] == 1:
-                        if f_opi_start_ind[k].item() == 1:
-                            f_opi_start_index_temp.append(k)
-                            f_opi_start_prob_temp.append(f_opi_start_prob[k].item())
-                        if f_opi_end_ind[k].item() == 1:
-                            f_opi_end_index_temp.append(k)
-                            f_opi_end_prob_temp.append(f_opi_end_prob[k].item())
-
-                f_opi_start_index, f_opi_end_index, f_opi_prob = Utils.filter_unpaired(
-                    f_opi_start_prob_temp, f_opi_end_prob_temp, f_opi_start_index_temp, f_opi_end_index_temp, max_len)
-
-                for idx in range(len(f_opi_start_index)):
-                    asp = [batch_dict['forward_asp_query'][0][j].item() for j in
-                        range(f_asp_start_index[start_index], f_asp_end_index[start_index] + 1)]
-                    opi = [opinion_query[0][j].item() for j in range(f_opi_start_index[idx], f_opi_end_index[idx] + 1)]
-                    asp_ind = [f_asp_start_index[start_index] - 5, f_asp_end_index[start_index] - 5]
-                    opi_ind = [f_opi_start_index[idx] - f_opi_length, f_opi_end_index[idx] - f_opi_length]
-                    # TODO
-                    temp_prob = math.sqrt(f_asp_prob[start_index] * f_opi_prob[idx])
-                    if asp_ind + opi_ind not in forward_pair_list:
-                        forward_pair_list.append([asp] + [opi])
-                        forward_pair_prob.append(temp_prob)
-                        forward_pair_ind_list.append(asp_ind + opi_ind)
-                    else:
-                        print('error')
-                        exit(1)
-
-            b_opi_start_scores, b_opi_end_scores = model(batch_dict['backward_opi_query'],
-                                                        batch_dict['backward_opi_query_mask'],
-                                                        batch_dict['backward_opi_query_seg'], 'O')
-            b_opi_start_scores = F.softmax(b_opi_start_scores[0], dim=1)
-            b_opi_end_scores = F.softmax(b_opi_end_scores[0], dim=1)
-            b_opi_start_prob, b_opi_start_ind = torch.max(b_opi_start_scores, dim=1)
-            b_opi_end_prob, b_opi_end_ind = torch.max(b_opi_end_scores, dim=1)
-
-            b_opi_start_prob_temp = []
-            b_opi_end_prob_temp = []
-            b_opi_start_index_temp = []
-            b_opi_end_index_temp = []
-            for start_index in range(b_opi_start_ind.size(0)):
-                if batch_dict['backward_opi_answer_start'][0, start_index] != -1:
-                    if b_opi_start_ind[start_index].item() == 1:
-                        b_opi_start_index_temp.append(start_index)
-                        b_opi_start_prob_temp.append(b_opi_start_prob[start_index].item())
-                    if b_opi_end_ind[start_index].item() == 1:
-                        b_opi_end_index_temp.append(start_index)
-                        b_opi_end_prob_temp.append(b_opi_end_prob[start_index].item())
-
-            b_opi_start_index, b_opi_end_index, b_opi_prob = Utils.filter_unpaired(
-                b_opi_start_prob_temp, b_opi_end_prob_temp, b_opi_start_index_temp, b_opi_end_index_temp, max_len)
-
-            for start_index in range(len(b_opi_start_index)):
-                aspect_query = tokenize.convert_tokens_to_ids(
-                    [word.lower() if word not in ['[CLS]', '[SEP]'] else word for word in
-                    '[CLS] What aspect does the opinion'.split(' ')])
-                for j in range(b_opi_start_index[start_index], b_opi_end_index[start_index] + 1):
-                    aspect_query.append(batch_dict['backward_opi_query'][0][j].item())
-                aspect_query.append(tokenize.convert_tokens_to_ids('describe'))
-                aspect_query.append(tokenize.convert_tokens_to_ids('?'))
-                aspect_query.append(tokenize.convert_tokens_to_ids('[SEP]'))
-                aspect_query_seg = [0] * len(aspect_query)
-                b_asp_length = len(aspect_query)
-                aspect_query = torch.tensor(aspect_query).long()
-                if gpu:
-                    aspect_query = aspect_query.cuda()
-                aspect_query = torch.cat([aspect_query, ok_start_tokens], -1).unsqueeze(0)
-                aspect_query_seg += [1] * ok_start_tokens.size(0)
-                aspect_query_mask = torch.ones(aspect_query.size(1)).float().unsqueeze(0)
-                if gpu:
-                    aspect_query_mask = aspect_query_mask.cuda()
-                aspect_query_seg = torch.tensor(aspect_query_seg).long().unsqueeze(0)
-                if gpu:
-                    aspect_query_seg = aspect_query_seg.cuda()
-
-                b_asp_start_scores, b_asp_end_scores = model(aspect_query, aspect_query_mask, aspect_query_seg, 'OA')
-
-                b_asp_start_scores = F.softmax(b_asp_start_scores[0], dim=1)
-                b_asp_end_scores = F.softmax(b_asp_end_scores[0], dim=1)
-                b_asp_start_prob, b_asp_start_ind = torch.max(b_asp_start_scores, dim=1)
-                b_asp_end_prob, b_asp_end_ind = torch.max(b_asp_end_scores, dim=1)
-
-                b_asp_start_prob_temp = []
-                b_asp_end_prob_temp = []
-                b_asp_start_index_temp = []
-                b_asp_end_index_temp = []
-                for k in range(b_asp_start_ind.size(0)):
-                    if aspect_query_seg[0, k] == 1:
-                        if b_asp_start_ind[k].item() == 1:
-                            b_asp_start_index_temp.append(k)
-                            b_asp_start_prob_temp.append(b_asp_start_prob[k].item())
-                        if b_asp_end_ind[k].item() == 1:
-                            b_asp_end_index_temp.append(k)
-                            b_asp_end_prob_temp.append(b_asp_end_prob[k].item())
-
-                b_asp_start_index, b_asp_end_index, b_asp_prob = Utils.filter_unpaired(
-                    b_asp_start_prob_temp, b_asp_end_prob_temp, b_asp_start_index_temp, b_asp_end_index_temp, max_len)
-
-                for idx in range(len(b_asp_start_index)):
-                    opi = [batch_dict['backward_opi_query'][0][j].item() for j in
-                        range(b_opi_start_index[start_index], b_opi_end_index[start_index] + 1)]
-                    asp = [aspect_query[0][j].item() for j in range(b_asp_start_index[idx], b_asp_end_index[idx] + 1)]
-                    asp_ind = [b_asp_start_index[idx] - b_asp_length, b_asp_end_index[idx] - b_asp_length]
-                    opi_ind = [b_opi_start_index[start_index] - 5, b_opi_end_index[start_index] - 5]
-                    # TODO
-                    temp_prob = math.sqrt(b_asp_prob[idx] * b_opi_prob[start_index])
-                    if asp_ind + opi_ind not in backward_pair_ind_list:
-                        backward_pair_list.append([asp] + [opi])
-                        backward_pair_prob.append(temp_prob)
-                        backward_pair_ind_list.append(asp_ind + opi_ind)
-                    else:
-                        print('error')
-                        exit(1)
+    model.eval()
+    head_ids = Cascade.query_head_ids(tokenize)
+    counts = Cascade.new_match_counts()
+    fast_threshold = args.fast_threshold if args.decode_policy == 'fast' else None
+    stats = Cascade.new_decode_stats()
 
-            for idx in range(len(forward_pair_list)):
-                if forward_pair_list[idx] in backward_pair_list or forward_pair_prob[idx] >= beta:
-                    if forward_pair_list[idx][0] not in final_asp_list:
-                        final_asp_list.append(forward_pair_list[idx][0])
-                        final_opi_list.append([forward_pair_list[idx][1]])
-                        final_asp_ind_list.append(forward_pair_ind_list[idx][:2])
-                        final_opi_ind_list.append([forward_pair_ind_list[idx][2:]])
-                    else:
-                        asp_index = final_asp_list.index(forward_pair_list[idx][0])
-                        if forward_pair_list[idx][1] not in final_opi_list[asp_index]:
-                            final_opi_list[asp_index].append(forward_pair_list[idx][1])
-                            final_opi_ind_list[asp_index].append(forward_pair_ind_list[idx][2:])
-            # backward
-            for idx in range(len(backward_pair_list)):
-                if backward_pair_list[idx] not in forward_pair_list:
-                    if backward_pair_prob[idx] >= beta:
-                        if backward_pair_list[idx][0] not in final_asp_list:
-                            final_asp_list.append(backward_pair_list[idx][0])
-                            final_opi_list.append([backward_pair_list[idx][1]])
-                            final_asp_ind_list.append(backward_pair_ind_list[idx][:2])
-                            final_opi_ind_list.append([backward_pair_ind_list[idx][2:]])
-                        else:
-                            asp_index = final_asp_list.index(backward_pair_list[idx][0])
-                            if backward_pair_list[idx][1] not in final_opi_list[asp_index]:
-                                final_opi_list[asp_index].append(backward_pair_list[idx][1])
-                                final_opi_ind_list[asp_index].append(backward_pair_ind_list[idx][2:])
+    for batch_index, batch_dict in enumerate(batch_generator):
+        context_tokens, forward, backward = Cascade.candidate_pairs(model, batch_dict, head_ids, gpu, max_len,
+                                                                    fast_threshold, stats)
+        merged = Cascade.merge_pairs(context_tokens.tolist(), forward, backward, beta)
 
-            # category
-            for idx in range(len(final_asp_list)):
-                predict_opinion_num = len(final_opi_list[idx])
-                for idy in range(predict_opinion_num):
-                    asp_f = []
-                    opi_f = []
-                    asp_f.append(final_asp_ind_list[idx][0])
-                    asp_f.append(final_asp_ind_list[idx][1])
-                    opi_f.append(final_opi_ind_list[idx][idy][0])
-                    opi_f.append(final_opi_ind_list[idx][idy][1])
+        # category only for task 3 when the dataset carries category labels
+        steps = ('C',) if args.task == 3 and 'category_query' in batch_dict else ()
+        predictions = Cascade.sentence_predictions(
+            merged,
+            lambda asp, opi: Cascade.predict_attributes(model, head_ids, asp, opi, context_tokens, gpu, steps,
+                                                        stats),
+            with_va=False)
 
-                    if opi_f not in opi_predict:
-                        opi_predict.append(opi_f)
-                    if asp_f not in asp_predict:
-                        asp_predict.append(asp_f)
-                    if asp_f + opi_f not in asp_opi_predict:
-                        asp_opi_predict.append(asp_f + opi_f)
+        Cascade.update_match_counts(counts, predictions, test_data[batch_index])
 
+        with open('./task1&2_predict.txt', 'a') as f:
+            f.write(f"{predictions['triplet']}\n")
 
-                    if args.task == 3 and 'category_query' in batch_dict:
-                        category_query = tokenize.convert_tokens_to_ids(
-                            [word.lower() if word not in ['[CLS]', '[SEP]'] else word for word in
-                            '[CLS] What category given the aspect'.split(' ')])
-                        category_query += final_asp_list[idx]
-                        category_query += tokenize.convert_tokens_to_ids(
-                            [word.lower() for word in 'and the opinion'.split(' ')])
-                        category_query += final_opi_list[idx][idy]
-                        category_query.append(tokenize.convert_tokens_to_ids('?'))
-                        category_query.append(tokenize.convert_tokens_to_ids('[SEP]'))
-
-                        category_query_seg = [0] * len(category_query)
-                        category_query = torch.tensor(category_query).long()
-                        if gpu:
-                            category_query = category_query.cuda()
-                        category_query = torch.cat([category_query, ok_start_tokens], -1).unsqueeze(0)
-                        category_query_seg += [1] * ok_start_tokens.size(0)
-                        category_query_mask = torch.ones(category_query.size(1)).float().unsqueeze(0)
-                        if gpu:
-                            category_query_mask = category_query_mask.cuda()
-                        category_query_seg = torch.tensor(category_query_seg).long().unsqueeze(0)
-                        if gpu:
-                            category_query_seg = category_query_seg.cuda()
-
-                        category_scores = model(category_query, category_query_mask, category_query_seg, 'C')
-                        category_predicted = torch.argmax(category_scores[0], dim=0).item()
-                        if asp_f + [category_predicted] not in asp_cate_predict:
-                            asp_cate_predict.append(asp_f + [category_predicted])
-                        triplet_predict = asp_f + opi_f + [category_predicted]
-                        if triplet_predict not in triplets_predict:
-                            triplets_predict.append(triplet_predict)
-                    else:
-                        category_predicted = None
-                        if asp_f + [category_predicted] not in asp_cate_predict:
-                            asp_cate_predict.append(asp_f + [category_predicted])
-                        triplet_predict = asp_f + opi_f + [category_predicted]
-                        if triplet_predict not in triplets_predict:
-                            triplets_predict.append(triplet_predict)
-
-            triplet_target_num += len(triplets_target)
-            asp_target_num += len(asp_target)
-            opi_target_num += len(opi_target)
-            asp_opi_target_num += len(asp_opi_target)
-            asp_cate_target_num += len(asp_cate_target)
-
-            triplet_predict_num += len(triplets_predict)
-            asp_predict_num += len(asp_predict)
-            opi_predict_num += len(opi_predict)
-            asp_opi_predict_num += len(asp_opi_predict)
-            asp_cate_predict_num += len(asp_cate_predict)
-
-            for trip in triplets_predict:
-                for trip_ in triplets_target:
-                    if trip_ == trip:
-                        triplet_match_num += 1
-
-            with open('./task1&2_predict.txt', 'a') as f:
-                f.write(f"{triplets_predict}\n")
-
-            for trip in asp_predict:
-                for trip_ in asp_target:
-                    if trip_ == trip:
-                        asp_match_num += 1
-            for trip in opi_predict:
-                for trip_ in opi_target:
-                    if trip_ == trip:
-                        opi_match_num += 1
-            for trip in asp_opi_predict:
-                for trip_ in asp_opi_target:
-                    if trip_ == trip:
-                        asp_opi_match_num += 1
-            for trip in asp_cate_predict:
-                for trip_ in asp_cate_target:
-                    if trip_ == trip:
-                        asp_cate_match_num += 1
-
-    precision = float(triplet_match_num) / float(triplet_predict_num + 1e-6)
-    recall = float(triplet_match_num) / float(triplet_target_num + 1e-6)
-    f1 = 2 * precision * recall / (precision + recall + 1e-6)
-    logger.info('Triplet - Precision: {}\tRecall: {}\tF1: {}'.format(precision, recall, f1))
-
-    precision_aspect = float(asp_match_num) / float(asp_predict_num + 1e-6)
-    recall_aspect = float(asp_match_num) / float(asp_target_num + 1e-6)
-    f1_aspect = 2 * precision_aspect * recall_aspect / (precision_aspect + recall_aspect + 1e-6)
-    logger.info('Aspect - Precision: {}\tRecall: {}\tF1: {}'.format(precision_aspect, recall_aspect, f1_aspect))
-
-    precision_opinion = float(opi_match_num) / float(opi_predict_num + 1e-6)
-    recall_opinion = float(opi_match_num) / float(opi_target_num + 1e-6)
-    f1_opinion = 2 * precision_opinion * recall_opinion / (precision_opinion + recall_opinion + 1e-6)
-    logger.info('Opinion - Precision: {}\tRecall: {}\tF1: {}'.format(precision_opinion, recall_opinion, f1_opinion))
-
-    precision_aspect_category = float(asp_cate_match_num) / float(asp_cate_predict_num + 1e-6)
-    recall_aspect_category = float(asp_cate_match_num) / float(asp_cate_target_num + 1e-6)
-    f1_aspect_category = 2 * precision_aspect_category * recall_aspect_category / (
-            precision_aspect_category + recall_aspect_category + 1e-6)
-    logger.info('Aspect-Category - Precision: {}\tRecall: {}\tF1: {}'.format(precision_aspect_category,
-                                                                             recall_aspect_category,
-                                                                             f1_aspect_category))
-
-    precision_aspect_opinion = float(asp_opi_match_num) / float(asp_opi_predict_num + 1e-6)
-    recall_aspect_opinion = float(asp_opi_match_num) / float(asp_opi_target_num + 1e-6)
-    f1_aspect_opinion = 2 * precision_aspect_opinion * recall_aspect_opinion / (
-            precision_aspect_opinion + recall_aspect_opinion + 1e-6)
-    logger.info(
-        'Aspect-Opinion - Precision: {}\tRecall: {}\tF1: {}'.format(precision_aspect_opinion, recall_aspect_opinion,
-                                                                    f1_aspect_opinion))
-    return f1
+    Cascade.log_decode_stats(stats, logger)
+    return Cascade.log_match_counts(counts, logger)
 """
 with torch.no_grad():
     def inference(args, model, tokenize, batch_generator, beta, logger, gpu, max_len, category_mapping):
@@ -906,12 +585,26 @@ with torch.no_grad():
                     json_str = json.dumps(item, ensure_ascii=False)
                     f.write(json_str + '\n')
 """
-@torch.no_grad()
-def inference(args, model, tokenize, batch_generator, beta, logger, gpu, max_len, category_mapping):
+def output_file_name(args, subtask_dir, shard=None):
+    file_name = args.output_path + subtask_dir + out_put_file_name_map[args.domain + '_' + args.language]
+    if shard is not None:
+        file_name += '.shard' + str(shard)
+    return DataIO.compressed_name(file_name, args.compress_output)
+
+
+@Utils.no_grad
+def inference(args, model, tokenize, batch_generator, beta, logger, gpu, max_len, category_mapping, shard=None,
+              cache=None):
+    import Cascade
+
     # 把類別 index -> 類別名稱 的 list 準備好
     ids_to_categories = [key for key, value in sorted(category_mapping.items(), key=lambda item: item[1])]
 
     model.eval()
+    head_ids = Cascade.query_head_ids(tokenize)
+    steps = ('C', 'Valence', 'Arousal') if args.task == 3 else ('Valence', 'Arousal')
+    fast_threshold = args.fast_threshold if args.decode_policy == 'fast' else None
+    stats = Cascade.new_decode_stats()
     output_data_triple = []
     output_data_quadra = []
 
@@ -924,400 +617,31 @@ def inference(args, model, tokenize, batch_generator, beta, logger, gpu, max_len
         if batch_index < 5:
             print(f"[DEBUG D0] batch_index={batch_index}, ID={batch_dict['id'][0]}")
 
-        dump_data_triple = {
-            "ID": batch_dict['id'][0],
-            "Triplet": [],
-        }
-        dump_data_quadra = {
-            "ID": batch_dict['id'][0],
-            "Quadruplet": [],
-        }
-
-        triplets_predict = []
-        asp_predict = []
-        opi_predict = []
-        asp_opi_predict = []
-        asp_cate_predict = []
-
-        forward_pair_list = []
-        backward_pair_list = []
-
-        forward_pair_prob = []
-        backward_pair_prob = []
-
-        forward_pair_ind_list = []
-        backward_pair_ind_list = []
-
-        final_asp_list = []
-        final_opi_list = []
-
-        final_asp_ind_list = []
-        final_opi_ind_list = []
-
-        ok_start_index = batch_dict['forward_asp_answer_start'][0].gt(-1).float().nonzero()
-        ok_start_tokens = batch_dict['forward_asp_query'][0][ok_start_index].squeeze(1)
-
-        # ========= forward aspect =========
-        f_asp_start_scores, f_asp_end_scores = model(
-            batch_dict['forward_asp_query'],
-            batch_dict['forward_asp_query_mask'],
-            batch_dict['forward_asp_query_seg'],
-            'A'
-        )
-
-        f_asp_start_scores = F.softmax(f_asp_start_scores[0], dim=1)
-        f_asp_end_scores = F.softmax(f_asp_end_scores[0], dim=1)
-
-        f_asp_start_prob, f_asp_start_ind = torch.max(f_asp_start_scores, dim=1)
-        f_asp_end_prob, f_asp_end_ind = torch.max(f_asp_end_scores, dim=1)
-
-        f_asp_start_prob_temp = []
-        f_asp_end_prob_temp = []
-        f_asp_start_index_temp = []
-        f_asp_end_index_temp = []
-
-        for start_index in range(f_asp_start_ind.size(0)):
-            if batch_dict['forward_asp_answer_start'][0, start_index] != -1:
-                if f_asp_start_ind[start_index].item() == 1:
-                    f_asp_start_index_temp.append(start_index)
-                    f_asp_start_prob_temp.append(f_asp_start_prob[start_index].item())
-                if f_asp_end_ind[start_index].item() == 1:
-                    f_asp_end_index_temp.append(start_index)
-                    f_asp_end_prob_temp.append(f_asp_end_prob[start_index].item())
-
-        f_asp_start_index, f_asp_end_index, f_asp_prob = Utils.filter_unpaired(
-            f_asp_start_prob_temp, f_asp_end_prob_temp,
-            f_asp_start_index_temp, f_asp_end_index_temp, max_len
-        )
-
-        # ========= forward AO (opinion given aspect) =========
-        for start_index in range(len(f_asp_start_index)):
-            opinion_query = tokenize.convert_tokens_to_ids(
-                [w.lower() if w not in ['[CLS]', '[SEP]'] else w
-                 for w in '[CLS] What opinion given the aspect'.split(' ')]
-            )
-            for j in range(f_asp_start_index[start_index], f_asp_end_index[start_index] + 1):
-                opinion_query.append(batch_dict['forward_asp_query'][0][j].item())
-            opinion_query.append(tokenize.convert_tokens_to_ids('?'))
-            opinion_query.append(tokenize.convert_tokens_to_ids('[SEP]'))
-
-            opinion_query_seg = [0] * len(opinion_query)
-            f_opi_length = len(opinion_query)
-
-            opinion_query = torch.tensor(opinion_query).long()
-            if gpu:
-                opinion_query = opinion_query.cuda()
-            opinion_query = torch.cat([opinion_query, ok_start_tokens], -1).unsqueeze(0)
-            opinion_query_seg += [1] * ok_start_tokens.size(0)
-            opinion_query_mask = torch.ones(opinion_query.size(1)).float().unsqueeze(0)
-            if gpu:
-                opinion_query_mask = opinion_query_mask.cuda()
-            opinion_query_seg = torch.tensor(opinion_query_seg).long().unsqueeze(0)
-            if gpu:
-                opinion_query_seg = opinion_query_seg.cuda()
-
-            f_opi_start_scores, f_opi_end_scores = model(
-                opinion_query, opinion_query_mask, opinion_query_seg, 'AO'
-            )
-
-            f_opi_start_scores = F.softmax(f_opi_start_scores[0], dim=1)
-            f_opi_end_scores = F.softmax(f_opi_end_scores[0], dim=1)
-            f_opi_start_prob, f_opi_start_ind = torch.max(f_opi_start_scores, dim=1)
-            f_opi_end_prob, f_opi_end_ind = torch.max(f_opi_end_scores, dim=1)
-
-            f_opi_start_prob_temp = []
-            f_opi_end_prob_temp = []
-            f_opi_start_index_temp = []
-            f_opi_end_index_temp = []
-
-            for k in range(f_opi_start_ind.size(0)):
-                if opinion_query_seg[0, k] == 1:
-                    if f_opi_start_ind[k].item() == 1:
-                        f_opi_start_index_temp.append(k)
-                        f_opi_start_prob_temp.append(f_opi_start_prob[k].item())
-                    if f_opi_end_ind[k].item() == 1:
-                        f_opi_end_index_temp.append(k)
-                        f_opi_end_prob_temp.append(f_opi_end_prob[k].item())
-
-            f_opi_start_index, f_opi_end_index, f_opi_prob = Utils.filter_unpaired(
-                f_opi_start_prob_temp, f_opi_end_prob_temp,
-                f_opi_start_index_temp, f_opi_end_index_temp, max_len
-            )
-
-            for idx in range(len(f_opi_start_index)):
-                asp = [batch_dict['forward_asp_query'][0][j].item()
-                       for j in range(f_asp_start_index[start_index], f_asp_end_index[start_index] + 1)]
-                opi = [opinion_query[0][j].item()
-                       for j in range(f_opi_start_index[idx], f_opi_end_index[idx] + 1)]
-                asp_ind = [f_asp_start_index[start_index] - 5, f_asp_end_index[start_index] - 5]
-                opi_ind = [f_opi_start_index[idx] - f_opi_length, f_opi_end_index[idx] - f_opi_length]
-                temp_prob = math.sqrt(f_asp_prob[start_index] * f_opi_prob[idx])
-                if asp_ind + opi_ind not in forward_pair_ind_list:
-                    forward_pair_list.append([asp] + [opi])
-                    forward_pair_prob.append(temp_prob)
-                    forward_pair_ind_list.append(asp_ind + opi_ind)
-
-        # ========= backward opinion =========
-        b_opi_start_scores, b_opi_end_scores = model(
-            batch_dict['backward_opi_query'],
-            batch_dict['backward_opi_query_mask'],
-            batch_dict['backward_opi_query_seg'],
-            'O'
-        )
-        b_opi_start_scores = F.softmax(b_opi_start_scores[0], dim=1)
-        b_opi_end_scores = F.softmax(b_opi_end_scores[0], dim=1)
-        b_opi_start_prob, b_opi_start_ind = torch.max(b_opi_start_scores, dim=1)
-        b_opi_end_prob, b_opi_end_ind = torch.max(b_opi_end_scores, dim=1)
-
-        b_opi_start_prob_temp = []
-        b_opi_end_prob_temp = []
-        b_opi_start_index_temp = []
-        b_opi_end_index_temp = []
-
-        for start_index in range(b_opi_start_ind.size(0)):
-            if batch_dict['backward_opi_answer_start'][0, start_index] != -1:
-                if b_opi_start_ind[start_index].item() == 1:
-                    b_opi_start_index_temp.append(start_index)
-                    b_opi_start_prob_temp.append(b_opi_start_prob[start_index].item())
-                if b_opi_end_ind[start_index].item() == 1:
-                    b_opi_end_index_temp.append(start_index)
-                    b_opi_end_prob_temp.append(b_opi_end_prob[start_index].item())
-
-        b_opi_start_index, b_opi_end_index, b_opi_prob = Utils.filter_unpaired(
-            b_opi_start_prob_temp, b_opi_end_prob_temp,
-            b_opi_start_index_temp, b_opi_end_index_temp, max_len
-        )
-
-        # ========= backward OA (aspect given opinion) =========
-        for start_index in range(len(b_opi_start_index)):
-            aspect_query = tokenize.convert_tokens_to_ids(
-                [w.lower() if w not in ['[CLS]', '[SEP]'] else w
-                 for w in '[CLS] What aspect does the opinion'.split(' ')]
-            )
-            for j in range(b_opi_start_index[start_index], b_opi_end_index[start_index] + 1):
-                aspect_query.append(batch_dict['backward_opi_query'][0][j].item())
-            aspect_query.append(tokenize.convert_tokens_to_ids('describe'))
-            aspect_query.append(tokenize.convert_tokens_to_ids('?'))
-            aspect_query.append(tokenize.convert_tokens_to_ids('[SEP]'))
-
-            aspect_query_seg = [0] * len(aspect_query)
-            b_asp_length = len(aspect_query)
-
-            aspect_query = torch.tensor(aspect_query).long()
-            if gpu:
-                aspect_query = aspect_query.cuda()
-            aspect_query = torch.cat([aspect_query, ok_start_tokens], -1).unsqueeze(0)
-            aspect_query_seg += [1] * ok_start_tokens.size(0)
-            aspect_query_mask = torch.ones(aspect_query.size(1)).float().unsqueeze(0)
-            if gpu:
-                aspect_query_mask = aspect_query_mask.cuda()
-            aspect_query_seg = torch.tensor(aspect_query_seg).long().unsqueeze(0)
-            if gpu:
-                aspect_query_seg = aspect_query_seg.cuda()
-
-            b_asp_start_scores, b_asp_end_scores = model(
-                aspect_query, aspect_query_mask, aspect_query_seg, 'OA'
-            )
-
-            b_asp_start_scores = F.softmax(b_asp_start_scores[0], dim=1)
-            b_asp_end_scores = F.softmax(b_asp_end_scores[0], dim=1)
-            b_asp_start_prob, b_asp_start_ind = torch.max(b_asp_start_scores, dim=1)
-            b_asp_end_prob, b_asp_end_ind = torch.max(b_asp_end_scores, dim=1)
-
-            b_asp_start_prob_temp = []
-            b_asp_end_prob_temp = []
-            b_asp_start_index_temp = []
-            b_asp_end_index_temp = []
-
-            for k in range(b_asp_start_ind.size(0)):
-                if aspect_query_seg[0, k] == 1:
-                    if b_asp_start_ind[k].item() == 1:
-                        b_asp_start_index_temp.append(k)
-                        b_asp_start_prob_temp.append(b_asp_start_prob[k].item())
-                    if b_asp_end_ind[k].item() == 1:
-                        b_asp_end_index_temp.append(k)
-                        b_asp_end_prob_temp.append(b_asp_end_prob[k].item())
-
-            b_asp_start_index, b_asp_end_index, b_asp_prob = Utils.filter_unpaired(
-                b_asp_start_prob_temp, b_asp_end_prob_temp,
-                b_asp_start_index_temp, b_asp_end_index_temp, max_len
-            )
-
-            for idx in range(len(b_asp_start_index)):
-                opi = [batch_dict['backward_opi_query'][0][j].item()
-                       for j in range(b_opi_start_index[start_index], b_opi_end_index[start_index] + 1)]
-                asp = [aspect_query[0][j].item()
-                       for j in range(b_asp_start_index[idx], b_asp_end_index[idx] + 1)]
-                asp_ind = [b_asp_start_index[idx] - b_asp_length, b_asp_end_index[idx] - b_asp_length]
-                opi_ind = [b_opi_start_index[start_index] - 5, b_opi_end_index[start_index] - 5]
-                temp_prob = math.sqrt(b_asp_prob[idx] * b_opi_prob[start_index])
-                if asp_ind + opi_ind not in backward_pair_ind_list:
-                    backward_pair_list.append([asp] + [opi])
-                    backward_pair_prob.append(temp_prob)
-                    backward_pair_ind_list.append(asp_ind + opi_ind)
-
-        # ========= merge forward & backward =========
-        for idx in range(len(forward_pair_list)):
-            if forward_pair_list[idx] in backward_pair_list or forward_pair_prob[idx] >= beta:
-                if forward_pair_list[idx][0] not in final_asp_list:
-                    final_asp_list.append(forward_pair_list[idx][0])
-                    final_opi_list.append([forward_pair_list[idx][1]])
-                    final_asp_ind_list.append(forward_pair_ind_list[idx][:2])
-                    final_opi_ind_list.append([forward_pair_ind_list[idx][2:]])
-                else:
-                    asp_index = final_asp_list.index(forward_pair_list[idx][0])
-                    if forward_pair_list[idx][1] not in final_opi_list[asp_index]:
-                        final_opi_list[asp_index].append(forward_pair_list[idx][1])
-                        final_opi_ind_list[asp_index].append(forward_pair_ind_list[idx][2:])
-
-        for idx in range(len(backward_pair_list)):
-            if backward_pair_list[idx] not in forward_pair_list:
-                if backward_pair_prob[idx] >= beta:
-                    if backward_pair_list[idx][0] not in final_asp_list:
-                        final_asp_list.append(backward_pair_list[idx][0])
-                        final_opi_list.append([backward_pair_list[idx][1]])
-                        final_asp_ind_list.append(backward_pair_ind_list[idx][:2])
-                        final_opi_ind_list.append([backward_pair_ind_list[idx][2:]])
-                    else:
-                        asp_index = final_asp_list.index(backward_pair_list[idx][0])
-                        if backward_pair_list[idx][1] not in final_opi_list[asp_index]:
-                            final_opi_list[asp_index].append(backward_pair_list[idx][1])
-                            final_opi_ind_list[asp_index].append(backward_pair_ind_list[idx][2:])
-
-        # ========= category / valence / arousal =========
-        for idx in range(len(final_asp_list)):
-            predict_opinion_num = len(final_opi_list[idx])
-            for idy in range(predict_opinion_num):
-
-                # ----- category -----
-                if args.task == 3:
-                    category_query = tokenize.convert_tokens_to_ids(
-                        [w.lower() if w not in ['[CLS]', '[SEP]'] else w
-                         for w in '[CLS] What category given the aspect'.split(' ')]
-                    )
-                    category_query += final_asp_list[idx]
-                    category_query += tokenize.convert_tokens_to_ids(
-                        [w.lower() for w in 'and the opinion'.split(' ')]
-                    )
-                    category_query += final_opi_list[idx][idy]
-                    category_query.append(tokenize.convert_tokens_to_ids('?'))
-                    category_query.append(tokenize.convert_tokens_to_ids('[SEP]'))
-
-                    category_query_seg = [0] * len(category_query)
-                    category_query = torch.tensor(category_query).long()
-                    if gpu:
-                        category_query = category_query.cuda()
-                    category_query = torch.cat([category_query, ok_start_tokens], -1).unsqueeze(0)
-                    category_query_seg += [1] * ok_start_tokens.size(0)
-                    category_query_mask = torch.ones(category_query.size(1)).float().unsqueeze(0)
-                    if gpu:
-                        category_query_mask = category_query_mask.cuda()
-                    category_query_seg = torch.tensor(category_query_seg).long().unsqueeze(0)
-                    if gpu:
-                        category_query_seg = category_query_seg.cuda()
-
-                    category_scores = model(category_query, category_query_mask, category_query_seg, 'C')
-                    category_predicted = torch.argmax(category_scores[0], dim=0).item()
-                else:
-                    category_predicted = None
-
-                # ----- valence -----
-                valence_query = tokenize.convert_tokens_to_ids(
-                    [w.lower() if w not in ['[CLS]', '[SEP]'] else w
-                     for w in '[CLS] What valence given the aspect'.split(' ')]
-                )
-                valence_query += final_asp_list[idx]
-                valence_query += tokenize.convert_tokens_to_ids(
-                    [w.lower() for w in 'and the opinion'.split(' ')]
-                )
-                valence_query += final_opi_list[idx][idy]
-                valence_query.append(tokenize.convert_tokens_to_ids('?'))
-                valence_query.append(tokenize.convert_tokens_to_ids('[SEP]'))
-
-                valence_query_seg = [0] * len(valence_query)
-                valence_query = torch.tensor(valence_query).long()
-                if gpu:
-                    valence_query = valence_query.cuda()
-                valence_query = torch.cat([valence_query, ok_start_tokens], -1).unsqueeze(0)
-                valence_query_seg += [1] * ok_start_tokens.size(0)
-                valence_query_mask = torch.ones(valence_query.size(1)).float().unsqueeze(0)
-                if gpu:
-                    valence_query_mask = valence_query_mask.cuda()
-                valence_query_seg = torch.tensor(valence_query_seg).long().unsqueeze(0)
-                if gpu:
-                    valence_query_seg = valence_query_seg.cuda()
-
-                valence_scores = model(valence_query, valence_query_mask, valence_query_seg, 'Valence')
-
-                # ----- arousal -----
-                arousal_query = tokenize.convert_tokens_to_ids(
-                    [w.lower() if w not in ['[CLS]', '[SEP]'] else w
-                     for w in '[CLS] What arousal given the aspect'.split(' ')]
-                )
-                arousal_query += final_asp_list[idx]
-                arousal_query += tokenize.convert_tokens_to_ids(
-                    [w.lower() for w in 'and the opinion'.split(' ')]
-                )
-                arousal_query += final_opi_list[idx][idy]
-                arousal_query.append(tokenize.convert_tokens_to_ids('?'))
-                arousal_query.append(tokenize.convert_tokens_to_ids('[SEP]'))
-
-                arousal_query_seg = [0] * len(arousal_query)
-                arousal_query = torch.tensor(arousal_query).long()
-                if gpu:
-                    arousal_query = arousal_query.cuda()
-                arousal_query = torch.cat([arousal_query, ok_start_tokens], -1).unsqueeze(0)
-                arousal_query_seg += [1] * ok_start_tokens.size(0)
-                arousal_query_mask = torch.ones(arousal_query.size(1)).float().unsqueeze(0)
-                if gpu:
-                    arousal_query_mask = arousal_query_mask.cuda()
-                arousal_query_seg = torch.tensor(arousal_query_seg).long().unsqueeze(0)
-                if gpu:
-                    arousal_query_seg = arousal_query_seg.cuda()
-
-                arousal_scores = model(arousal_query, arousal_query_mask, arousal_query_seg, 'Arousal')
-
-                # ----- collect indices -----
-                asp_f = [final_asp_ind_list[idx][0], final_asp_ind_list[idx][1]]
-                opi_f = [final_opi_ind_list[idx][idy][0], final_opi_ind_list[idx][idy][1]]
-
-                if opi_f not in opi_predict:
-                    opi_predict.append(opi_f)
-                if asp_f + opi_f not in asp_opi_predict:
-                    asp_opi_predict.append(asp_f + opi_f)
-                if asp_f + [category_predicted] not in asp_cate_predict:
-                    asp_cate_predict.append(asp_f + [category_predicted])
-                if asp_f not in asp_predict:
-                    asp_predict.append(asp_f)
-
-                triplet_predict = asp_f + opi_f + [category_predicted] + \
-                                  [str(round(valence_scores.item(), 2))] + \
-                                  [str(round(arousal_scores.item(), 2))]
-                if triplet_predict not in triplets_predict:
-                    triplets_predict.append(triplet_predict)
-
-        # ========= 把這個 batch 的結果轉回文字 & 存進 output list =========
         word_list_ids = batch_dict['forward_asp_query'][0][5:]
+        # 相同的句子 (token ids) 直接用 cache 的結果，重複的句子只算一次
+        cache_key = cache.key(word_list_ids.tolist()) if cache is not None else None
+        triplets_predict = cache.get(cache_key) if cache is not None else None
+
+        if triplets_predict is None:
+            context_tokens, forward, backward = Cascade.candidate_pairs(model, batch_dict, head_ids, gpu, max_len,
+                                                                        fast_threshold, stats)
+            merged = Cascade.merge_pairs(context_tokens.tolist(), forward, backward, beta)
+
+            # ========= category / valence / arousal =========
+            predictions = Cascade.sentence_predictions(
+                merged,
+                lambda asp, opi: Cascade.predict_attributes(model, head_ids, asp, opi, context_tokens, gpu, steps,
+                                                            stats),
+                with_va=True)
+            triplets_predict = predictions['triplet']
+            if cache is not None:
+                cache.put(cache_key, triplets_predict)
 
-        for triplet in triplets_predict:
-            meta_triplet = {}
-            meta_triplet["Aspect"] = tokenize.decode(word_list_ids[triplet[0]:triplet[1] + 1])
-            meta_triplet["Opinion"] = tokenize.decode(word_list_ids[triplet[2]:triplet[3] + 1])
-            meta_triplet["VA"] = triplet[5] + "#" + triplet[6]
-
-            if args.language in ['zho', 'jpn']:
-                meta_triplet["Aspect"] = meta_triplet["Aspect"].replace(" ", "")
-                meta_triplet["Opinion"] = meta_triplet["Opinion"].replace(" ", "")
-
-            dump_data_triple['Triplet'].append(meta_triplet)
-
-            if args.task == 3:
-                meta_quadra = {}
-                meta_quadra["Aspect"] = meta_triplet["Aspect"]
-                meta_quadra["Opinion"] = meta_triplet["Opinion"]
-                meta_quadra["VA"] = meta_triplet["VA"]
-                meta_quadra["Category"] = ids_to_categories[triplet[4]]
-                dump_data_quadra['Quadruplet'].append(meta_quadra)
+        # ========= 把這個 batch 的結果轉回文字 & 存進 output list =========
+        offsets = batch_dict['offsets'][0].tolist() if 'offsets' in batch_dict else None
+        dump_data_triple, dump_data_quadra = Cascade.prediction_records(
+            batch_dict['id'][0], word_list_ids, triplets_predict, tokenize, args.language, args.task, ids_to_categories,
+            batch_dict['line'][0], offsets)
 
         output_data_triple.append(dump_data_triple)
         output_data_quadra.append(dump_data_quadra)
@@ -1325,30 +649,456 @@ def inference(args, model, tokenize, batch_generator, beta, logger, gpu, max_len
     # ===== 所有 batch 跑完後，再一次性寫檔 =====
     print(f"[DEBUG D2] inference finished: batch_count={batch_count}, "
           f"triples={len(output_data_triple)}, quadras={len(output_data_quadra)}")
+    Cascade.log_decode_stats(stats, logger)
+    if cache is not None:
+        cache.flush()
+        cache.log_summary(logger)
 
-    out_put_file_task2_name = args.output_path + "subtask_2/" + \
-                              out_put_file_name_map[args.domain + '_' + args.language]
-    with open(out_put_file_task2_name, 'w', encoding='utf-8') as f:
+    out_put_file_task2_name = output_file_name(args, "subtask_2/", shard)
+    with DataIO.open_text(out_put_file_task2_name, 'w') as f:
         for item in output_data_triple:
             json_str = json.dumps(item, ensure_ascii=False)
             f.write(json_str + '\n')
 
     if args.task == 3:
-        out_put_file_task3_name = args.output_path + "subtask_3/" + \
-                                  out_put_file_name_map[args.domain + '_' + args.language]
-        with open(out_put_file_task3_name, 'w', encoding='utf-8') as f:
+        out_put_file_task3_name = output_file_name(args, "subtask_3/", shard)
+        with DataIO.open_text(out_put_file_task3_name, 'w') as f:
             for item in output_data_quadra:
                 json_str = json.dumps(item, ensure_ascii=False)
                 f.write(json_str + '\n')
 
 
+def sweep_beta(args, model, tokenize, batch_generator, test_data, logger, gpu, max_len, model_path):
+    """
+    Grid search over inference_beta on the dev split.
+    The encoder runs once: candidate pairs of both directions (with their probs) and the category / VA heads
+    of every candidate are stored in args.candidate_cache, each beta then only re-runs merge and scoring.
+    """
+    import torch
+    import Cascade
+
+    beta_grid = [float(beta) for beta in args.beta_grid.split(',')]
+    cache_path = args.candidate_cache or \
+        args.save_model_path + 'candidates_task' + str(args.task) + '_' + args.domain + '_' + args.language + '.npz'
+    # the dev split comes from --train_data: like preprocess_key, any change of its file(s) invalidates the cache
+    if args.streaming:
+        from StreamingData import train_shard_paths
+        train_paths = train_shard_paths(args)
+    else:
+        train_paths = [args.data_path + args.train_data]
+    model_path = weights_path(args, model_path)
+    # --quantize / --backend change the candidates, an int8 sweep must not reuse the fp32 ones
+    meta = {'model_path': model_path, 'model_mtime': os.path.getmtime(model_path), 'task': args.task,
+            'quantize': args.quantize, 'backend': args.backend, 'max_len': max_len, 'sentences': len(test_data),
+            'train_data': [[path, os.path.getsize(path), os.path.getmtime(path)] for path in train_paths]}
+    if args.streaming:
+        meta['dev_split'] = [args.dev_percent, args.max_dev_reviews]
+
+    sentences = None
+    if os.path.exists(cache_path):
+        sentences, cached_meta = Cascade.load_candidates(cache_path)
+        if cached_meta != meta:
+            logger.info('candidate cache {} is stale, rebuilding......'.format(cache_path))
+            sentences = None
+        else:
+            logger.info('loaded candidate cache {}'.format(cache_path))
+
+    if sentences is None:
+        model.eval()
+        head_ids = Cascade.query_head_ids(tokenize)
+        sentences = []
+        with torch.no_grad():
+            for batch_index, batch_dict in enumerate(batch_generator):
+                context_tokens, forward, backward = Cascade.candidate_pairs(model, batch_dict, head_ids, gpu, max_len)
+                context_list = context_tokens.tolist()
+                steps = ('C', 'Valence', 'Arousal') if args.task == 3 and 'category_query' in batch_dict \
+                    else ('Valence', 'Arousal')
+                attributes = {}
+                for ind, _ in forward + backward:
+                    asp, opi = Cascade.pair_tokens(context_list, ind)
+                    if (tuple(asp), tuple(opi)) not in attributes:
+                        attributes[(tuple(asp), tuple(opi))] = Cascade.predict_attributes(
+                            model, head_ids, asp, opi, context_tokens, gpu, steps)
+                sentences.append({'context': context_list, 'forward': forward, 'backward': backward,
+                                  'attributes': attributes})
+        Cascade.save_candidates(cache_path, sentences, meta)
+        logger.info('candidate cache saved to {}'.format(cache_path))
+
+    best_beta, best_f1 = None, -1.
+    for beta in beta_grid:
+        counts = Cascade.new_match_counts()
+        va_errors = Cascade.new_va_errors()
+        for sentence, test_example in zip(sentences, test_data):
+            attributes = lambda asp, opi: sentence['attributes'][(tuple(asp), tuple(opi))]
+            merged = Cascade.merge_pairs(sentence['context'], sentence['forward'], sentence['backward'], beta)
+            predictions = Cascade.sentence_predictions(merged, attributes, with_va=False)
+            Cascade.update_match_counts(counts, predictions, test_example)
+            Cascade.update_va_errors(va_errors, predictions, test_example, sentence['context'], attributes)
+
+        precision, recall, f1 = Cascade.precision_recall_f1(counts['triplet'])
+        _, _, f1_aspect_category = Cascade.precision_recall_f1(counts['aspect_category'])
+        logger.info('beta={}\tTriplet - Precision: {}\tRecall: {}\tF1: {}\tAspect-Category F1: {}\t'
+                    'Valence RMSE: {}\tArousal RMSE: {}'.format(
+                        beta, precision, recall, f1, f1_aspect_category,
+                        *Cascade.va_rmse(va_errors)))
+        if f1 > best_f1:
+            best_beta, best_f1 = beta, f1
+
+    logger.info('best inference_beta: {}\tTriplet F1: {}'.format(best_beta, best_f1))
+    return best_beta
+
+
+def quantized_model_path(model_path, quantize):
+    return model_path[:-len('.pth')] + '_' + quantize + '.pth'
+
+
+def inference_model_path(model_path):
+    return model_path[:-len('.pth')] + '_infer.safetensors'
+
+
+EXPORT_DTYPES = {'fp32': 'float32', 'fp16': 'float16', 'bf16': 'bfloat16'}
+
+
+def export_inference_artifact(args, model_path, max_len, category_mapping, logger):
+    """
+    Write task*_infer.safetensors: only the model weights (no optimizer state / epoch), floating point tensors cast
+    to --export_dtype, plus the metadata needed to run inference with it in the safetensors header.
+    """
+    import torch
+    from DimABSAModel import save_weights_file
+
+    checkpoint = torch.load(model_path, mmap=True)
+    dtype = getattr(torch, EXPORT_DTYPES[args.export_dtype])
+    net = {name: tensor.to(dtype) if tensor.is_floating_point() else tensor
+           for name, tensor in checkpoint['net'].items()}
+    meta = {
+        'task': args.task,
+        'domain': args.domain,
+        'language': args.language,
+        'categories': [key for key, value in sorted(category_mapping.items(), key=lambda item: item[1])],
+        'max_len': max_len,
+        'bert_model_type': args.bert_model_type,
+        'hidden_size': args.hidden_size,
+        'templates': get_query_templates(args.language),
+        'dtype': args.export_dtype,
+        'epoch': checkpoint.get('epoch'),
+    }
+    artifact_path = inference_model_path(model_path)
+    save_weights_file(artifact_path, net, meta)
+    logger.info('inference artifact saved to {} ({:.1f} MB, checkpoint {:.1f} MB)'.format(
+        artifact_path, os.path.getsize(artifact_path) / 2 ** 20, os.path.getsize(model_path) / 2 ** 20))
+    return artifact_path
+
+
+def weights_path(args, model_path):
+    """The file the weights are restored from: --inference_artifact when given, else the training checkpoint."""
+    return args.inference_artifact or model_path
+
+
+def read_weights(args, model_path, logger):
+    """
+    Weights to restore: checkpoint['net'] of the training checkpoint, or the export_inference artifact only when it is
+    asked for with --inference_artifact. Both are memory mapped, half precision weights are cast back by load_state_dict.
+    """
+    from DimABSAModel import load_weights_file
+
+    if args.inference_artifact:
+        artifact_path = args.inference_artifact
+        artifact = load_weights_file(artifact_path)
+        meta = artifact['meta']
+        category_dict, _ = category_map[args.domain]
+        categories = [key for key, value in sorted(category_dict.items(), key=lambda item: item[1])]
+        assert (meta['task'], meta['domain'], meta['language']) == (args.task, args.domain, args.language), \
+            '{} was exported for task {} {} {}'.format(artifact_path, meta['task'], meta['domain'], meta['language'])
+        assert meta['categories'] == categories, '{} has a different category list'.format(artifact_path)
+        logger.info('loaded inference artifact {} ({})'.format(artifact_path, meta['dtype']))
+        return artifact['net']
+    return load_weights_file(model_path)['net']
+
+
+def load_checkpoint(args, model, model_path, logger):
+    """
+    Load the trained fp32 checkpoint into model.
+    With --quantize int8 the model is dynamically quantized after loading, a saved int8 artifact
+    (task*_int8.pth, written with --save_quantized) is loaded directly when it is newer than the checkpoint.
+    """
+    from DimABSAOnnx import OnnxDimABSA
+
+    if isinstance(model, OnnxDimABSA):
+        # the exported graphs already hold the weights
+        logger.info('onnx backend, graphs from {}'.format(model.onnx_dir))
+        return model
+
+    import torch
+    from DimABSAModel import quantize_dynamic_int8
+
+    if args.quantize == 'none':
+        model.load_state_dict(read_weights(args, model_path, logger))
+        return model
+
+    assert not args.gpu, 'dynamic int8 quantization only runs on CPU, use --gpu='
+    int8_path = quantized_model_path(model_path, args.quantize)
+    if os.path.exists(int8_path) and os.path.getmtime(int8_path) >= os.path.getmtime(weights_path(args, model_path)):
+        model = quantize_dynamic_int8(model)
+        checkpoint = torch.load(int8_path, weights_only=False)
+        model.load_state_dict(checkpoint['net'])
+        logger.info('loaded int8 model {}'.format(int8_path))
+        return model
+
+    model.load_state_dict(read_weights(args, model_path, logger))
+    model = quantize_dynamic_int8(model)
+    logger.info('quantized model to int8')
+    if args.save_quantized:
+        torch.save({'net': model.state_dict(), 'quantize': args.quantize}, int8_path)
+        logger.info('int8 model saved to {}'.format(int8_path))
+    return model
+
+
+def compile_if_requested(args, model, logger):
+    """--compile: torch.compile (TorchScript fallback) of the encoder with bucketed sequence lengths + warm-up."""
+    if not args.compile:
+        return model
+    from DimABSAModel import DimABSA, compile_model
+
+    if isinstance(model, DimABSA):
+        buckets = [int(bucket) for bucket in args.compile_buckets.split(',')] if args.compile_buckets else None
+        logger.info('compiling encoder......')
+        compile_model(model, buckets, logger)
+    return model
+
+
+def state_dict_size(model):
+    import torch
+
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell()
+
+
+def dev_pass(args, model, tokenize, dev_dataset, test_data, gpu, max_len):
+    """One timed pass of the full cascade (with VA heads) over the dev split, returns the metrics of the report."""
+    import torch
+    import Cascade
+
+    model.eval()
+    head_ids = Cascade.query_head_ids(tokenize)
+    counts = Cascade.new_match_counts()
+    va_errors = Cascade.new_va_errors()
+    batch_generator = Utils.numpy_batches(dev_dataset)
+
+    start_time = time.time()
+    with torch.no_grad():
+        for batch_index, batch_dict in enumerate(batch_generator):
+            context_tokens, forward, backward = Cascade.candidate_pairs(model, batch_dict, head_ids, gpu, max_len)
+            context_list = context_tokens.tolist()
+            merged = Cascade.merge_pairs(context_list, forward, backward, args.inference_beta)
+            steps = ('C', 'Valence', 'Arousal') if args.task == 3 and 'category_query' in batch_dict \
+                else ('Valence', 'Arousal')
+
+            attribute_cache = {}
+
+            def attributes(asp, opi):
+                key = (tuple(asp), tuple(opi))
+                if key not in attribute_cache:
+                    attribute_cache[key] = Cascade.predict_attributes(
+                        model, head_ids, asp, opi, context_tokens, gpu, steps)
+                return attribute_cache[key]
+
+            predictions = Cascade.sentence_predictions(merged, attributes, with_va=False)
+            Cascade.update_match_counts(counts, predictions, test_data[batch_index])
+            Cascade.update_va_errors(va_errors, predictions, test_data[batch_index], context_list, attributes)
+    seconds = time.time() - start_time
+
+    precision, recall, f1 = Cascade.precision_recall_f1(counts['triplet'])
+    valence_rmse, arousal_rmse = Cascade.va_rmse(va_errors)
+    return {'precision': precision, 'recall': recall, 'f1': f1,
+            'aspect_category_f1': Cascade.precision_recall_f1(counts['aspect_category'])[2],
+            'valence_rmse': valence_rmse, 'arousal_rmse': arousal_rmse, 'va_pairs': va_errors['num'],
+            'seconds': seconds, 'sentences_per_second': len(test_data) / seconds if seconds else None,
+            'state_dict_bytes': state_dict_size(model)}
+
+
+def quantize_report(args, model, tokenize, dev_dataset, test_data, logger, gpu, max_len, model_path):
+    """Compare the fp32 model with its dynamic int8 version on the dev split and write the report as JSON."""
+    import torch
+    from DimABSAModel import quantize_dynamic_int8
+
+    report = {'fp32': dev_pass(args, model, tokenize, dev_dataset, test_data, gpu, max_len)}
+
+    quantized = quantize_dynamic_int8(model)
+    report['int8'] = dev_pass(args, quantized, tokenize, dev_dataset, test_data, gpu, max_len)
+    if args.save_quantized:
+        int8_path = quantized_model_path(model_path, 'int8')
+        torch.save({'net': quantized.state_dict(), 'quantize': 'int8'}, int8_path)
+        logger.info('int8 model saved to {}'.format(int8_path))
+
+    for name in ['fp32', 'int8']:
+        logger.info('{}\tTriplet - Precision: {}\tRecall: {}\tF1: {}\tAspect-Category F1: {}\t'
+                    'Valence RMSE: {}\tArousal RMSE: {}\t{:.1f} sentences/s\t{:.1f} MB'.format(
+                        name, report[name]['precision'], report[name]['recall'], report[name]['f1'],
+                        report[name]['aspect_category_f1'], report[name]['valence_rmse'],
+                        report[name]['arousal_rmse'], report[name]['sentences_per_second'] or 0.,
+                        report[name]['state_dict_bytes'] / 2 ** 20))
+    logger.info('int8 - fp32 Triplet F1: {}'.format(report['int8']['f1'] - report['fp32']['f1']))
+
+    report_path = args.save_model_path + 'quantize_report_task' + str(args.task) + '_' + args.domain + '_' + \
+        args.language + '.json'
+    with open(report_path, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+    logger.info('quantization report saved to {}'.format(report_path))
+    return report
+
+
+def open_prediction_cache(args, model_path, onnx_dir, max_len):
+    """--prediction_cache: PredictionCache fingerprinted with the weight files and decoding settings, else None."""
+    if not args.prediction_cache:
+        return None
+    if args.backend == 'onnx':
+        files = [onnx_dir]
+    else:
+        files = [weights_path(args, model_path), quantized_model_path(model_path, args.quantize)]
+    fast_threshold = args.fast_threshold if args.decode_policy == 'fast' else None
+    settings = decoding_settings(args.task, args.language, max_len, args.inference_beta, fast_threshold,
+                                 args.quantize, args.backend)
+    return PredictionCache(args.prediction_cache, fingerprint(files, settings, by_content=False),
+                           args.cache_memory_size, args.cache_max_entries)
+
+
+def model_file_paths(args):
+    """(checkpoint path, onnx graph folder) of the current task / domain / language."""
+    model_path = args.save_model_path + 'task' + str(args.task) + '_' + args.domain + '_' + args.language + '.pth'
+    onnx_dir = args.onnx_dir or \
+        args.save_model_path + 'onnx_task' + str(args.task) + '_' + args.domain + '_' + args.language + '/'
+    return model_path, onnx_dir
+
+
+def decoding_tokenizer(args):
+    """
+    Tokenizer of the query heads and decoded spans. --backend onnx uses Utils.load_tokenizer (the `tokenizers` library,
+    same ids), AutoTokenizer would import torch through transformers.
+    """
+    if args.backend == 'onnx' and args.mode in ['evaluate', 'inference']:
+        return Utils.load_tokenizer(args.bert_model_type)
+    # torch before transformers: torch.save of int8 weights finds some functions by searching sys.modules in import
+    # order, the lazy transformers module would try to import all of its models on the way
+    import torch
+    from transformers import AutoTokenizer
+    return AutoTokenizer.from_pretrained(args.bert_model_type)
+
+
+def build_model(args, category_mapping, onnx_dir):
+    from DimABSAOnnx import OnnxDimABSA
+
+    if args.backend == 'onnx' and args.mode in ['evaluate', 'inference']:
+        assert not args.gpu and args.quantize == 'none', 'the onnx backend runs the exported fp32 graphs on CPU'
+        return OnnxDimABSA(onnx_dir, args.ort_threads)
+    from DimABSAModel import DimABSA
+    # every mode but train overwrites all weights from a checkpoint, so the pretrained BERT weights are not loaded
+    model = DimABSA(args.hidden_size, args.bert_model_type, len(category_mapping), pretrained=args.mode == 'train')
+    if args.gpu:
+        model = model.cuda()
+    return model
+
+
+def inference_worker(job):
+    """
+    One --num_workers shard: run inference on the range (DataIO.shard_ranges) and write *.shard{k} outputs.
+    shared_model is the already loaded model with its weights in shared memory (--share_weights),
+    otherwise the worker loads its own copy.
+    """
+    args, shard, start, end, max_len, category_mapping, num_threads, shared_model = job
+    if args.backend == 'torch':
+        import torch
+        torch.set_num_threads(num_threads)
+    logger, fh, sh = Utils.get_logger(args.log_path + args.model_name + '.shard' + str(shard) + '.log')
+    tokenize = decoding_tokenizer(args)
+    model_path, onnx_dir = model_file_paths(args)
+
+    ID_list, Text_list, QA_list = load_inference_data(args, (start, end))
+    inf_dataset = InferenceReviewDataset(args, QA_list)
+
+    logger.info('shard {}: range [{}, {}), {} lines, {} threads'.format(shard, start, end, len(QA_list), num_threads))
+    if shared_model is not None:
+        model = shared_model
+    else:
+        model = build_model(args, category_mapping, onnx_dir)
+        model = load_checkpoint(args, model, model_path, logger)
+    model = compile_if_requested(args, model, logger)
+
+    cache = open_prediction_cache(args, model_path, onnx_dir, max_len)
+    batch_generator = Utils.numpy_batches(inf_dataset)
+    inference(args, model, tokenize, batch_generator, args.inference_beta, logger, args.gpu, max_len,
+              category_mapping, shard=shard, cache=cache)
+    if cache is not None:
+        cache.close()
+
+    rss, pss = Utils.memory_usage_mb()
+    logger.info('shard {} done, RSS: {} MB\tPSS: {} MB'.format(shard, rss, pss))
+    logger.removeHandler(fh)
+    logger.removeHandler(sh)
+    return shard, pss
+
+
+def sharded_inference(args, train_total_data, category_mapping):
+    """
+    --num_workers N: split --infer_data into N contiguous ranges (JSONL bytes / Parquet row groups), run one inference
+    process per range (torch threads = cores / N each) and concatenate the shard outputs in order, i.e. in the original
+    ID order.
+    """
+    # torch.multiprocessing hands --share_weights storages to the workers, --backend onnx runs without torch
+    if args.backend == 'onnx':
+        import multiprocessing
+    else:
+        import torch.multiprocessing as multiprocessing
+
+    logger, fh, sh = Utils.get_logger(args.log_path + args.model_name + '.log')
+    inference_data_path = args.data_path + args.infer_data
+    ranges = DataIO.shard_ranges(inference_data_path, args.num_workers)
+    num_threads = max(1, (os.cpu_count() or 1) // len(ranges))
+
+    # --share_weights: load the checkpoint once here and move the parameters into shared memory,
+    # torch.multiprocessing then hands the workers the shared storages instead of copies
+    shared_model = None
+    if args.share_weights:
+        model_path, onnx_dir = model_file_paths(args)
+        assert args.backend == 'torch', '--share_weights only applies to the torch backend'
+        logger.info('loading shared model......')
+        shared_model = build_model(args, category_mapping, onnx_dir)
+        shared_model = load_checkpoint(args, shared_model, model_path, logger)
+        shared_model.share_memory()
+        shared_model.eval()
+
+    jobs = [(args, shard, start, end, train_total_data[args.max_len], category_mapping, num_threads, shared_model)
+            for shard, (start, end) in enumerate(ranges)]
+
+    logger.info('inference with {} workers......'.format(len(jobs)))
+    with multiprocessing.get_context('spawn').Pool(processes=len(jobs)) as pool:
+        results = pool.map(inference_worker, jobs)
+    shards = [shard for shard, _ in results]
+    if all(pss is not None for _, pss in results):
+        logger.info('workers total PSS: {:.1f} MB'.format(sum(pss for _, pss in results)))
+
+    # compressed shards are concatenated as they are: gzip members / zstd frames in a row are still one valid file
+    subtask_dirs = ["subtask_2/", "subtask_3/"] if args.task == 3 else ["subtask_2/"]
+    for subtask_dir in subtask_dirs:
+        with open(output_file_name(args, subtask_dir), 'wb') as f:
+            for shard in shards:
+                shard_file_name = output_file_name(args, subtask_dir, shard)
+                with open(shard_file_name, 'rb') as shard_file:
+                    shutil.copyfileobj(shard_file, f)
+                os.remove(shard_file_name)
+    logger.removeHandler(fh)
+    logger.removeHandler(sh)
+
+
 def train(args, train_total_data, test_total_data, inference_dataset, category_mapping):
+    # only the modes that need them import torch / the model module (--backend onnx evaluate / inference run without)
     log_path = args.log_path + args.model_name + '.log'
-    model_path = args.save_model_path + 'task' + str(args.task) + '_' + args.domain + '_' + args.language + '.pth'
+    model_path, onnx_dir = model_file_paths(args)
 
     # init logger and tokenizer
     logger, fh, sh = Utils.get_logger(log_path)
-    tokenize = AutoTokenizer.from_pretrained(args.bert_model_type)
+    tokenize = decoding_tokenizer(args)
 
     # for training
     train_data = train_total_data['train']
@@ -1361,20 +1111,18 @@ def train(args, train_total_data, test_total_data, inference_dataset, category_m
     # for evaluating as golden labels
     dev_standard = test_total_data['dev']
 
-    model = DimABSA(args.hidden_size, args.bert_model_type, len(category_mapping))
-    if args.gpu:
-        model = model.cuda()
+    model = build_model(args, category_mapping, onnx_dir)
 
     if args.mode == 'evaluate':
         test_dataset = ReviewDataset(args, dev_data)
         # load checkpoint
         logger.info('loading model......')
-        checkpoint = torch.load(model_path)
-        model.load_state_dict(checkpoint['net'])
+        model = load_checkpoint(args, model, model_path, logger)
+        model = compile_if_requested(args, model, logger)
 
         # eval
         logger.info('evaluating......')
-        batch_generator_test = generate_batches(dataset=test_dataset, batch_size=1, shuffle=False, gpu=args.gpu)
+        batch_generator_test = Utils.numpy_batches(test_dataset)
         evaluate(args, model, tokenize, batch_generator_test, dev_standard, args.inference_beta,
                  logger, args.gpu, max_len)
 
@@ -1383,22 +1131,70 @@ def train(args, train_total_data, test_total_data, inference_dataset, category_m
         inf_dataset = InferenceReviewDataset(args, QA_list)
         # load checkpoint
         logger.info('loading model......')
-        checkpoint = torch.load(model_path)
-        model.load_state_dict(checkpoint['net'])
+        model = load_checkpoint(args, model, model_path, logger)
+        model = compile_if_requested(args, model, logger)
 
         # eval
         logger.info('evaluating......')
-        batch_generator_test = generate_batches(dataset=inf_dataset, batch_size=1, shuffle=False,
-                                                gpu=args.gpu)
+        cache = open_prediction_cache(args, model_path, onnx_dir, max_len)
+        batch_generator_test = Utils.numpy_batches(inf_dataset)
         inference(args, model, tokenize, batch_generator_test, args.inference_beta,
-                  logger, args.gpu, max_len, category_mapping)
+                  logger, args.gpu, max_len, category_mapping, cache=cache)
+        if cache is not None:
+            cache.close()
+
+    elif args.mode == 'sweep_beta':
+        dev_dataset = ReviewDataset(args, dev_data)
+        # load checkpoint
+        logger.info('loading model......')
+        model = load_checkpoint(args, model, model_path, logger)
+        model = compile_if_requested(args, model, logger)
+
+        logger.info('sweeping inference_beta......')
+        batch_generator_dev = Utils.numpy_batches(dev_dataset)
+        sweep_beta(args, model, tokenize, batch_generator_dev, dev_standard, logger, args.gpu, max_len, model_path)
+
+    elif args.mode == 'export_onnx':
+        from DimABSAModel import load_weights_file
+        from DimABSAOnnx import export_onnx
+
+        # load checkpoint
+        logger.info('loading model......')
+        model.load_state_dict(load_weights_file(model_path)['net'])
+
+        logger.info('exporting onnx graphs to {}......'.format(onnx_dir))
+        export_onnx(model, onnx_dir, max_len)
+
+    elif args.mode == 'export_inference':
+        logger.info('exporting inference artifact ({})......'.format(args.export_dtype))
+        export_inference_artifact(args, model_path, max_len, category_mapping, logger)
+
+    elif args.mode == 'quantize_report':
+        dev_dataset = ReviewDataset(args, dev_data)
+        assert not args.gpu, 'dynamic int8 quantization only runs on CPU, use --gpu='
+        from DimABSAModel import load_weights_file
 
+        # load fp32 checkpoint
+        logger.info('loading model......')
+        model.load_state_dict(load_weights_file(model_path)['net'])
+
+        logger.info('comparing fp32 and int8......')
+        quantize_report(args, model, tokenize, dev_dataset, dev_standard, logger, args.gpu, max_len, model_path)
 
     elif args.mode == 'train':
-        train_dataset = ReviewDataset(args, train_data)
+        import torch
+        from torch.optim import AdamW
+        from torch.cuda.amp import autocast, GradScaler
+        from transformers.optimization import get_linear_schedule_with_warmup
+        from DimABSAModel import load_weights_file
+
+        # --streaming: train_data is already the StreamingReviewDataset over the shards
+        train_dataset = train_data if args.streaming else ReviewDataset(args, train_data)
         dev_dataset = ReviewDataset(args, dev_data)
         batch_num_train = train_dataset.get_batch_num(args.batch_size)
 
+        model = compile_if_requested(args, model, logger)
+
         # optimizer
         logger.info('initial optimizer......')
         param_optimizer = list(model.named_parameters())
@@ -1432,6 +1228,9 @@ def train(args, train_total_data, test_total_data, inference_dataset, category_m
         # ====== 這裡開始是 AMP 重點：建立 scaler ======
         scaler = GradScaler(enabled=args.gpu)
 
+        # --streaming: the reviews are tokenized / turned into QA features in --preprocess_workers DataLoader processes
+        loader_workers = args.preprocess_workers if args.streaming and args.preprocess_workers > 1 else 0
+
         # training
         logger.info('begin training......')
         best_f1 = 0.
@@ -1439,9 +1238,12 @@ def train(args, train_total_data, test_total_data, inference_dataset, category_m
         for epoch in range(start_epoch, args.epoch_num + 1):
             model.train()
             model.zero_grad()
+            if args.streaming:
+                train_dataset.set_epoch(epoch)
             batch_generator = generate_batches(dataset=train_dataset,
                                                batch_size=args.batch_size,
-                                               gpu=args.gpu)
+                                               gpu=args.gpu,
+                                               num_workers=loader_workers)
 
             total_batches = 0  # 🔍 DEBUG D-1
             for batch_index, batch_dict in enumerate(batch_generator):
@@ -1628,10 +1430,7 @@ def train(args, train_total_data, test_total_data, inference_dataset, category_m
                     )
 
             # validation
-            batch_generator_dev = generate_batches(dataset=dev_dataset,
-                                                   batch_size=1,
-                                                   shuffle=False,
-                                                   gpu=args.gpu)
+            batch_generator_dev = Utils.numpy_batches(dev_dataset)
             logger.info("dev")
             dev_f1 = evaluate(args, model, tokenize, batch_generator_dev, dev_standard,
                               args.inference_beta, logger, args.gpu, max_len)
@@ -1639,18 +1438,17 @@ def train(args, train_total_data, test_total_data, inference_dataset, category_m
             if dev_f1 > best_f1:
                 best_f1 = dev_f1
                 logger.info('Model saved after epoch {}'.format(epoch))
-                state = {'net': model.state_dict(), 'optimizer': optimizer.state_dict(), 'epoch': epoch}
+                state = {'net': model.state_dict(), 'optimizer': optimizer.state_dict(), 'epoch': epoch,
+                         'max_len': max_len}
                 torch.save(state, model_path)
 
         # do inference
         ID_list, Text_list, QA_list = inference_dataset
         inf_dataset = InferenceReviewDataset(args, QA_list)
         logger.info('loading model......')
-        checkpoint = torch.load(model_path)
-        model.load_state_dict(checkpoint['net'])
+        model.load_state_dict(load_weights_file(model_path)['net'])
         logger.info('inference......')
-        batch_generator_test = generate_batches(dataset=inf_dataset, batch_size=1,
-                                                shuffle=False, gpu=args.gpu)
+        batch_generator_test = Utils.numpy_batches(inf_dataset)
         inference(args, model, tokenize, batch_generator_test, args.inference_beta,
                   logger, args.gpu, max_len, category_mapping)
 
@@ -1662,26 +1460,90 @@ def train(args, train_total_data, test_total_data, inference_dataset, category_m
     logger.removeHandler(sh)
 
 
-def load_inference_data(args):
-    tokenizer = AutoTokenizer.from_pretrained(args.bert_model_type)
+def preprocessed_data_path(args):
+    return args.preprocessed_data or \
+        args.save_model_path + 'preprocessed_task' + str(args.task) + '_' + args.domain + '_' + args.language + '.pkl'
+
+
+# bumped whenever the pickled feature classes change (2: CompactQueryAndAnswer, __slots__ / array('i') fields,
+# 3: Query.offsets)
+PREPROCESS_FORMAT = 3
+
+
+def preprocess_key(args):
+    """Everything the preprocessed features depend on, checked again when the pickle is loaded."""
+    key = {'format': PREPROCESS_FORMAT, 'task': args.task, 'domain': args.domain, 'language': args.language,
+           'bert_model_type': args.bert_model_type}
+    for name in ['train_data', 'infer_data']:
+        data_path = args.data_path + getattr(args, name)
+        key[name] = (data_path, os.path.getsize(data_path), os.path.getmtime(data_path))
+    return key
+
+
+def preprocess(args):
+    """--mode preprocess: tokenize and build the QA features of --train_data and --infer_data only, without torch."""
+    train_dataset, test_dataset, category_dict = load_train_data_multilingual(args)
+    inference_dataset = load_inference_data(args)
+    data_path = preprocessed_data_path(args)
+    with open(data_path, 'wb') as f:
+        # the key is its own pickle in front of the features, so it is checked before the features are unpickled
+        pickle.dump(preprocess_key(args), f, protocol=pickle.HIGHEST_PROTOCOL)
+        pickle.dump({'train': train_dataset, 'test': test_dataset,
+                     'category_dict': category_dict, 'inference': inference_dataset}, f,
+                    protocol=pickle.HIGHEST_PROTOCOL)
+    print('preprocessed data saved to {}'.format(data_path))
+
+
+def open_record_cache(args):
+    """--record_cache: RecordCache fingerprinted with the tokenizer files and the feature settings, else None."""
+    if not args.record_cache:
+        return None
+    settings = {'format': PREPROCESS_FORMAT, 'task': args.task, 'domain': args.domain, 'language': args.language,
+                'bert_model_type': args.bert_model_type, 'templates': get_query_templates(args.language)}
+    files = [os.path.join(args.bert_model_type, name)
+             for name in ['tokenizer.json', 'vocab.txt', 'tokenizer_config.json']]
+    return RecordCache(args.record_cache, fingerprint(files, settings))
+
+
+def load_preprocessed_data(args):
+    with open(preprocessed_data_path(args), 'rb') as f:
+        try:
+            key = pickle.load(f)
+        except (AttributeError, TypeError, pickle.UnpicklingError):
+            # written by an older version, its feature classes no longer unpickle
+            key = None
+        assert key == preprocess_key(args), \
+            '{} was preprocessed with other arguments / data files, re-run --mode preprocess'.format(
+                preprocessed_data_path(args))
+        data = pickle.load(f)
+    return data['train'], data['test'], data['category_dict'], data['inference']
+
+
+def load_inference_data(args, shard_range=None):
+    tokenizer = Utils.load_tokenizer(args.bert_model_type)
     inference_datasets = []
 
     # train_data_path, dev_data_path, test_data_path = dataset_path_map[args.domain + '_' + args.language]
     inference_data_path = args.data_path + args.infer_data
     category_dict, category_list = category_map[args.domain]
 
-    with open(inference_data_path, 'r', encoding='utf-8') as f:
-        for line in f:
-            data = json.loads(line)
-            data_id = data['ID']
-            text = data['Text'].lower()
-            text = " ".join(tokenizer.tokenize(text))
-            inference_datasets.append((data_id, text))
+    # shard_range: one DataIO.shard_ranges range of the file for --num_workers, default the whole file
+    # a Parquet file converted with the same tokenizer already holds the token ids / offsets
+    tokens = DataIO.iter_tokens(inference_data_path, shard_range) \
+        if DataIO.has_tokens(inference_data_path, args.bert_model_type) else None
+
+    for data in DataIO.iter_reviews(inference_data_path, shard_range):
+        data_id = data['ID']
+        text = data['Text']
+        # 只 tokenize 一次: token id + 每個 token 在 (小寫) 原文中的位置, 輸出的 span 直接從原文切出來
+        lowered = text.lower()
+        word_ids, offsets = next(tokens) if tokens is not None else tokenizer.encode(lowered)
+        inference_datasets.append((data_id, text if len(lowered) == len(text) else lowered, word_ids, offsets))
 
-        # 🔍 DEBUG A
-        print("[DEBUG A] load_inference_data: lines read from jsonl =", len(inference_datasets))
-        if len(inference_datasets) > 0:
-            print("[DEBUG A] first 3 IDs:", [x[0] for x in inference_datasets[:3]])
+    # 🔍 DEBUG A
+    print("[DEBUG A] load_inference_data: lines read from jsonl =", len(inference_datasets))
+    if len(inference_datasets) > 0:
+        print("[DEBUG A] first 3 IDs:", [x[0] for x in inference_datasets[:3]])
 
 
     inference_dataset = dataset_inference_process(args, inference_datasets, category_dict, tokenizer)
@@ -1690,18 +1552,9 @@ def load_inference_data(args):
 
 
 def load_train_data_multilingual(args):
-    from transformers import AutoTokenizer
-    tokenizer = AutoTokenizer.from_pretrained(args.bert_model_type)
-    def find_word_indices(text, phrase):
-        words = tokenizer.tokenize(text)[:256]
-        if phrase == "NULL" or not phrase:
-            return " ".join(words), "NULL", -1, -1
-        phrase_words = tokenizer.tokenize(phrase)
-
-        for i in range(len(words) - len(phrase_words) + 1):
-            if words[i:i + len(phrase_words)] == phrase_words:
-                return " ".join(words), " ".join(phrase_words), i, i + len(phrase_words) - 1
-        return " ".join(words), " ".join(phrase_words), -1, -1
+    tokenizer = Utils.load_tokenizer(args.bert_model_type)
+    # aspect / opinion 詞重複出現很多次, 每個 phrase 只 tokenize 一次
+    phrase_tokens = {}
 
     train_datasets = {
         'train': [],
@@ -1714,11 +1567,13 @@ def load_train_data_multilingual(args):
 
     category_dict, category_list = category_map[args.domain]
 
+    # --record_cache: reviews whose ID and content are cached are not tokenized again
+    cache = open_record_cache(args)
+
+    # JSONL or Parquet (DataIO.py)
     all_data =[]
-    with open(train_data_path, 'r', encoding='utf-8') as f:
-        for line in f:
-            data = json.loads(line)
-            all_data.append(data)
+    for data in DataIO.iter_reviews(train_data_path):
+        all_data.append((data, DataIO.content_hash(data) if cache is not None else None))
 
     random.seed(42)
     random.shuffle(all_data)
@@ -1727,51 +1582,79 @@ def load_train_data_multilingual(args):
     total_count = len(all_data)
     train_count = int(total_count * 0.8)
 
-    for i, data in enumerate(all_data):
-        text = data['Text']
-        quadruplets = data['Quadruplet']
-        quintuplets = []
-        for quad in quadruplets:
-            if 'Category' in quad and args.task == 3:
-                category = quad['Category'].upper()
-                if args.domain in ['lap']:
-                    replacement_dict = dict(zip(lap_filter_from_category, lap_filter_to_category))
-                    category = replace_using_dict(category, replacement_dict)
-                assert category in category_list, print(f"Wrong category type {category} in dataset, need filter.")
-            else:
-                category = None
-
-            new_text, new_opinion, a_start, a_end = find_word_indices(text, quad['Aspect'].lower())
-            _, new_opinion, o_start, o_end = find_word_indices(text, quad['Opinion'].lower())
-
-            va_parts = quad['VA'].split('#')
-            valence = va_parts[0]
-            arousal = va_parts[1] if len(va_parts) > 1 else "0.0"
-
-            quint = (
-                [a_start, a_end],
-                [o_start, o_end],
-                category,
-                valence,
-                arousal
-            )
-            quintuplets.append(quint)
-
-        quint_str = ", ".join([str(q) for q in quintuplets])
-        output_line = f"{new_text}####[{quint_str}]"
+    for i, (data, data_hash) in enumerate(all_data):
+        record = cache.get(data['ID'], data_hash) if cache is not None else None
+        if record is None:
+            # 直接交給 line_data_process, 不再組成 "text####[(...)]" 字串再用 regex / eval 解析回來
+            record = review_to_record(args, data, tokenizer, phrase_tokens)
+            if cache is not None:
+                record['cache_key'] = (data['ID'], data_hash)
         if i < train_count:
             dataset_type = 'train'
         else:
             dataset_type = 'dev'
-        train_datasets[dataset_type].append(output_line)
+        train_datasets[dataset_type].append(record)
 
-    train_dataset, eval_dataset = dataset_process(args, train_datasets, category_dict, tokenizer)
+    train_dataset, eval_dataset = dataset_process(args, train_datasets, category_dict, tokenizer, cache)
+    if cache is not None:
+        print('record cache: {} reviews reused, {} tokenized'.format(cache.hits, cache.misses))
+        cache.close()
 
     return train_dataset, eval_dataset, category_dict
 
+
+def load_streaming_train_data(args):
+    """
+    --streaming: one statistics pass over the shards (one --preprocess_workers process per shard) for the padding
+    sizes and the dev split, the training reviews are read again from the shards in every epoch.
+    """
+    from DataProcess import parallel_map, stream_shard_statistics, dataset_align
+    from StreamingData import StreamingReviewDataset, train_shard_paths
+
+    tokenizer = Utils.load_tokenizer(args.bert_model_type)
+    category_dict, category_list = category_map[args.domain]
+    paths = train_shard_paths(args)
+
+    results = parallel_map(stream_shard_statistics, [(args, path, tokenizer) for path in paths],
+                           args.preprocess_workers)
+    train_count = sum(result['train_count'] for result in results)
+    max_tokens_len = max(result['max_tokens_len'] for result in results)
+    max_aspect_num = max(result['max_aspect_num'] for result in results)
+    max_len = max(result['max_len'] for result in results)
+    dev_records = [record for result in results for record in result['dev_records']][:args.max_dev_reviews]
+
+    train_dataset, eval_dataset = dataset_process(args, {'train': [], 'dev': dev_records}, category_dict, tokenizer)
+    # the dev queries are padded like the training ones, to the maxima of the whole corpus
+    train_dataset = dataset_align(train_dataset, max_tokens_len, max_aspect_num + 1, tokenizer)
+    train_dataset['max_tokens_len'] = max_tokens_len
+    train_dataset['max_aspect_num'] = max_aspect_num
+    train_dataset['max_len'] = max_len
+    train_dataset['train'] = StreamingReviewDataset(args, paths, tokenizer, train_count, max_tokens_len,
+                                                    max_aspect_num)
+    print('Streaming {} training reviews from {} shard(s), {} dev reviews'.format(
+        train_count, len(paths), len(dev_records)))
+    return train_dataset, eval_dataset, category_dict
+
+
 if __name__ == '__main__':
     args = parser_getting()
     create_directory(args)
-    train_dataset, test_dataset, category_dict = load_train_data_multilingual(args)
-    inference_dataset = load_inference_data(args) # ID_LIST, TEXT_LIST, QA_LIST
-    train(args, train_dataset, test_dataset, inference_dataset, category_dict)
+    if args.mode == 'preprocess':
+        preprocess(args)
+        exit(0)
+
+    if args.streaming:
+        assert not args.preprocessed_data, '--streaming reads the shards directly, drop --preprocessed_data'
+        train_dataset, test_dataset, category_dict = load_streaming_train_data(args)
+        inference_dataset = None
+    elif args.preprocessed_data:
+        train_dataset, test_dataset, category_dict, inference_dataset = load_preprocessed_data(args)
+    else:
+        train_dataset, test_dataset, category_dict = load_train_data_multilingual(args)
+        inference_dataset = None
+    if args.mode == 'inference' and args.num_workers > 1:
+        sharded_inference(args, train_dataset, category_dict)
+    else:
+        if inference_dataset is None:
+            inference_dataset = load_inference_data(args) # ID_LIST, TEXT_LIST, QA_LIST
+        train(args, train_dataset, test_dataset, inference_dataset, category_dict)
@@ -3,6 +3,7 @@ import os
 import sys
 import argparse
 import time
+from DataIO import iter_reviews, open_text, compressed_name
 from google import genai # 确保您的环境中安装了 google-genai SDK
 # from google.generativeai.errors import APIError # 导入 APIError 用于更精确的错误处理
 
@@ -26,6 +27,7 @@ def parser_getting():
     parser.add_argument('--data_path', type=str, default="./dataset/", help="Base path for data files.")
     parser.add_argument('--infer_data', type=str, default="zho_restaurant_dev_task3.jsonl", help="Inference data file name.")
     parser.add_argument('--output_path', type=str, default="./tasks/")
+    parser.add_argument('--compress_output', type=str, default=None, choices=['gz', 'zst'], help="Write the predictions as .jsonl.gz / .jsonl.zst.")
     # 新增参数，用于限制推论数量，默认为 None (无限制)
     parser.add_argument('--limit', type=int, default=None, help="Limit the number of samples to process for testing.")
     
@@ -44,51 +46,26 @@ OUTPUT_FILENAME = OUT_PUT_FILE_NAME_MAP['res_zho']
 
 def load_inference_data(args):
     """
-    读取指定路径的 JSONL 文件。
+    读取指定路径的 JSONL / Parquet 文件。
     """
-    # 确保文件路径正确地使用了 args.infer_data
     file_path = os.path.join(args.data_path, args.infer_data)
+    if not os.path.exists(file_path):
+        file_path = args.infer_data
+    if not os.path.exists(file_path):
+        print(f"Error: Input file {os.path.join(args.data_path, args.infer_data)} or {args.infer_data} not found.", file=sys.stderr)
+        sys.exit(1)
+
+    def skip_line(line):
+        print(f"Skipping malformed line (JSON Decode Error): {line.strip()}", file=sys.stderr)
+
     inference_datasets = []
     print(f"Loading data from {file_path}...")
-    try:
-        with open(file_path, 'r', encoding='utf-8') as f:
-            for line in f:
-                if not line.strip():
-                    continue
-                try:
-                    # 修正：您的 JSONL 文件是每行一个完整的 JSON 对象，不需要 find('{')
-                    data = json.loads(line.strip())
-
-                except json.JSONDecodeError:
-                    print(f"Skipping malformed line (JSON Decode Error): {line.strip()}", file=sys.stderr)
-                    continue
-
-                data_id = data.get('ID')
-                text = data.get('Text')
-                if data_id and text:
-                    inference_datasets.append({'ID': data_id, 'Text': text})
-    except FileNotFoundError:
-        # 如果文件未找到，尝试在当前目录下查找 (针对您提供的文件)
-        try:
-             with open(args.infer_data, 'r', encoding='utf-8') as f:
-                print(f"Loading data from local file: {args.infer_data}...")
-                for line in f:
-                    if not line.strip():
-                        continue
-                    try:
-                        data = json.loads(line.strip())
-                    except json.JSONDecodeError:
-                        print(f"Skipping malformed line (JSON Decode Error): {line.strip()}", file=sys.stderr)
-                        continue
-
-                    data_id = data.get('ID')
-                    text = data.get('Text')
-                    if data_id and text:
-                        inference_datasets.append({'ID': data_id, 'Text': text})
-        except FileNotFoundError:
-            print(f"Error: Input file {file_path} or {args.infer_data} not found.", file=sys.stderr)
-            sys.exit(1)
-        
+    for data in iter_reviews(file_path, on_error=skip_line):
+        data_id = data.get('ID')
+        text = data.get('Text')
+        if data_id and text:
+            inference_datasets.append({'ID': data_id, 'Text': text})
+
     print(f"Loaded {len(inference_datasets)} samples.")
     return inference_datasets
 
@@ -262,8 +239,9 @@ def run_inference(args, inference_data, output_filename, limit=None): # 添加 l
         out_put_file_task3_name = os.path.join(output_dir, f"test_limit_{limit}_{output_filename}")
 
 
+    out_put_file_task3_name = compressed_name(out_put_file_task3_name, args.compress_output)
     print(f"\nWriting results to {out_put_file_task3_name}...")
-    with open(out_put_file_task3_name, 'w', encoding='utf-8') as f:
+    with open_text(out_put_file_task3_name, 'w') as f:
         for item in output_data_quadra:
             # 確保輸出是單行 JSON
             json_str = json.dumps(item, ensure_ascii=False)